@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Start-up benchmark of PRAGUI: time taken to import the modules loaded by the command line,
+# the GUI and the PRAGUI service, and to print the help of rnaseq_pip_util.py, each in a new
+# Python process, e.g.
+#   python3 benchmark_imports.py [max_seconds]
+# Fails if one of them cannot be imported, loads a module of HEAVY_MODULES (numpy, HTSeq...),
+# which should only be imported by the stages using them, or takes longer than max_seconds,
+# and if --help fails. The slowest imports reported by python -X importtime are listed to find
+# what to defer.
+
+import os
+import subprocess
+import sys
+import time
+
+PRAGUI_DIR = os.path.dirname(os.path.realpath(__file__))
+
+HEAVY_MODULES = ['numpy', 'HTSeq', 'pysam', 'pandas', 'scipy', 'matplotlib']
+
+# Modules timed, and the heavy modules they need anyway
+CHECKS = [('rnaseq_pip_util', []),
+          ('pragui_daemon',   []),
+          ('rnaseq_pip_gui',  ['PyQt5'])]
+
+DEFAULT_MAX_SECONDS = 1.0
+N_SLOWEST = 5
+
+
+def time_import(module):
+  # Wall time of importing module in a new process, the heavy modules it loaded and its
+  # slowest imports as [(cumulative microseconds, module)]
+  code = 'import sys, %s; print(" ".join([x for x in %r if x in sys.modules]))' % (module, HEAVY_MODULES)
+  start = time.time()
+  proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=PRAGUI_DIR, universal_newlines=True,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  seconds = time.time() - start
+  if proc.returncode != 0:
+    return(None, proc.stderr.strip().splitlines()[-1], [])
+  imports = []
+  for line in proc.stderr.splitlines():
+    # import time: self [us] | cumulative | imported package
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    self_us, cumulative, name = line[len('import time:'):].split('|')
+    if not name.startswith('  '): # Imported by the module itself rather than by its imports
+      imports.append((int(cumulative), name.strip()))
+  return(seconds, proc.stdout.split(), sorted(imports, reverse=True)[:N_SLOWEST])
+
+
+def time_help():
+  # Wall time of printing the help of rnaseq_pip_util.py, and its last error line if it failed
+  start = time.time()
+  proc = subprocess.run([sys.executable, os.path.join(PRAGUI_DIR, 'rnaseq_pip_util.py'), '--help'],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+  seconds = time.time() - start
+  if proc.returncode != 0:
+    return(seconds, (proc.stderr.strip().splitlines() or ['exit code %d' % proc.returncode])[-1])
+  return(seconds, None)
+
+
+def benchmark(max_seconds=DEFAULT_MAX_SECONDS):
+  # Print the timings and return the problems found
+  problems = []
+  for module, needed in CHECKS:
+    seconds, heavy, slowest = time_import(module)
+    if seconds is None:
+      print('%-16s not importable (%s)' % (module, heavy))
+      problems.append('%s cannot be imported: %s' % (module, heavy))
+      continue
+    print('%-16s %6.3f s' % (module, seconds))
+    for cumulative, name in slowest:
+      print('  %-24s %6.3f s' % (name, cumulative / 1e6))
+    heavy = [x for x in heavy if x not in needed]
+    if len(heavy) > 0:
+      problems.append('importing %s loads %s' % (module, ', '.join(heavy)))
+    if seconds > max_seconds:
+      problems.append('importing %s takes %.2f s' % (module, seconds))
+
+  seconds, error = time_help()
+  print('%-16s %6.3f s' % ('--help', seconds))
+  if error is not None:
+    problems.append('rnaseq_pip_util.py --help fails: %s' % error)
+  elif seconds > max_seconds:
+    problems.append('rnaseq_pip_util.py --help takes %.2f s' % seconds)
+  return(problems)
+
+
+if __name__ == '__main__':
+
+  max_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MAX_SECONDS
+  problems = benchmark(max_seconds)
+  for problem in problems:
+    print('FAILED: %s' % problem)
+  sys.exit(1 if len(problems) > 0 else 0)
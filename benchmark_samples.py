@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Scaling benchmark of the samples file bookkeeping done before the first tool runs:
+# reading the samples file, checking sample names and FASTQ files, fingerprinting the
+# samples for the run manifest, grouping Cufflinks replicates and writing the DESeq table.
+# Tab-separated samples files of increasing size are generated with small gzipped FASTQ
+# files in a temporary folder, and go through the same checks as a run, e.g.
+#   python3 benchmark_samples.py 1000 10000
+# The time of each step should grow linearly with the number of samples.
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import rnaseq_pip_util as rnapip
+
+DEFAULT_SIZES = [1000, 10000]
+N_CONDITIONS = 4
+FASTQ_RECORD = b'@read1\nACGTACGTACGTACGTACGT\n+\nIIIIIIIIIIIIIIIIIIII\n'
+
+
+def make_samples_csv(folder, n_samples):
+  # Paired-end samples file with n_samples rows over N_CONDITIONS conditions
+  samples_csv = os.path.join(folder, 'samples_%d.csv' % n_samples)
+  fastq_data = gzip.compress(FASTQ_RECORD)
+  file_obj = open(samples_csv, 'w')
+  file_obj.write('sample\tread1\tread2\tcondition\n')
+  for i in range(n_samples):
+    reads = []
+    for r in (1, 2):
+      fastq = os.path.join(folder, 'sample%d_r%d.fq.gz' % (i, r))
+      open(fastq, 'wb').write(fastq_data)
+      reads.append(fastq)
+    file_obj.write('sample%d\t%s\t%s\tcond%d\n' % (i, reads[0], reads[1], i % N_CONDITIONS))
+  file_obj.close()
+  return(samples_csv)
+
+
+def time_step(timings, name, func, *args):
+  start = time.time()
+  result = func(*args)
+  timings.append((name, time.time() - start))
+  return(result)
+
+
+def benchmark(folder, n_samples):
+  samples_csv = make_samples_csv(folder, n_samples)
+  timings = []
+  header, csv = time_step(timings, 'parse samples file', rnapip.parse_csv, samples_csv)
+  time_step(timings, 'check sample names', rnapip.check_csv_samples, csv)
+  time_step(timings, 'check FASTQ files', rnapip.check_csv_reads, csv)
+  time_step(timings, 'sample fingerprints', rnapip.sample_fingerprints, csv)
+  cxb_list = ['./%s_abundances.cxb' % os.path.basename(x) for x in csv[:,1]]
+  time_step(timings, 'Cufflinks replicates', rnapip.cuff_replicates, csv, cxb_list)
+  rc_file_list = ['%s_htseq.txt' % x for x in csv[:,0]]
+  header = ['sample', 'file', 'condition']
+  time_step(timings, 'DESeq table', rnapip.write_deseq_table,
+            os.path.join(folder, 'deseq_%d.txt' % n_samples), csv, header, rc_file_list)
+  return(timings)
+
+
+if __name__ == '__main__':
+
+  sizes = [int(x) for x in sys.argv[1:]] or DEFAULT_SIZES
+  folder = tempfile.mkdtemp(prefix='pragui_benchmark_')
+  try:
+    for n_samples in sizes:
+      timings = benchmark(folder, n_samples)
+      print('%d samples' % n_samples)
+      for name, seconds in timings:
+        print('  %-22s %8.3f s' % (name, seconds))
+      print('  %-22s %8.3f s' % ('total', sum([x[1] for x in timings])))
+  finally:
+    shutil.rmtree(folder)
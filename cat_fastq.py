@@ -1,6 +1,9 @@
 #!/home/paulafp/applications/anaconda3/bin/python3
 
 import csv
+import errno
+import fcntl
+import gzip
 import os
 import shutil
 import uuid
@@ -16,9 +19,125 @@ import cell_bio_util as util
 PROG_NAME = 'CAT_FASTQ'
 DESCRIPTION = 'Function to concatenate fastq files from different lanes and flowcells.'
 
+FICLONE = 0x40049409 # Linux ioctl making a file a copy-on-write clone of another (reflink), e.g. on Btrfs or XFS
+
+# Errors meaning a kernel copy method is not supported for a pair of files, rather than a failed copy
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+
+def reflink_file(in_path, out_path):
+  # Make out_path a copy-on-write clone of in_path, which shares its blocks until either is changed.
+  # Returns False, leaving no out_path, if the file system does not support it.
+  with open(in_path, 'rb') as in_file_obj:
+    with open(out_path, 'wb') as out_file_obj:
+      try:
+        fcntl.ioctl(out_file_obj.fileno(), FICLONE, in_file_obj.fileno())
+        return True
+      except OSError as err:
+        if err.errno not in UNSUPPORTED_ERRNOS + (errno.EPERM,):
+          raise
+  os.remove(out_path)
+  return False
+
+
+def hardlink_file(in_path, out_path):
+  # Returns False if in_path and out_path are on different file systems or linking is not allowed
+  try:
+    os.link(in_path, out_path)
+    return True
+  except OSError as err:
+    if err.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTSUP):
+      raise
+    return False
+
+
+def append_file(in_path, out_file_obj):
+  # Append the content of in_path at the current position of out_file_obj in the kernel, without
+  # going through user space buffers: copy_file_range (which may share blocks or copy on the
+  # server of a network file system), otherwise sendfile, otherwise a plain copy.
+  out_file_obj.flush()
+  out_fd = out_file_obj.fileno()
+
+  with open(in_path, 'rb') as in_file_obj:
+    in_fd = in_file_obj.fileno()
+    size = os.fstat(in_fd).st_size
+    copied = 0
+
+    if hasattr(os, 'copy_file_range'):
+      try:
+        while copied < size:
+          n = os.copy_file_range(in_fd, out_fd, size - copied)
+          if n == 0:
+            break
+          copied += n
+        return(copied)
+      except OSError as err:
+        if copied > 0 or err.errno not in UNSUPPORTED_ERRNOS:
+          raise
+
+    try:
+      while copied < size:
+        n = os.sendfile(out_fd, in_fd, copied, size - copied)
+        if n == 0:
+          break
+        copied += n
+      return(copied)
+    except OSError as err:
+      if copied > 0 or err.errno not in UNSUPPORTED_ERRNOS:
+        raise
+
+    shutil.copyfileobj(in_file_obj, out_file_obj)
+    out_file_obj.flush()
+    return(size)
+
+
+def concatenate_files(in_paths, out_path, allow_hardlink=True):
+  # Concatenate files of the same format into out_path at close to no CPU cost. A single file
+  # is cloned (reflink) where supported, else hard linked, else copied in the kernel. For several
+  # files the first is cloned and the others appended with append_file.
+  # Returns the method used for the first file, for reporting.
+  if reflink_file(in_paths[0], out_path):
+    method = 'reflink'
+  elif len(in_paths) == 1 and allow_hardlink and hardlink_file(in_paths[0], out_path):
+    return('hardlink')
+  else:
+    method = 'copy'
+    open(out_path, 'wb').close()
+
+  with open(out_path, 'r+b') as out_file_obj:
+    out_file_obj.seek(0, os.SEEK_END)
+    if method == 'copy':
+      append_file(in_paths[0], out_file_obj)
+    for in_path in in_paths[1:]:
+      append_file(in_path, out_file_obj)
+
+  return(method)
+
+
+def concatenate_gzip(in_paths, out_path):
+  # A GZIP file may hold several compressed members one after the other, so GZIP files are
+  # concatenated as they are. Uncompressed files are compressed into new members.
+  if all([x.endswith('.gz') for x in in_paths]):
+    return(concatenate_files(in_paths, out_path))
+
+  open(out_path, 'wb').close()
+  with open(out_path, 'r+b') as out_file_obj:
+    for in_path in in_paths:
+      if in_path.endswith('.gz'):
+        append_file(in_path, out_file_obj)
+      else:
+        with open(in_path, 'rb') as in_file_obj:
+          gzip_obj = gzip.GzipFile(fileobj=out_file_obj, mode='wb', compresslevel=6)
+          shutil.copyfileobj(in_file_obj, gzip_obj)
+          gzip_obj.close()
+        out_file_obj.flush()
+
+  return('copy')
+
+
 def cat_fastq(barcode_csv, fastq_paths_r1,
                   fastq_paths_r2=None, out_top_dir=None, 
-                  sub_dir_name=None, file_ext=None):
+                  sub_dir_name=None, file_ext=None, keep_gz=False):
   
   if not sub_dir_name:
     sub_dir_name = 'strain'
@@ -36,6 +155,9 @@ def cat_fastq(barcode_csv, fastq_paths_r1,
       
   if not file_ext:
     file_ext = util.get_file_ext(fastq_paths_r1[0])
+
+  if keep_gz and not file_ext.endswith('.gz'):
+    file_ext += '.gz'
     
   if not out_top_dir:
     file_path = fastq_paths_r1[0]
@@ -105,10 +227,21 @@ def cat_fastq(barcode_csv, fastq_paths_r1,
       else:
         # Concatenate or sym link
         
-        if len(in_fastq_paths) == 1 and not in_fastq_paths[0].endswith('.gz'):
+        if keep_gz:
+          util.info('Concatenating %s reads to %s' % (barcode_name, out_fastq_path))
+          method = concatenate_gzip(in_fastq_paths, out_fastq_path)
+          util.info(' .. using %s' % method)
+
+        elif len(in_fastq_paths) == 1 and not in_fastq_paths[0].endswith('.gz'):
           util.info('Sym linking %s reads to %s' % (barcode_name, out_fastq_path))
           os.symlink(in_fastq_paths[0], out_fastq_path)
-        
+
+        elif not any([x.endswith('.gz') for x in in_fastq_paths]):
+          # Uncompressed files of the same format are merged in the kernel
+          util.info('Concatenating %s reads to %s' % (barcode_name, out_fastq_path))
+          method = concatenate_files(in_fastq_paths, out_fastq_path)
+          util.info(' .. using %s' % method)
+
         else:
           with open(out_fastq_path, 'wb') as out_file_obj:
             util.info('Concatenating %s reads to %s' % (barcode_name, out_fastq_path))
@@ -150,6 +283,9 @@ if __name__ == '__main__':
   arg_parse.add_argument('-sub_dir_name', default=None, 
                          help='Name of subdirectory created in DIR_NAME to store output files (need not exist). Defaults to "strain".')
 
+  arg_parse.add_argument('-gz', default=False, action='store_true',
+                         help='Keep GZIP compressed reads compressed: GZIP files are concatenated as they are, which is much faster than decompressing them. Output files get a .gz extension.')
+
   args = vars(arg_parse.parse_args())
 
   barcode_csv   = args['barcode_csv']
@@ -158,6 +294,7 @@ if __name__ == '__main__':
   is_single_end = args['se']
   out_top_dir   = args['outdir']
   sub_dir_name  = args['sub_dir_name']
+  keep_gz       = args['gz']
   
   if len(pair_tags) != 2:
     util.critical('When specified, exactly two paired-end filename tags must be given.')
@@ -178,4 +315,4 @@ if __name__ == '__main__':
   
   cat_fastq(barcode_csv, fastq_paths_r1,
                   fastq_paths_r2=fastq_paths_r2, out_top_dir=out_top_dir, 
-                  sub_dir_name=None)
+                  sub_dir_name=None, keep_gz=keep_gz)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Local stand-in for SGE's qsub, to test cluster submissions (see pragui_cluster.py)
+# without a cluster. Jobs run immediately and one after the other, so a job held on
+# earlier jobs (-hold_jid) always starts after them. Array tasks (-t) run in order with
+# SGE_TASK_ID set, and the output of every job/task is written to NAME.oJOB_ID[.TASK_ID]
+# in the current folder as with "qsub -cwd -j y".
+# Job ids and exit statuses are kept in FAKE_QSUB_DIR (default: ./.fake_qsub). Jobs held on a job
+# exiting with code 100 are not run, as SGE leaves them held.
+
+import os
+import subprocess
+import sys
+
+PROG_NAME = 'fake_qsub'
+FAILED_EXIT = 100 # Puts a job in error state
+
+# qsub options followed by one or more values, all other options are flags
+OPTION_VALUES = {'-N':1, '-pe':2, '-l':1, '-hold_jid':1, '-t':1, '-o':1, '-e':1, '-j':1, '-q':1, '-wd':1}
+
+
+def parse_qsub_args(argv):
+  opts = {}
+  i = 0
+  while i < len(argv) and argv[i].startswith('-'):
+    n = OPTION_VALUES.get(argv[i], 0)
+    values = argv[i+1:i+1+n]
+    opts.setdefault(argv[i], []).append(values)
+    i += 1 + n
+  if i >= len(argv):
+    sys.stderr.write('%s: no job script given\n' % PROG_NAME)
+    sys.exit(1)
+  return(opts, argv[i], argv[i+1:])
+
+
+def new_job_id(state_dir):
+  counter = os.path.join(state_dir, 'last_job_id')
+  job_id = 1
+  if os.path.exists(counter):
+    job_id = int(open(counter).read()) + 1
+  open(counter, 'w').write(str(job_id))
+  return(job_id)
+
+
+def fake_qsub(argv):
+  opts, script, script_args = parse_qsub_args(argv)
+  state_dir = os.environ.get('FAKE_QSUB_DIR', '.fake_qsub')
+  os.makedirs(state_dir, exist_ok=True)
+
+  held = False
+  for values in opts.get('-hold_jid', []):
+    for hold in values[0].split(','):
+      done = os.path.join(state_dir, '%s.done' % hold)
+      if not os.path.exists(done):
+        sys.stderr.write('%s: held job %s is unknown\n' % (PROG_NAME, hold))
+        sys.exit(1)
+      held = held or str(FAILED_EXIT) in open(done).read().split()
+
+  job_id = new_job_id(state_dir)
+  name = opts.get('-N', [[os.path.basename(script)]])[-1][0]
+  slots = '1'
+  if '-pe' in opts:
+    slots = opts['-pe'][-1][1]
+
+  tasks = [None]
+  if '-t' in opts:
+    first, last = opts['-t'][-1][0].split(':')[0].split('-')
+    tasks = list(range(int(first), int(last) + 1))
+
+  exit_codes = []
+  if held: # As SGE, jobs held on a job in error state never start
+    sys.stderr.write('%s: job %d stays held, a job it waits for exited with code %d\n' % (PROG_NAME, job_id, FAILED_EXIT))
+    exit_codes = [FAILED_EXIT]
+    tasks = []
+  for task in tasks:
+    env = dict(os.environ, JOB_ID=str(job_id), JOB_NAME=name, NSLOTS=slots,
+               SGE_TASK_ID='undefined' if task is None else str(task))
+    out_name = '%s.o%d' % (name, job_id)
+    if task is not None:
+      out_name += '.%d' % task
+    out_obj = open(out_name, 'w')
+    exit_codes.append(subprocess.call(['bash', script] + script_args, env=env,
+                                      stdout=out_obj, stderr=subprocess.STDOUT))
+    out_obj.close()
+
+  open(os.path.join(state_dir, '%d.done' % job_id), 'w').write(' '.join([str(x) for x in exit_codes]) + '\n')
+
+  if '-terse' in opts:
+    if '-t' in opts:
+      print('%d.%s' % (job_id, opts['-t'][-1][0]))
+    else:
+      print(job_id)
+  else:
+    print('Your job %d ("%s") has been submitted' % (job_id, name))
+
+
+if __name__ == '__main__':
+
+  fake_qsub(sys.argv[1:])
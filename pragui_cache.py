@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+# Location of the files PRAGUI keeps between runs (run history, caches...).
+# Defaults to ~/.pragui and can be moved with the PRAGUI_HOME environment variable,
+# e.g. to a shared folder so that several users benefit from the same files.
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+
+PRAGUI_HOME = os.path.expanduser(os.environ.get('PRAGUI_HOME', '~/.pragui'))
+
+HASH_FILE = 'file_hashes.json'
+
+
+def pragui_path(*parts):
+  # Return the path of a file or folder under PRAGUI_HOME, creating its parent folder if needed
+  path = os.path.join(PRAGUI_HOME, *parts)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  return(path)
+
+
+@contextlib.contextmanager
+def file_lock(path, on_wait=None):
+  # Exclusive lock held on path.lock for the duration of a with block, so that
+  # runs sharing PRAGUI_HOME (e.g. cluster jobs) do not update a file at the same time.
+  # on_wait is called before blocking if another process holds the lock.
+  lock_obj = open(path + '.lock', 'a')
+  try:
+    fcntl.flock(lock_obj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except BlockingIOError:
+    if on_wait is not None:
+      on_wait()
+    fcntl.flock(lock_obj, fcntl.LOCK_EX)
+  try:
+    yield
+  finally:
+    fcntl.flock(lock_obj, fcntl.LOCK_UN)
+    lock_obj.close()
+
+
+def load_json(name, default=None):
+  # Read a JSON file under PRAGUI_HOME, returning default if it is missing or unreadable
+  path = pragui_path(name)
+  if not os.path.exists(path):
+    return(default)
+  try:
+    return(json.load(open(path, 'r')))
+  except ValueError:
+    return(default)
+
+
+def save_json(name, data):
+  # Write a JSON file under PRAGUI_HOME, replacing it in one step so readers never see half of it
+  path = pragui_path(name)
+  temp = '%s.%d.tmp' % (path, os.getpid())
+  file_obj = open(temp, 'w')
+  json.dump(data, file_obj, indent=1, sort_keys=True)
+  file_obj.close()
+  os.replace(temp, path)
+
+
+def file_hash(path, block_size=1024**2):
+  # SHA-256 of the content of a file. Hashes are cached by path, size and modification
+  # time, so that large files (e.g. genomes) are only read again after they change.
+  path = os.path.realpath(os.path.expanduser(path))
+  stat = os.stat(path)
+  key = '%s:%d:%d' % (path, stat.st_size, stat.st_mtime_ns)
+  cache = load_json(HASH_FILE, {})
+  if key in cache:
+    return(cache[key])
+  sha = hashlib.sha256()
+  file_obj = open(path, 'rb')
+  block = file_obj.read(block_size)
+  while block:
+    sha.update(block)
+    block = file_obj.read(block_size)
+  file_obj.close()
+  with file_lock(pragui_path(HASH_FILE)):
+    cache = load_json(HASH_FILE, {})
+    cache[key] = sha.hexdigest()
+    save_json(HASH_FILE, cache)
+  return(cache[key])
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# Submission of PRAGUI to an SGE cluster as per-sample jobs.
+# Instead of one job running the whole pipeline on a single node, three jobs are queued:
+#  1. index   - checks/builds the aligner index,
+#  2. samples - an array job with one task per sample (trimming, alignment, read count),
+#               held until the index job finishes,
+#  3. de      - differential expression, held until every sample task finishes.
+# Each job is sized for its own stages from the run history (see pragui_history.py).
+# Setting qsub to fake_qsub.py runs the same jobs locally, e.g. to test without a cluster.
+
+import os
+import subprocess
+
+import pragui_history
+
+DEFAULT_QSUB_ARGS = ['-pe', 'smp', '4']
+
+# Exit code putting an SGE job in error state, so that jobs held until it ends (-hold_jid) do not start
+SGE_FAILED_EXIT = 100
+
+# Stages run by each job, used to size it from the run history
+JOB_STAGES = {'index'   : ['setup', 'index'],
+              'samples' : ['setup', 'trim', 'align', 'count'],
+              'de'      : ['setup', 'de', 'cufflinks', 'multiqc']}
+
+
+def qsub_job(script, qsub_args, name, hold_jids=None, n_tasks=None, qsub='qsub'):
+  # Submit a job script and return its job id
+  cmdArgs = [qsub, '-terse', '-N', name] + qsub_args
+  if hold_jids:
+    cmdArgs += ['-hold_jid', ','.join(hold_jids)]
+  if n_tasks is not None:
+    cmdArgs += ['-t', '1-%d' % n_tasks]
+  cmdArgs.append(script)
+  out = subprocess.run(cmdArgs, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+  # -terse prints the job id, e.g. "123", or "123.1-4:1" for array jobs
+  job_id = out.strip().split('\n')[-1].split('.')[0]
+  return(job_id)
+
+
+def job_resources(job, csv, aligner, fasta_file, analysis_type, max_cpu=24):
+  # qsub options sizing a job from the run history, and the number of cores the pipeline should use
+  prediction = pragui_history.predict_resources(csv, aligner=aligner, fasta_file=fasta_file,
+                                                analysis_type=analysis_type, max_cpu=max_cpu,
+                                                stage_names=JOB_STAGES[job], per_sample=(job == 'samples'))
+  if prediction is None:
+    return(list(DEFAULT_QSUB_ARGS), int(DEFAULT_QSUB_ARGS[2]))
+  qsub_args = pragui_history.qsub_resource_args(prediction['cores'], prediction['mem'], prediction['walltime'])
+  return(qsub_args, prediction['cores'])
+
+
+def write_job_script(file_name, header, command):
+  file_obj = open(file_name, 'w')
+  file_obj.write('#!/bin/bash\n')
+  file_obj.write(header)
+  file_obj.write(command + '\n')
+  file_obj.close()
+  return(file_name)
+
+
+def submit_per_sample(pragui_command, csv, aligner, fasta_file, analysis_type, header='', qsub_args=None,
+                      job_name='pragui', max_cpu=24, qsub='qsub'):
+  # Submit the index, per-sample array and differential expression jobs.
+  # pragui_command is the full command line running rnaseq_pip_util.py without -stage/-cpu options
+  # and header holds the lines to run before it (e.g. module loads).
+  # Returns the ids of the three jobs.
+  if qsub_args is None:
+    qsub_args = ['-cwd', '-j', 'y', '-V']
+  job_ids  = []
+  hold_jid = []
+
+  for job in ['index', 'samples', 'de']:
+    resources, cpu = job_resources(job, csv, aligner, fasta_file, analysis_type, max_cpu=max_cpu)
+    command = '%s -stage=%s -cpu=%d' % (pragui_command, job, cpu)
+    n_tasks = None
+    if job == 'samples':
+      command += ' -sample_task=$SGE_TASK_ID'
+      n_tasks = len(csv)
+    if job != 'de':
+      command += ' || exit %d' % SGE_FAILED_EXIT # Keeps the jobs held by this one from starting
+    script = write_job_script('%s_%s.sh' % (job_name, job), header, command)
+    job_id = qsub_job(script, qsub_args + resources, '%s_%s' % (job_name, job),
+                      hold_jids=hold_jid, n_tasks=n_tasks, qsub=qsub)
+    os.remove(script) # qsub keeps its own copy of the job script
+    hold_jid = [job_id]
+    job_ids.append(job_id)
+
+  return(job_ids)
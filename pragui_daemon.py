@@ -0,0 +1,370 @@
+#!/usr/bin/python
+
+# Long-running PRAGUI service running jobs submitted over a local UNIX socket, e.g. from the GUI
+# or with "pragui_daemon.py -submit SAMPLES_CSV FASTA_FILE [options of rnaseq_pip_util.py]".
+# The service imports PRAGUI (numpy, HTSeq...) once and forks a process per job, so that jobs
+# start at once and keep what the service holds between jobs: the tool versions probed when it
+# starts and, with -star_index, STAR genomes loaded in shared memory for jobs using these indexes.
+# Waiting jobs are run fairly: in turn for each owner (the submitting user by default), in
+# submission order for a given owner, and at most -jobs at a time.
+# Requests and replies are JSON objects, one per line and connection:
+#   {"command": "submit", "args": [...], "cwd": "...", "status": "...", "output": "..."} -> {"job": 1}
+#   {"command": "jobs"}                                                               -> {"jobs": [...]}
+#   {"command": "cancel", "job": 1}                                                   -> {"cancelled": true}
+#   {"command": "shutdown"}                                                           -> {"shutdown": true}
+
+import collections
+import json
+import os
+import pwd
+import select
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+import traceback
+
+import rnaseq_pip_util as rnapip
+import pragui_versions
+import cell_bio_util as util
+
+PROG_NAME = 'pragui_daemon'
+
+SOCKET_PATH = os.environ.get('PRAGUI_SOCKET', os.path.join(tempfile.gettempdir(), 'pragui_%d.sock' % os.getuid()))
+
+POLL_INTERVAL = 1.0 # Seconds between checks of running jobs
+KILL_DELAY    = 10  # Seconds between SIGTERM and SIGKILL when cancelling a job
+REQUEST_TIMEOUT = 10
+
+
+class JobQueue(object):
+  '''
+  Jobs waiting to run, taken in turn from each owner with waiting jobs
+  and in submission order for each owner.
+  '''
+  def __init__(self):
+    self.waiting = collections.OrderedDict() # Owner: deque of jobs, owners in turn order
+
+  def add(self, job):
+    self.waiting.setdefault(job['owner'], collections.deque()).append(job)
+
+  def next_job(self):
+    if len(self.waiting) == 0:
+      return(None)
+    owner = next(iter(self.waiting))
+    jobs  = self.waiting.pop(owner)
+    job   = jobs.popleft()
+    if len(jobs) > 0: # Next turn of this owner after the others
+      self.waiting[owner] = jobs
+    return(job)
+
+  def remove(self, job):
+    jobs = self.waiting.get(job['owner'])
+    if jobs is None or job not in jobs:
+      return(False)
+    jobs.remove(job)
+    if len(jobs) == 0:
+      del self.waiting[job['owner']]
+    return(True)
+
+
+def append_event(status, event, **info):
+  # Progress event written for PRAGUI when it could not write one itself (see report_progress)
+  if status is None:
+    return
+  info['event'] = event
+  info['time']  = time.time()
+  fd = os.open(status, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  os.write(fd, (json.dumps(info) + '\n').encode())
+  os.close(fd)
+
+
+def run_job(job, shared_indexes):
+  # Fork a process running PRAGUI with the arguments of a job, in its own process group so
+  # that cancelling stops every tool it started. Returns the process id.
+  pid = os.fork()
+  if pid > 0:
+    return(pid)
+  exit_code = 1
+  try:
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    os.chdir(job['cwd'])
+    out_fd = os.open(job['output'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.dup2(out_fd, 1)
+    os.dup2(out_fd, 2)
+    os.close(out_fd)
+    rnapip.main(job['args'], shared_indexes=shared_indexes)
+    exit_code = 0
+  except SystemExit as err:
+    exit_code = err.code if isinstance(err.code, int) else 1
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
+
+def warm_imports():
+  # Modules imported by rnaseq_pip_util.py only when a run needs them, loaded once by the
+  # service so that forked jobs start with them
+  import numpy
+  import HTSeq
+  import readCsvFile
+
+
+def peer_user(conn):
+  # Name of the user connected to a UNIX socket
+  creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+  pid, uid, gid = struct.unpack('3i', creds)
+  try:
+    return(pwd.getpwuid(uid).pw_name)
+  except KeyError:
+    return(str(uid))
+
+
+class PRAGUIService(object):
+  '''
+  Service accepting PRAGUI jobs on a UNIX socket and running them as forked processes,
+  at most max_jobs at a time. star_indexes are loaded in shared memory for as long as it runs.
+  '''
+  def __init__(self, socket_path=SOCKET_PATH, max_jobs=1, star_indexes=()):
+    self.socket_path  = socket_path
+    self.max_jobs     = max_jobs
+    self.star_indexes = [os.path.realpath(x) for x in star_indexes]
+    self.queue   = JobQueue()
+    self.jobs    = collections.OrderedDict() # Job id: job
+    self.running = {} # Process id: job
+    self.last_id = 0
+    self.stopping = False
+
+  def job_summary(self, job):
+    return(dict([(x, job.get(x)) for x in ['id', 'owner', 'state', 'cwd', 'args', 'output', 'exit_code',
+                                           'submitted', 'started', 'finished']]))
+
+  def submit(self, request, owner):
+    self.last_id += 1
+    cwd = request.get('cwd') or os.getcwd()
+    job = {'id'        : self.last_id,
+           'owner'     : request.get('owner') or owner,
+           'args'      : [str(x) for x in request['args']],
+           'cwd'       : cwd,
+           'status'    : request.get('status'),
+           'output'    : request.get('output') or os.path.join(cwd, 'pragui_job_%d.out' % self.last_id),
+           'state'     : 'queued',
+           'submitted' : time.time()}
+    self.jobs[job['id']] = job
+    self.queue.add(job)
+    util.info('Job %d queued for %s in %s...' % (job['id'], job['owner'], cwd))
+    return({'job': job['id']})
+
+  def cancel(self, job_id):
+    job = self.jobs.get(job_id)
+    if job is None or job['state'] not in ('queued', 'running'):
+      return({'cancelled': False})
+    util.info('Cancelling job %d...' % job_id)
+    if self.queue.remove(job):
+      job['state'] = 'cancelled'
+      job['finished'] = time.time()
+      append_event(job['status'], 'failed', message='Job cancelled')
+    else:
+      job['cancel_time'] = time.time()
+      self.signal_job(job, signal.SIGTERM)
+    return({'cancelled': True})
+
+  def signal_job(self, job, sig):
+    try:
+      os.killpg(job['pid'], sig)
+    except ProcessLookupError:
+      pass
+
+  def handle(self, conn):
+    # Answer the request of a client connection
+    conn.settimeout(REQUEST_TIMEOUT)
+    try:
+      request = json.loads(conn.makefile('r').readline())
+      command = request.get('command')
+      if command == 'submit':
+        reply = self.submit(request, peer_user(conn))
+      elif command == 'jobs':
+        reply = {'jobs': [self.job_summary(x) for x in self.jobs.values()]}
+      elif command == 'cancel':
+        reply = self.cancel(int(request['job']))
+      elif command == 'shutdown':
+        self.stopping = True
+        reply = {'shutdown': True}
+      else:
+        reply = {'error': 'Unknown command %s' % command}
+    except (ValueError, KeyError, TypeError, OSError) as err: # OSError includes timeouts
+      reply = {'error': 'Invalid request: %s' % err}
+    try:
+      conn.sendall((json.dumps(reply) + '\n').encode())
+    except OSError: # Client gone
+      pass
+    conn.close()
+
+  def reap(self):
+    # Collect finished jobs, and kill cancelled jobs still running after KILL_DELAY
+    for pid, job in list(self.running.items()):
+      done, wait_status = os.waitpid(pid, os.WNOHANG)
+      if done == 0:
+        if 'cancel_time' in job and time.time() - job['cancel_time'] > KILL_DELAY:
+          self.signal_job(job, signal.SIGKILL)
+        continue
+      del self.running[pid]
+      if os.WIFEXITED(wait_status):
+        job['exit_code'] = os.WEXITSTATUS(wait_status)
+      else:
+        job['exit_code'] = -os.WTERMSIG(wait_status)
+      job['finished'] = time.time()
+      if 'cancel_time' in job:
+        job['state'] = 'cancelled'
+        if job['status'] is not None and os.path.isfile(job['status']):
+          # Outputs of unfinished stages would be taken as done by the next run
+          rnapip.remove_outputs([os.path.join(job['cwd'], x) for x in rnapip.partial_outputs(job['status'])])
+      else:
+        job['state'] = 'done' if job['exit_code'] == 0 else 'failed'
+      if job['exit_code'] != 0:
+        append_event(job['status'], 'failed', message='Exit code %d' % job['exit_code'])
+      util.info('Job %d %s after %.0f s...' % (job['id'], job['state'], job['finished'] - job['started']))
+
+  def start_jobs(self):
+    while len(self.running) < self.max_jobs and not self.stopping:
+      job = self.queue.next_job()
+      if job is None:
+        return
+      job['state']   = 'running'
+      job['started'] = time.time()
+      job['pid'] = run_job(job, self.star_indexes)
+      self.running[job['pid']] = job
+      util.info('Job %d started (process %d)...' % (job['id'], job['pid']))
+
+  def serve(self):
+    if os.path.exists(self.socket_path):
+      if service_running(self.socket_path):
+        util.critical('A PRAGUI service is already running on %s...' % self.socket_path)
+      os.remove(self.socket_path) # Left by a service that did not stop cleanly
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(self.socket_path)
+    os.chmod(self.socket_path, 0o600)
+    server.listen(16)
+
+    loaded = []
+    try:
+      for index in self.star_indexes:
+        util.info('Loading STAR index %s into shared memory...' % index)
+        util.call(rnapip.shared_genome_command(index, 'LoadAndExit'))
+        loaded.append(index)
+      warm_imports()
+      pragui_versions.probe_versions(list(pragui_versions.VERSION_ARGS))
+      util.info('PRAGUI service listening on %s, running up to %d jobs at a time...' % (self.socket_path, self.max_jobs))
+
+      while not (self.stopping and len(self.running) == 0):
+        readable = select.select([server], [], [], POLL_INTERVAL)[0]
+        if len(readable) > 0:
+          conn = server.accept()[0]
+          self.handle(conn)
+        self.reap()
+        self.start_jobs()
+    finally:
+      server.close()
+      os.remove(self.socket_path)
+      for job in self.running.values(): # Stopped by a signal
+        self.signal_job(job, signal.SIGTERM)
+      for index in loaded:
+        util.info('Removing STAR index %s from shared memory...' % index)
+        util.call(rnapip.shared_genome_command(index, 'Remove'))
+
+
+def request(message, socket_path=SOCKET_PATH, timeout=REQUEST_TIMEOUT):
+  # Send a request to the PRAGUI service and return its reply
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.settimeout(timeout)
+  sock.connect(socket_path)
+  sock.sendall((json.dumps(message) + '\n').encode())
+  reply = json.loads(sock.makefile('r').readline())
+  sock.close()
+  if 'error' in reply:
+    raise RuntimeError(reply['error'])
+  return(reply)
+
+
+def service_running(socket_path=SOCKET_PATH):
+  try:
+    request({'command': 'jobs'}, socket_path=socket_path)
+  except (OSError, ValueError):
+    return(False)
+  return(True)
+
+
+def submit_job(args, cwd=None, status=None, output=None, owner=None, socket_path=SOCKET_PATH):
+  # Queue a run of PRAGUI with the command line arguments of rnaseq_pip_util.py, returns the job id
+  message = {'command': 'submit', 'args': list(args), 'cwd': os.path.abspath(cwd or os.getcwd()),
+             'status': status, 'output': output, 'owner': owner}
+  return(request(message, socket_path=socket_path)['job'])
+
+
+def job_info(job_id, socket_path=SOCKET_PATH):
+  for job in request({'command': 'jobs'}, socket_path=socket_path)['jobs']:
+    if job['id'] == job_id:
+      return(job)
+  return(None)
+
+
+def cancel_job(job_id, socket_path=SOCKET_PATH):
+  return(request({'command': 'cancel', 'job': job_id}, socket_path=socket_path)['cancelled'])
+
+
+def stop_service(signum, frame):
+  sys.exit(0) # Runs the clean-up of PRAGUIService.serve
+
+
+if __name__ == '__main__':
+
+  from argparse import ArgumentParser, REMAINDER
+
+  arg_parse = ArgumentParser(prog=PROG_NAME, description='Long-running PRAGUI service with a local job queue.',
+                             prefix_chars='-', add_help=True)
+
+  arg_parse.add_argument('-socket', default=SOCKET_PATH,
+                         help='UNIX socket of the service. Default: %s (or the PRAGUI_SOCKET environment variable).' % SOCKET_PATH)
+
+  arg_parse.add_argument('-jobs', default=1, type=int,
+                         help='Number of jobs run at the same time. Default: 1')
+
+  arg_parse.add_argument('-star_index', nargs='+', default=[],
+                         help='STAR indexes kept in shared memory while the service runs, for jobs using them (-al_index).')
+
+  arg_parse.add_argument('-submit', nargs=REMAINDER, default=None,
+                         help='Submit a job to a running service, followed by the arguments of rnaseq_pip_util.py.')
+
+  arg_parse.add_argument('-list', default=False, action='store_true',
+                         help='List the jobs of a running service.')
+
+  arg_parse.add_argument('-cancel', default=None, type=int, metavar='JOB_ID',
+                         help='Cancel a job of a running service.')
+
+  arg_parse.add_argument('-shutdown', default=False, action='store_true',
+                         help='Stop a running service once its running jobs have finished. Queued jobs are not run.')
+
+  args = vars(arg_parse.parse_args())
+  socket_path = args['socket']
+
+  if args['submit'] is not None:
+    print('Job %d submitted' % submit_job(args['submit'], socket_path=socket_path))
+  elif args['list']:
+    for job in request({'command': 'jobs'}, socket_path=socket_path)['jobs']:
+      print('%d\t%s\t%s\t%s\t%s' % (job['id'], job['owner'], job['state'], job['cwd'], ' '.join(job['args'])))
+  elif args['cancel'] is not None:
+    print('Job %d cancelled' % args['cancel'] if cancel_job(args['cancel'], socket_path=socket_path)
+          else 'Job %d is not queued or running' % args['cancel'])
+  elif args['shutdown']:
+    request({'command': 'shutdown'}, socket_path=socket_path)
+  else:
+    util.init_app(PROG_NAME)
+    signal.signal(signal.SIGTERM, stop_service)
+    PRAGUIService(socket_path=socket_path, max_jobs=args['jobs'], star_indexes=args['star_index']).serve()
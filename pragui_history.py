@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Local history of PRAGUI runs.
+# Every completed run appends the wall-clock time, CPU time and peak memory of each
+# of its stages together with the size of its input, the aligner and the genome used.
+# The history is then used to predict the cores, memory and walltime needed by a new
+# samples file, e.g. to size cluster jobs.
+
+import json
+import math
+import os
+import time
+
+from pragui_cache import pragui_path
+
+HISTORY_FILE = 'run_history.jsonl'
+
+# Stages whose run time and output size grow with the number of reads.
+PER_READ_STAGES = ('trim', 'align', 'count', 'cufflinks')
+
+TIME_MARGIN = 1.5   # Predictions are padded to absorb run to run variation
+MEM_MARGIN  = 1.2
+MIN_WALLTIME = 3600
+MIN_MEM      = 2 * 1024**3
+
+
+def input_size(csv):
+  # Total size in bytes of the FASTQ files listed in a parsed samples file
+  size = 0
+  for row in csv:
+    for f in row[1:3]:
+      f = os.path.expanduser(f)
+      if f != '' and os.path.isfile(f):
+        size += os.path.getsize(f)
+  return(size)
+
+
+def genome_size(fasta_file):
+  fasta_file = os.path.expanduser(fasta_file)
+  if os.path.isfile(fasta_file):
+    return(os.path.getsize(fasta_file))
+  return(0)
+
+
+def record_run(clock, csv, aligner, fasta_file, analysis_type, num_cpu, skip=()):
+  # Append the stages measured by a StageClock to the history file, but for the stages in skip
+  # (e.g. with cached outputs, which would make per-read stages look faster than they are)
+  record = {'time'          : time.time(),
+            'aligner'       : aligner,
+            'genome'        : os.path.basename(fasta_file),
+            'genome_bytes'  : genome_size(fasta_file),
+            'analysis_type' : analysis_type,
+            'n_samples'     : len(csv),
+            'input_bytes'   : input_size(csv),
+            'cpu'           : num_cpu,
+            'stages'        : [{'stage': stage, 'wall': wall, 'cpu': cpu, 'peak_mem': peak_mem}
+                               for stage, wall, cpu, peak_mem in clock.stages if stage not in skip]}
+  file_obj = open(pragui_path(HISTORY_FILE), 'a')
+  file_obj.write(json.dumps(record) + '\n')
+  file_obj.close()
+
+
+def load_history():
+  records = []
+  history = pragui_path(HISTORY_FILE)
+  if os.path.exists(history):
+    for line in open(history, 'r'):
+      try:
+        records.append(json.loads(line))
+      except ValueError: # Ignore lines truncated by an interrupted write
+        pass
+  return(records)
+
+
+def matching_records(records, aligner, fasta_file, analysis_type):
+  # Prefer runs with the same aligner, genome and analysis type, then the same aligner only
+  genome = os.path.basename(fasta_file)
+  genome_bytes = genome_size(fasta_file)
+  same_setup = [x for x in records if x['aligner'] == aligner and x['analysis_type'] == analysis_type and
+                x['genome'] == genome and x['genome_bytes'] == genome_bytes]
+  if len(same_setup) > 0:
+    return(same_setup)
+  return([x for x in records if x['aligner'] == aligner and x['analysis_type'] == analysis_type])
+
+
+def predict_stages(records, input_bytes):
+  # Predict wall time, CPU time and peak memory of each stage for an input of input_bytes.
+  # Per-read stages are scaled by the input size using the total time over the total input
+  # of all records, so that large runs weigh more than small ones (e.g. previews).
+  totals = {}
+  for record in records:
+    for x in record['stages']:
+      wall, cpu, mem, size, n = totals.get(x['stage'], (0.0, 0.0, 0, 0, 0))
+      totals[x['stage']] = (wall + x['wall'], cpu + x['cpu'], max(mem, x['peak_mem']),
+                            size + record['input_bytes'], n + 1)
+  stages = {}
+  for stage, (wall, cpu, mem, size, n) in totals.items():
+    if stage in PER_READ_STAGES:
+      scale = float(input_bytes) / max(size, 1)
+    else:
+      scale = 1.0 / n
+    stages[stage] = {'wall': wall * scale, 'cpu': cpu * scale, 'peak_mem': mem}
+  return(stages)
+
+
+def predict_resources(csv, aligner, fasta_file, analysis_type, max_cpu=24, stage_names=None, per_sample=False):
+  # Predict the cores, memory (bytes) and walltime (seconds) needed to run a samples file.
+  # stage_names restricts the prediction to some stages, e.g. for a job running only those.
+  # per_sample predicts a job processing one average sample (e.g. a cluster array task).
+  # Returns None if there is no comparable run in the history.
+  records = matching_records(load_history(), aligner, fasta_file, analysis_type)
+  if len(records) == 0:
+    return(None)
+
+  input_bytes = input_size(csv)
+  if per_sample:
+    input_bytes = input_bytes / max(len(csv), 1)
+  stages = predict_stages(records, input_bytes)
+  if stage_names is not None:
+    stages = dict([(x, stages[x]) for x in stage_names if x in stages])
+  if len(stages) == 0:
+    return(None)
+
+  wall = sum([x['wall'] for x in stages.values()])
+  cpu  = sum([x['cpu'] for x in stages.values()])
+  mem  = max([x['peak_mem'] for x in stages.values()])
+
+  # Effective parallelism of past runs tells how many cores are actually put to use
+  cores = int(math.ceil(cpu / max(wall, 1)))
+  cores = min(max(cores, 1), max_cpu)
+
+  prediction = {'cores'    : cores,
+                'mem'      : max(int(mem * MEM_MARGIN), MIN_MEM),
+                'walltime' : max(int(wall * TIME_MARGIN), MIN_WALLTIME),
+                'stages'   : stages,
+                'n_runs'   : len(records)}
+  return(prediction)
+
+
+def format_duration(seconds):
+  seconds = int(round(seconds))
+  return('%d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60))
+
+
+def qsub_resource_args(cores, mem, walltime):
+  # qsub options requesting cores, memory and walltime. h_vmem is requested per slot.
+  mem_per_core = int(math.ceil(float(mem) / cores / 1024**3))
+  return(['-pe', 'smp', str(cores),
+          '-l', 'h_vmem=%dG' % mem_per_core,
+          '-l', 'h_rt=%s' % format_duration(walltime)])
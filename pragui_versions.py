@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# Versions of the external tools used by PRAGUI.
+# All the tools needed by a run are probed once, in parallel, when it starts. Versions are
+# cached under PRAGUI_HOME by path and modification time of each binary, so that tools are
+# only run again after being updated (probing can be slow on NFS-mounted module trees).
+
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import pragui_cache
+
+CACHE_FILE = 'tool_versions.json'
+
+# Options printing the version of each tool. Cufflinks tools print it in their usage message.
+VERSION_ARGS = {'STAR'        : ['--version'],
+                'hisat2'      : ['--version'],
+                'salmon'      : ['-v'],
+                'samtools'    : ['--version'],
+                'trim_galore' : ['--version'],
+                'cutadapt'    : ['--version'],
+                'fastqc'      : ['-v'],
+                'cufflinks'   : [],
+                'cuffmerge'   : ['--version'],
+                'cuffquant'   : [],
+                'cuffnorm'    : [],
+                'cuffdiff'    : [],
+                'Rscript'     : ['--version'],
+                'multiqc'     : ['--version']}
+
+PROBE_TIMEOUT = 120
+
+# Versions found in this run
+TOOL_VERSIONS = {}
+
+
+def tool_key(path):
+  # Cache key of a binary, changes when it is replaced or updated
+  path = os.path.realpath(path)
+  return('%s:%d' % (path, os.stat(path).st_mtime_ns))
+
+
+def run_probe(tool, path):
+  # First line of the tool output looking like a version, e.g. "samtools 1.15" or "FastQC v0.11.9"
+  try:
+    proc = subprocess.run([path] + VERSION_ARGS.get(tool, ['--version']), stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True, errors='replace',
+                          timeout=PROBE_TIMEOUT)
+  except (OSError, subprocess.TimeoutExpired):
+    return('unknown')
+  for line in proc.stdout.splitlines():
+    if re.search(r'\d+\.\d+', line):
+      return(line.strip())
+  return('unknown')
+
+
+def probe_versions(tools, num_threads=8):
+  # Find the versions of tools, running only those not in the cache. Returns {tool: version}.
+  paths = {}
+  for tool in tools:
+    path = shutil.which(tool)
+    paths[tool] = path
+
+  with pragui_cache.file_lock(pragui_cache.pragui_path(CACHE_FILE)):
+    cache = pragui_cache.load_json(CACHE_FILE, {})
+    versions = {}
+    to_probe = []
+    for tool, path in paths.items():
+      if path is None:
+        versions[tool] = 'not found'
+        continue
+      key = tool_key(path)
+      if key in cache:
+        versions[tool] = cache[key]
+      else:
+        to_probe.append((tool, path, key))
+
+    if len(to_probe) > 0:
+      pool = ThreadPoolExecutor(max_workers=num_threads)
+      results = pool.map(lambda x: run_probe(x[0], x[1]), to_probe)
+      for (tool, path, key), version in zip(to_probe, results):
+        versions[tool] = version
+        cache[key] = version
+      pool.shutdown()
+      pragui_cache.save_json(CACHE_FILE, cache)
+
+  TOOL_VERSIONS.update(versions)
+  return(versions)
+
+
+def tool_version(tool):
+  # Version of a tool, probing it if it was not among the tools of this run
+  if tool not in TOOL_VERSIONS:
+    probe_versions([tool])
+  return(TOOL_VERSIONS[tool])
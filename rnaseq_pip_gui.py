@@ -4,8 +4,16 @@ from PyQt5.QtWidgets import *
 from tempfile import NamedTemporaryFile
 from subprocess import run, Popen
 import rnaseq_pip_util as rnapip
+import pragui_cluster
+import pragui_daemon
+import pragui_history
 import sys
 import os
+import json
+import shlex
+import shutil
+import signal
+import time
 import traceback
 import uuid
 import subprocess
@@ -14,6 +22,12 @@ current_path = os.path.dirname(current_path) + '/cell_bio_util'
 sys.path.append(current_path)
 import cell_bio_util as util
 
+# Environment set up and PRAGUI location used by cluster jobs
+CLUSTER_HEADER = 'module load python3/3.7.1\nmodule load multiqc\nmodule load R\n'
+CLUSTER_PRAGUI = 'python3 /net/nfs1/public/genomics/PRAGUI/rnaseq_pip_util.py'
+# qsub command, can be set to fake_qsub.py to run cluster jobs locally
+QSUB = os.environ.get('PRAGUI_QSUB', 'qsub')
+
 
 class PRAGUISignals(QObject):
   '''
@@ -50,6 +64,130 @@ class RunPRAGUI(QRunnable):
       self.signals.finished.emit(ok)
 
 
+class PRAGUISupervisor(QObject):
+  '''
+  Class to run PRAGUI locally as a child process of the GUI.
+  PRAGUI runs in its own process group (see -gui in rnaseq_pip_util.py), so that
+  cancelling kills every tool it started (STAR, samtools, R...). Its output is
+  passed on line by line with the output signal without blocking the GUI.
+  Supported signals are:
+  output - str (a line written by PRAGUI)
+  finished - Boolean (did the job run without errors?)
+  '''
+  output   = pyqtSignal(str)
+  finished = pyqtSignal(bool)
+  KILL_DELAY = 10000 # ms between SIGTERM and SIGKILL
+
+  def __init__(self, args, status, parent=None):
+    super(PRAGUISupervisor, self).__init__(parent)
+    self.status    = status
+    self.cancelled = False
+    self.process = QProcess(self)
+    self.process.setProcessChannelMode(QProcess.MergedChannels)
+    self.process.readyReadStandardOutput.connect(self.read_output)
+    self.process.finished.connect(self.on_finished)
+    self.process.start(args[0], args[1:])
+
+  def read_output(self):
+    data = bytes(self.process.readAllStandardOutput()).decode(errors='replace')
+    for line in data.splitlines():
+      self.output.emit(line)
+
+  def signal_group(self, sig):
+    pid = self.process.processId()
+    if pid <= 0:
+      return
+    try:
+      os.killpg(pid, sig)
+    except (ProcessLookupError, PermissionError): # PRAGUI has not got its own group yet
+      os.kill(pid, sig)
+
+  def cancel(self):
+    if self.process.state() == QProcess.NotRunning:
+      return
+    self.cancelled = True
+    self.output.emit('Cancelling PRAGUI...')
+    self.signal_group(signal.SIGTERM)
+    QTimer.singleShot(self.KILL_DELAY, lambda: self.signal_group(signal.SIGKILL))
+
+  def remove_partial_outputs(self):
+    # Outputs of stages that were started but not finished are incomplete and
+    # would otherwise be skipped as already done by the next run
+    if not os.path.isfile(self.status):
+      return
+    for path in rnapip.partial_outputs(self.status):
+      if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+      elif os.path.exists(path):
+        os.remove(path)
+      else:
+        continue
+      self.output.emit('Removed partial output %s' % path)
+
+  def on_finished(self, exit_code, exit_status):
+    self.read_output()
+    if self.cancelled:
+      self.remove_partial_outputs()
+    self.finished.emit(exit_status == QProcess.NormalExit and exit_code == 0)
+
+
+class DaemonSupervisor(QObject):
+  '''
+  Class to run PRAGUI as a job of the PRAGUI service (see pragui_daemon.py) instead of a
+  child process of the GUI, with the signals of PRAGUISupervisor. The output of the job
+  is read from its output file as it grows. The service removes the partial outputs of
+  cancelled jobs.
+  Supported signals are:
+  output - str (a line written by PRAGUI)
+  finished - Boolean (did the job run without errors?)
+  '''
+  output   = pyqtSignal(str)
+  finished = pyqtSignal(bool)
+  POLL_INTERVAL = 1000 # ms between checks of the job
+
+  def __init__(self, args, status, parent=None):
+    super(DaemonSupervisor, self).__init__(parent)
+    self.status     = status
+    self.cancelled  = False
+    self.out_file   = os.path.splitext(status)[0] + '.out'
+    self.out_offset = 0
+    self.job_id = pragui_daemon.submit_job(args, status=status, output=self.out_file)
+    self.timer = QTimer(self)
+    self.timer.timeout.connect(self.poll)
+    self.timer.start(self.POLL_INTERVAL)
+
+  def read_output(self):
+    if not os.path.isfile(self.out_file):
+      return
+    out_obj = open(self.out_file,'rb')
+    out_obj.seek(self.out_offset)
+    data = out_obj.read()
+    out_obj.close()
+    data = data[:data.rfind(b'\n')+1] # A line may still be being written
+    self.out_offset += len(data)
+    for line in data.decode(errors='replace').splitlines():
+      self.output.emit(line)
+
+  def poll(self):
+    self.read_output()
+    try:
+      job = pragui_daemon.job_info(self.job_id)
+    except OSError: # Service stopped
+      job = None
+    if job is not None and job['state'] in ('queued', 'running'):
+      return
+    self.timer.stop()
+    self.read_output()
+    self.finished.emit(job is not None and job['state'] == 'done')
+
+  def cancel(self):
+    if not self.timer.isActive():
+      return
+    self.cancelled = True
+    self.output.emit('Cancelling PRAGUI...')
+    pragui_daemon.cancel_job(self.job_id)
+
+
 class MyFileFetchFrame(QFrame):
   """
   Class with a frame to find and load filenames. 
@@ -182,6 +320,8 @@ def centre(window):
 
 
 class Window(QWidget):
+  STATUS_POLL_INTERVAL = 5000 # ms between reads of the status file of cluster runs
+
   def __init__(self):
     super().__init__()
     self.initUI()
@@ -243,7 +383,11 @@ class Window(QWidget):
     self.qsub        = QCheckBox('Submit job to LMB cluster')
     self.node        = QCheckBox('Request a whole node')
     self.node.setEnabled(False)
+    self.array       = QCheckBox('One job per sample')
+    self.array.setEnabled(False)
     self.qsub.stateChanged.connect(self.enable_node_request)
+    self.daemon      = QCheckBox('Run on PRAGUI service')
+    self.daemon.setToolTip('Queue the job on the PRAGUI service started with pragui_daemon.py')
     self.csv_create = BuildCSV(None)
     self.csv_upload = UploadCSV(None)
     submit_btn = QPushButton('Submit',self)
@@ -273,6 +417,12 @@ class Window(QWidget):
     grid.addWidget(QLabel('',self),28,0,1,3) # add empty row
     grid.addWidget(submit_btn,29,1)
     grid.addWidget(quit_btn,29,2)
+    # Output of local runs
+    self.log_view = QPlainTextEdit(self)
+    self.log_view.setReadOnly(True)
+    self.log_view.setMaximumBlockCount(5000)
+    self.log_view.hide()
+    grid.addWidget(self.log_view,30,0,1,4)
     
     
     
@@ -339,9 +489,11 @@ class Window(QWidget):
     grid5.addWidget(self.skipmultiqc,2,0)
     grid5.addWidget(self.q,2,1)
     grid5.addWidget(self.log,1,1)
+    grid5.addWidget(self.daemon,3,0)
     grid5.addWidget(self.qsub,1,3)
     grid5.addWidget(self.cpu,2,3)
     grid5.addWidget(self.node,3,3)
+    grid5.addWidget(self.array,4,3)
     self.ProcOptsGroupBox.setLayout(grid5)
      
   def csv_func(self, text):
@@ -368,8 +520,10 @@ class Window(QWidget):
   def enable_node_request(self,checked):
     if checked:
       self.node.setEnabled(True)
+      self.array.setEnabled(True)
     else:
       self.node.setEnabled(False)
+      self.array.setEnabled(False)
       #self.log.setChecked(False)
   
   def closeEvent(self, event):
@@ -483,23 +637,44 @@ class Window(QWidget):
     if self.qsub.isChecked():
       if self.lib == 'paired-end':
         args = args + ['-pe',self.pe_tags]
+      if self.array.isChecked():
+        # Per-sample array job and differential expression job held on it
+        header, csv = rnapip.parse_csv(self.csv_file)
+        command = '%s %s' % (CLUSTER_PRAGUI, ' '.join(args))
+        job_ids = pragui_cluster.submit_per_sample(command, csv, aligner=dict_aux[self.txqt], fasta_file=self.fa_file,
+                                                   analysis_type=self.de, header=CLUSTER_HEADER,
+                                                   job_name='pragui_' + util.get_rand_string(5), qsub=QSUB)
+        show_pop_up(msg='Jobs %s submitted to LMB cluster!' % ', '.join(job_ids))
+        return
+      qsubArgs = [QSUB, '-cwd', '-j', 'y', '-V']
+      if self.node.isChecked():
+        qsubArgs = qsubArgs + ['-l', 'dedicated=24']
+      elif len(self.cpu_args)>0:
+        qsubArgs = qsubArgs + ['-pe', 'smp', dict_args['cpu']]
+      else:
+        # Size the job from the runtimes and memory of previous runs
+        header, csv = rnapip.parse_csv(self.csv_file)
+        prediction = pragui_history.predict_resources(csv, aligner=dict_aux[self.txqt], fasta_file=self.fa_file,
+                                                      analysis_type=self.de, max_cpu=24)
+        if prediction is None:
+          #qsubArgs = ['qsub', '-cwd', '-pe', 'smp', '4', '-j', 'y', '-V', temp]
+          qsubArgs = qsubArgs + ['-pe', 'smp', '4']
+        else:
+          util.info('Requesting %d cores, %.1f GB of memory and a walltime of %s based on %d previous runs...' %
+                    (prediction['cores'], prediction['mem'] / 1024.0**3,
+                     pragui_history.format_duration(prediction['walltime']), prediction['n_runs']))
+          qsubArgs = qsubArgs + pragui_history.qsub_resource_args(prediction['cores'], prediction['mem'],
+                                                                  prediction['walltime'])
+          args.append('-cpu=%d' % prediction['cores'])
       command = ' '.join(args)
-      command = 'module load python3/3.7.1\nmodule load multiqc\nmodule load R\npython3 /net/nfs1/public/genomics/PRAGUI/rnaseq_pip_util.py %s ' % (command)
+      command = '%s%s %s ' % (CLUSTER_HEADER, CLUSTER_PRAGUI, command)
+      # Report jobs failing before PRAGUI starts (e.g. missing modules)
+      command += '|| echo \'{"event": "failed", "time": 0}\' >> %s\n' % self.status
       temp = 'job_' + util.get_rand_string(5) + ".sh"
       tempObj = open(temp, 'w')
       tempObj.write(command)
       tempObj.close()
-      qsubArgs = ['qsub', '-cwd', '-j', 'y', '-V']
-      if self.node.isChecked():
-        qsubArgs = qsubArgs + ['-l', 'dedicated=24', temp]
-      else:
-        if len(self.cpu_args)>0:
-          cpu = dict_args['cpu']
-        else:
-          cpu = '4'
-        #qsubArgs = ['qsub', '-cwd', '-pe', 'smp', '4', '-j', 'y', '-V', temp]
-        qsubArgs = qsubArgs + ['-pe', 'smp', cpu, temp]
-      util.call(qsubArgs)
+      util.call(qsubArgs + [temp])
       show_pop_up(msg='Job submitted to LMB cluster!')
       os.remove(temp)
     # Run PRAGUI on local machine
@@ -507,16 +682,40 @@ class Window(QWidget):
       if self.lib == 'paired-end':
         args = args + ['-pe'] + self.pe_tags.split(' ')
       pragui = '%s/rnaseq_pip_util.py' % os.path.dirname(os.path.realpath(__file__))
-      args   = ['python3',pragui] + args
-      util.call(args, shell=True)
-      #util.info(' '.join(args))
-      #proc = Popen(args)
-      #proc.communicate()
+      # Options were quoted for a shell, split them the same way
+      args   = ['python3',pragui] + shlex.split(' '.join(args))
+      self.log_view.clear()
+      self.log_view.show()
+      if self.daemon.isChecked():
+        if not pragui_daemon.service_running():
+          self.stop_progress()
+          show_error_message('The PRAGUI service is not running. Please start it with pragui_daemon.py.')
+          return
+        self.supervisor = DaemonSupervisor(args[2:], self.status, self)
+        self.log_view.appendPlainText('PRAGUI job %d queued, output in %s' % (self.supervisor.job_id,
+                                                                               self.supervisor.out_file))
+      else:
+        self.supervisor = PRAGUISupervisor(args, self.status, self)
+      self.supervisor.output.connect(self.log_view.appendPlainText)
+      self.supervisor.finished.connect(self.on_local_finished)
+      self.progress.canceled.connect(self.supervisor.cancel)
+
+  def on_local_finished(self, ok):
+    if self.progress_stopped:
+      return
+    self.read_progress(self.status) # Events written just before PRAGUI exited
+    if self.progress_stopped:
+      return
+    if self.supervisor.cancelled:
+      self.stop_progress()
+      show_pop_up('Job cancelled.')
+    elif not ok:
+      self.print_error()
 
   def print_error(self):
     #err = t[2]
     #msg = 'Oops! An error has ocurred:  %s' % err
-    self.timer.stop()
+    self.stop_progress()
     msg = 'Oops! An error has ocurred. Please refer to your log file or terminal for more information.'
     show_error_message(msg)
     
@@ -524,53 +723,100 @@ class Window(QWidget):
     if job:
       msg = 'Job finished successfully.'
       show_pop_up(msg)
-      
-  def check_progress(self):
-    self.counter +=1
+
+  def stop_progress(self):
+    self.progress_stopped = True
+    self.watcher.removePath(self.status)
+    if self.status_timer is not None:
+      self.status_timer.stop()
+    # Closing the dialog emits canceled, which must not cancel a job that is ending
+    try:
+      self.progress.canceled.disconnect()
+    except TypeError: # Nothing connected, e.g. cluster jobs
+      pass
+    self.progress.close()
     if os.path.isfile(self.status):
-      status_obj = open(self.status,'r')
-      n = 0
-      line = ''
-      for line in status_obj:
-        line = line.rstrip('\n')
-        n+=1
-      status_obj.close()
-      value = 100 * n / 6
-      self.progress.setValue(value)
-      self.progress.setLabelText(line)
-      #self.progress.update()
-      if value == 100:
-        os.remove(self.status)
-        msg = 'Job finished successfully.'
-        show_pop_up(msg)
-        self.timer.stop()
-      elif self.qsub.isChecked() and self.counter>2:
-        stdout = open('qstat.out','w')
-        subprocess.run(['qstat'],stdout=stdout)
-        print('Checking qstat...')
-        # util.call(['qstat'],stdout='qstat.out')
-        if os.stat('qstat.out').st_size == 0:
+      os.remove(self.status)
+
+  def read_progress(self, path):
+    """
+    This function reads the progress events appended to
+    the status file since it was last read (one JSON object per line,
+    see report_progress in rnaseq_pip_util.py) and updates the progress dialog.
+    """
+    if self.progress_stopped or not os.path.isfile(self.status):
+      return
+    status_obj = open(self.status,'rb')
+    status_obj.seek(self.status_offset)
+    data = status_obj.read()
+    status_obj.close()
+    data = data[:data.rfind(b'\n')+1] # A line may still be being written
+    for line in data.splitlines(True):
+      try:
+        event = json.loads(line.decode(errors='replace'))
+      except ValueError:
+        if self.status_bad_offset != self.status_offset: # May not be complete yet (e.g. over NFS), read it again next time
+          self.status_bad_offset = self.status_offset
+          break
+        event = None # Still malformed, skip it
+      self.status_offset += len(line)
+      if not isinstance(event, dict):
+        continue
+      if event['event'] == 'start':
+        self.progress_start = event['time']
+        self.progress_samples = event['samples']
+        self.progress_stages = event['sample_stages']
+        self.progress_total = len(event['samples']) * len(event['sample_stages']) + len(event['run_stages'])
+      elif event['event'] == 'done':
+        self.progress_done.add((event['stage'], event.get('sample')))
+      elif event['event'] == 'failed':
+        if self.qsub.isChecked() or not self.supervisor.cancelled:
           self.print_error()
-          self.timer.stop()
-          self.progress.close()
-        os.remove('qstat.out')
+        return
+      elif event['event'] == 'finished':
+        self.progress.setValue(100)
+        self.stop_progress()
+        show_pop_up('Job finished successfully.')
+        return
+    if self.progress_total is None:
+      return
+    # Per-stage completion, e.g. "trim 4/4, align 2/4, count 1/4"
+    n_done = len(self.progress_done)
+    stages = [x for x, sample in self.progress_done]
+    n_samples = len(self.progress_samples)
+    label = ', '.join(['%s %d/%d' % (x, stages.count(x), n_samples) for x in self.progress_stages])
+    if n_done > 0:
+      elapsed = time.time() - self.progress_start
+      eta = int(elapsed * (self.progress_total - n_done) / n_done)
+      label += '\nAbout %d:%02d:%02d left' % (eta // 3600, (eta % 3600) // 60, eta % 60)
+    self.progress.setValue(100 * n_done // self.progress_total)
+    self.progress.setLabelText(label)
            
   def on_submit(self):
-    self.counter = 0
-    self.status =  'status_%s.txt' % uuid.uuid4()
+    self.status =  os.path.abspath('status_%s.jsonl' % uuid.uuid4())
     status_obj = open(self.status,'w')
     status_obj.close()
+    self.status_offset  = 0
+    self.status_bad_offset = None
+    self.progress_done  = set()
+    self.progress_total = None
+    self.progress_stopped = False
     self.progress = QProgressDialog('PRAGUI\'s Progress...','Cancel',0,100)
-    # Set timer
-    self.timer = QTimer()
-    self.timer.setInterval(30000)#(120000)
-    self.timer.timeout.connect(self.check_progress)
-    self.timer.start()
+    # Progress events are appended to the status file by PRAGUI
+    self.watcher = QFileSystemWatcher([self.status])
+    self.watcher.fileChanged.connect(self.read_progress)
+    # Cluster nodes append to it over NFS, whose writes raise no change event on this host
+    self.status_timer = None
+    if self.qsub.isChecked():
+      self.status_timer = QTimer(self)
+      self.status_timer.timeout.connect(lambda: self.read_progress(self.status))
+      self.status_timer.start(self.STATUS_POLL_INTERVAL)
+    # Local runs are started under a supervisor, which must live in the GUI thread
+    if not self.qsub.isChecked():
+      self.execute_pragui()
+      return
     # Submit
     submit = RunPRAGUI(self.execute_pragui)
-    if not self.qsub.isChecked():
-      submit.signals.error.connect(self.print_error)
-      # submit.signals.finished.connect(self.print_job_done)
     self.threadpool.start(submit)
 
 
@@ -730,5 +976,6 @@ if __name__ == '__main__':
 
   #window = Window()
   window = MyMainWindow()
+  QTimer.singleShot(0, lambda: util.init_app('rnapip')) # Once the window is drawn
   app.exec_()
 
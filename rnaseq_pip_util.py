@@ -1,18 +1,25 @@
 #!/usr/bin/python
 
+import collections
 import gzip
-import multiprocessing
+import hashlib
+import json
+import math
 import os
 import random
+import resource
+import shlex
 import string
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import uuid
 import glob
-import numpy as np
 import shutil
-import HTSeq
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 current_path = os.path.realpath(__file__)
 pragui_directory = os.path.dirname(current_path)
@@ -21,18 +28,192 @@ current_path = os.path.dirname(current_path) + '/cell_bio_util'
 sys.path.append(current_path)
 import cell_bio_util as util
 
-from readCsvFile import readCsvFile
+import pragui_cache
+import pragui_history
+import pragui_versions
 
 PROG_NAME = 'RNAseq Pipeline'
 DESCRIPTION = 'Process fastq files to RNAseq data analysis.'
 
-util.init_app('rnapip') # Redefine variables from cross_fil_util.py
-
 ALIGNERS = ('STAR', 'hisat2', 'tophat2','salmon')
 ALIGNER_STAR, ALIGNER_HISAT2, ALIGNER_TOPHAT2, SALMON = ALIGNERS
 DEFAULT_ALIGNER = ALIGNER_STAR
+
+TRIM_DIR = './trim_galore' # Default output folder of trim_galore
+TRIM_ADAPTER = 'AGATCGGAAGAGC' # Illumina universal adapter, as detected by trim_galore for most libraries
+
+# awk program passing on SAM header lines, unpaired reads and pairs on one contig, and
+# writing reads whose mate is on another contig to the file named by the variable cross
+SHARD_FILTER = '/^@/ || $7 == "=" || $7 == "*" {print; next} {print > cross}'
 OTHER_ALIGNERS = [ALIGNER_HISAT2, ALIGNER_TOPHAT2, SALMON]
 
+INDEX_MARKER = '.pragui_index.json' # Written once an index is complete
+
+# Share of the available memory STAR may use, the rest is left to the system and other tools
+STAR_MEM_FRACTION = 0.85
+STAR_MIN_SORT_RAM = 2 * 1024**3
+
+# Cuffdiff run on groups of loci in parallel (option -cuffdiff_shards): memory assumed to be
+# needed by each single-threaded Cuffdiff (option -cuffdiff_mem) and share of the available
+# memory they may use together. With -cuffdiff_total_norm, libraries are normalised by their total
+# numbers of fragments, which do not depend on the loci of a shard, so that all shards scale them alike.
+CUFFDIFF_WORKER_MEM = 4.0 # GB
+CUFFDIFF_MEM_FRACTION = 0.85
+CUFFDIFF_SHARD_OPTIONS = ['--library-norm-method', 'classic-fpkm', '--total-hits-norm']
+CUFFDIFF_FDR = 0.05 # Default --FDR of Cuffdiff
+GTF_GENE_ID = re.compile('gene_id "([^"]*)"')
+GTF_TRANSCRIPT_ID = re.compile('transcript_id "([^"]*)"')
+
+COUNT_SETTINGS = ['genome_gtf', 'stranded', 'mapq'] # Options of a run changing its read count tables
+
+SALMON_MATRICES = ['counts', 'abundance', 'length'] # Gene-level tables summarised from quant.sf files
+
+FILE_CHECK_THREADS = 16 # Threads checking the FASTQ files of a samples file
+
+# Rough size of the outputs of each stage relative to its inputs, used by the plan of a run
+# (option -plan) until some samples of the run have been processed to measure it
+PLAN_OUTPUT_RATIOS = {'index'     : 1.5, # STAR indexes are sized from their options
+                      'trim'      : 0.9,
+                      'align'     : 1.2,
+                      'count'     : 1.0, # BAM files sorted for counting
+                      'de'        : 0.01,
+                      'cufflinks' : 0.1,
+                      'multiqc'   : 0.0}
+PLAN_STAGES = ('index', 'trim', 'align', 'count', 'de', 'cufflinks', 'multiqc')
+
+
+MEM_SAMPLE_INTERVAL = 2.0 # Seconds between two measures of the memory used by the pipeline and its tools
+
+
+def process_tree_rss(root_pid=None):
+  # Resident memory in bytes of a process and all its descendants together, read from /proc
+  if root_pid is None:
+    root_pid = os.getpid()
+  page_size = os.sysconf('SC_PAGE_SIZE')
+  children = collections.defaultdict(list)
+  rss = {}
+  for name in os.listdir('/proc'):
+    if not name.isdigit():
+      continue
+    try:
+      stat  = open('/proc/%s/stat' % name,'r').read()
+      statm = open('/proc/%s/statm' % name,'r').read()
+    except OSError: # Process ended meanwhile
+      continue
+    ppid = int(stat[stat.rindex(')') + 2:].split()[1]) # Command names may hold spaces
+    children[ppid].append(int(name))
+    rss[int(name)] = int(statm.split()[1]) * page_size
+  total = 0
+  pids = [root_pid]
+  while pids:
+    pid = pids.pop()
+    total += rss.get(pid, 0)
+    pids += children[pid]
+  return(total)
+
+
+class StageClock(object):
+  '''
+  Records the wall-clock time, CPU time and peak memory of consecutive pipeline stages.
+  CPU time and memory include all external tools run by the pipeline.
+  Peak memory is the largest total resident size of the pipeline and the tools running
+  at the same time (e.g. parallel samples), sampled in a thread every MEM_SAMPLE_INTERVAL
+  seconds, as the operating system does not report peaks per stage. Without /proc, it is
+  the largest single process seen so far in the run.
+  '''
+  def __init__(self):
+    self.stages = []
+    self.last = time.time()
+    self.last_cpu = self.cpu_time()
+    self.sampled_mem = 0
+    self.stopped = threading.Event()
+    self.sampling = os.path.exists('/proc/self/stat')
+    if self.sampling:
+      threading.Thread(target=self.sample_mem, daemon=True).start()
+
+  def sample(self):
+    try:
+      self.sampled_mem = max(self.sampled_mem, process_tree_rss())
+    except (OSError, ValueError):
+      pass
+
+  def sample_mem(self):
+    while not self.stopped.is_set():
+      self.sample()
+      self.stopped.wait(MEM_SAMPLE_INTERVAL)
+
+  def stop(self):
+    # End memory sampling, e.g. before the next project of a batch starts its own clock
+    self.stopped.set()
+
+  def cpu_time(self):
+    cpu = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+      usage = resource.getrusage(who)
+      cpu += usage.ru_utime + usage.ru_stime
+    return(cpu)
+
+  def peak_mem(self):
+    # Memory sampled during the stage. ru_maxrss (in kilobytes on Linux) is a peak of the whole run,
+    # so it is only used without /proc.
+    if self.sampling:
+      self.sample() # Stages shorter than MEM_SAMPLE_INTERVAL
+      return(self.sampled_mem)
+    return(max(1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               1024 * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+  def lap(self, stage):
+    now = time.time()
+    cpu = self.cpu_time()
+    self.stages.append((stage, now - self.last, cpu - self.last_cpu, self.peak_mem()))
+    self.last = now
+    self.last_cpu = cpu
+    self.sampled_mem = 0 # Tools of the next stage only
+
+
+# Progress events for the GUI. When set (option -status), every finished stage
+# appends one JSON object per line to this file. See report_progress.
+PROGRESS_FILE = None
+
+# Stages reported once per sample, and once per run
+SAMPLE_STAGES = ('trim', 'align', 'count')
+RUN_STAGES    = ('de', 'multiqc')
+
+
+def report_progress(event, **info):
+  # Append a progress event to PROGRESS_FILE, e.g. report_progress('done', stage='align', sample='WT_1').
+  # Each event is written with a single append so that parallel workers can share the file.
+  if PROGRESS_FILE is None:
+    return
+  info['event'] = event
+  info['time']  = time.time()
+  line = json.dumps(info) + '\n'
+  fd = os.open(PROGRESS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  os.write(fd, line.encode())
+  os.close(fd)
+
+
+def partial_outputs(progress_file):
+  # Outputs of the stages that were started but not finished according to a progress file,
+  # e.g. to remove them after a run has been cancelled
+  started = {}
+  done = set()
+  for line in open(progress_file,'r'):
+    try:
+      event = json.loads(line)
+    except ValueError: # Last line may have been cut short
+      continue
+    key = (event.get('stage'), event.get('sample'))
+    if event['event'] == 'started':
+      started.setdefault(key, []).extend(event['outputs'])
+    elif event['event'] == 'done':
+      done.add(key)
+  outputs = []
+  for key in started:
+    if key not in done:
+      outputs += started[key]
+  return(outputs)
+
 
 def exists_skip(filename):
   if os.path.exists(filename):
@@ -47,12 +228,115 @@ def append_to_file_name(file_name,extension):
   return(new_file_name)
 
 
-def rm_low_mapq(in_file,out_file_name,mapq):
-  cmdArgs=['samtools', 'view', '-bq',
-          str(mapq), in_file]
-  out_file = open(out_file_name,'wb')
-  util.call(cmdArgs,stdout=out_file)
-  out_file.close()
+def postprocess_outputs(out_bam, index=True, counted=True):
+  # Files written by postprocess_bam
+  outputs = [out_bam, out_bam + '_flagstat.txt']
+  if index:
+    outputs.append(out_bam + '.bai')
+  if counted:
+    outputs.append(out_bam + '_count_table.txt')
+  return(outputs)
+
+
+def postprocess_commands(in_file, out_bam, mapq=20, genome_gtf=None, stranded='no', index=True, num_cpu=1):
+  # Reader of an alignment file and the commands sharing its output in postprocess_bam, each with
+  # the file its standard output goes to. The commands read the alignments from '-'.
+  reader = ['samtools','view','-h']
+  if mapq > 0:
+    reader += ['-q',str(mapq)]
+  reader.append(in_file)
+  consumers = [(['samtools','flagstat','-'], out_bam + '_flagstat.txt')]
+  if genome_gtf is not None:
+    # Mates are next to each other in HISAT2 output, and paired by position for sorted files
+    order = '--order=pos' if index else '--order=name'
+    consumers.append((['htseq-count','--format=sam',order,'--stranded=' + stranded,'-',genome_gtf],
+                      out_bam + '_count_table.txt'))
+  writer = ['samtools','view','-b','-@',str(num_cpu)]
+  if index: # Needs alignments sorted by position
+    writer += ['--write-index','-o','%s##idx##%s.bai' % (out_bam, out_bam)]
+  else:
+    writer += ['-o',out_bam]
+  consumers.append((writer + ['-'], None))
+  return(reader, consumers)
+
+
+def postprocess_command_line(in_file, out_bam, mapq=20, genome_gtf=None, stranded='no', index=True, num_cpu=1):
+  # postprocess_bam as it would be typed in bash, for the log and reports
+  reader, consumers = postprocess_commands(in_file, out_bam, mapq=mapq, genome_gtf=genome_gtf, stranded=stranded,
+                                           index=index, num_cpu=num_cpu)
+  line = command_line(reader) + ' | tee'
+  for cmdArgs, out_name in consumers[:-1]:
+    line += ' >(%s)' % command_line(cmdArgs, stdout=out_name)
+  return(line + ' | ' + command_line(consumers[-1][0]))
+
+
+def postprocess_bam(in_file, out_bam, mapq=20, genome_gtf=None, stranded='no', index=True, num_cpu=1):
+  # Read an aligned SAM/BAM file once to write out_bam without the reads below mapq, indexed while it
+  # is written if sorted by position (index), while samtools flagstat and, given genome_gtf, htseq-count
+  # read the same reads through named pipes. Replaces the separate passes filtering, sorting for
+  # htseq-count, counting and indexing each BAM file.
+  reader, consumers = postprocess_commands(in_file, out_bam, mapq=mapq, genome_gtf=genome_gtf, stranded=stranded,
+                                           index=index, num_cpu=num_cpu)
+  util.info('Running %s' % postprocess_command_line(in_file, out_bam, mapq=mapq, genome_gtf=genome_gtf,
+                                                    stranded=stranded, index=index, num_cpu=num_cpu))
+  fifo_dir = tempfile.mkdtemp(prefix=os.path.basename(out_bam) + '_post_', dir=os.path.dirname(os.path.abspath(out_bam)))
+  fifos = []
+  for i in range(len(consumers) - 1):
+    fifos.append('%s/%d.sam' % (fifo_dir, i))
+    os.mkfifo(fifos[-1])
+
+  view = subprocess.Popen(reader, stdout=subprocess.PIPE)
+  tee  = subprocess.Popen(['tee'] + fifos, stdin=view.stdout, stdout=subprocess.PIPE)
+  view.stdout.close()
+  procs = [view, tee]
+  out_objs = []
+  for (cmdArgs, out_name), source in zip(consumers, fifos + ['-']):
+    out_obj = None
+    if out_name is not None:
+      out_obj = open(out_name,'wb')
+      out_objs.append(out_obj)
+    stdin = tee.stdout if source == '-' else None
+    procs.append(subprocess.Popen([source if x == '-' else x for x in cmdArgs], stdin=stdin, stdout=out_obj))
+  tee.stdout.close()
+
+  # A failing command would leave tee waiting for it to open or read its named pipe
+  while None in [x.poll() for x in procs]:
+    if [x for x in procs if x.poll() not in (None, 0)]:
+      for x in procs:
+        if x.poll() is None:
+          x.terminate()
+    time.sleep(1)
+  for out_obj in out_objs:
+    out_obj.close()
+  shutil.rmtree(fifo_dir)
+  if [x.returncode for x in procs] != [0] * len(procs):
+    remove_outputs(postprocess_outputs(out_bam, index=index, counted=genome_gtf is not None))
+    util.critical('Post-processing the alignments of %s failed...' % in_file)
+  return(out_bam)
+
+
+def postprocess_bam_parallel(sam_list, bam_list, mapq, genome_gtf, stranded, num_cpu):
+  # postprocess_bam of HISAT2 outputs (not sorted) on num_cpu cores, removing the SAM files
+  def postprocess_sam(files, mapq, genome_gtf, stranded):
+    sam, bam = files
+    postprocess_bam(sam, bam, mapq=mapq, genome_gtf=genome_gtf, stranded=stranded, index=False)
+    os.remove(sam)
+  common_args = [mapq, genome_gtf, stranded]
+  util.parallel_split_job(postprocess_sam, list(zip(sam_list, bam_list)), common_args, num_cpu)
+
+
+def postprocessed_counts(bam_files, samples):
+  # Count tables written by postprocess_bam, None for BAM files aligned without counting reads
+  # (e.g. by an earlier version or for Cufflinks) that are counted separately
+  rc_file_list = []
+  for bam, sample in zip(bam_files, samples):
+    rc_file = '%s_count_table.txt' % bam
+    if exists_skip(rc_file):
+      rc_file_list.append(None)
+    else:
+      rc_file_list.append(rc_file)
+      report_progress('done', stage='count', sample=sample)
+  return(rc_file_list)
 
 
 def new_dir(new_dir):
@@ -63,36 +347,82 @@ def new_dir(new_dir):
   return(new_dir)
 
 
-def report_cuff_version(CUFF_PROG):
-  cufflinks_vs_obj = open('cufflinks_version_control.txt','a')
-  #util.call(CUFF_PROG,stderr=cufflinks_vs_obj)
-  cufflinks_vs_obj.close()
-  cufflinks_vs_obj = open('cufflinks_version_control.txt','r')
-  cufflinks_vs = cufflinks_vs_obj.readline()
-  cufflinks_vs_obj.close()
-  #util.LOG_FILE_OBJ.write(cufflinks_vs)
-  os.remove('cufflinks_version_control.txt')
-
-
-def rm_lines(f_in,f_out,string = '> Processing Locus'):
-  f_in_obj  = open(f_in,'r')
-  f_out_obj = open(f_out,'a')
+def required_tools(aligner, analysis_type, skipfastqc=False, cuffnorm=False, multiqc=True, stage='all', stream=False):
+  # External tools called by a run of the pipeline (or of one of its cluster stages)
+  tools = []
+  if stage in ('all', 'index', 'samples'):
+    tools.append(aligner)
+  if stage in ('all', 'samples'):
+    tools.append('cutadapt')
+    if not stream:
+      tools.append('trim_galore')
+    if not skipfastqc:
+      tools.append('fastqc')
+    if aligner != SALMON:
+      tools.append('samtools')
+  if stage in ('all', 'de'):
+    if analysis_type == 'Cufflinks':
+      tools += ['samtools', 'cufflinks', 'cuffmerge', 'cuffquant', 'cuffdiff']
+      if cuffnorm:
+        tools.append('cuffnorm')
+    tools.append('Rscript')
+    if multiqc:
+      tools.append('multiqc')
+  return(sorted(set(tools)))
+
+
+def log_tool_versions(tools):
+  # Probe the versions of all tools at once (see pragui_versions.py) and write them to the log
+  versions = pragui_versions.probe_versions(tools)
+  if util.LOG_FILE_OBJ is not None:
+    for tool in tools:
+      util.LOG_FILE_OBJ.write('%s: %s\n' % (tool, versions[tool]))
+    import HTSeq # Only for its version, slow to import
+    util.LOG_FILE_OBJ.write('HTSeq: %s\n' % HTSeq.__version__)
+  missing = [x for x in tools if versions[x] == 'not found']
+  if len(missing) > 0:
+    util.warn('Could not find %s in PATH...' % ', '.join(missing))
+  return(versions)
+
+
+def call_filtered(cmdArgs, check=True, string='> Processing Locus', n_context=50):
+  # Run a Cufflinks tool, appending its stderr to the log as it is written.
+  # Progress lines containing string are dropped, except the last one before any
+  # other line. The last n_context lines are kept to report why the tool failed.
+  context = collections.deque(maxlen=n_context)
+  util.logging(command_line(cmdArgs)) # As util.call does for the other tools
+  if util.LOG_FILE_OBJ is not None:
+    util.LOG_FILE_OBJ.flush()
+  log_obj = open(util.LOG_FILE_PATH,'a')
+  proc = subprocess.Popen(cmdArgs, stderr=subprocess.PIPE, universal_newlines=True, errors='replace')
   line0 = None
-  for line in f_in_obj:
+  for line in proc.stderr:
     if not string in line:
       if line0 is not None:
-        f_out_obj.write(line0)
+        log_obj.write(line0)
+        context.append(line0)
         line0 = None
-      f_out_obj.write(line)
+      log_obj.write(line)
+      context.append(line)
+      log_obj.flush()
     else:
       line0 = line
-  f_in_obj.close()
-  f_out_obj.flush()
-  os.remove(f_in)
+  proc.stderr.close()
+  log_obj.close()
+  err = proc.wait()
+  if err != 0:
+    if line0 is not None: # Locus being processed when the tool failed
+      context.append(line0)
+    msg = '%s exited with code %d. Last lines of its output:\n%s' % (cmdArgs[0], err, ''.join(context))
+    if check:
+      util.critical(msg)
+    util.warn(msg)
+  return(err)
 
 
 def parse_csv(samples_csv):
   # Parse input comma separated file
+  import numpy as np
   csvfile = open(samples_csv,'r')                  # Get header from csv file and build new header for
   header = csvfile.readline()                      # input table needed for analysis in R.
   csvfile.close()
@@ -101,18 +431,83 @@ def parse_csv(samples_csv):
   header = ['samplename','filename'] + header[3:]
   header = np.array(header)
 
+  from readCsvFile import readCsvFile # Imports numpy
   csv = readCsvFile(filename=samples_csv,separator='\t',header=True) # returns numpy array
 
   return(header,csv)
 
 
-def trim_bam(samples_csv, csv, trim_galore=None, skipfastqc=False, fastqc_args=None, is_single_end=False, pair_tags=['r_1','r_2']):
+class FifoTrimmer(object):
+  '''
+  Trims reads with cutadapt into named pipes read directly by the aligner (option -stream),
+  instead of writing gzipped trimmed FASTQ files with trim_galore that are read back.
+  The trimming of a sample starts with its alignment, and uses the default options of
+  trim_galore (quality 20, Illumina adapter, stringency 1, minimum length 20).
+  Paired-end reads are trimmed in one process, which writes mates to the two pipes in turn
+  rather than in chunks of many reads as cutadapt -j does. An aligner reading both pipes in
+  lockstep (e.g. HISAT2) could otherwise wait on an empty R2 pipe while cutadapt waits on a
+  full R1 pipe. This has not been checked with every aligner, and such a hang is not detected.
+  '''
+  def __init__(self, num_cpu=1):
+    self.num_cpu = num_cpu
+    self.jobs    = {} # First named pipe of a sample: (sample, FASTQ files, named pipes, report file)
+    self.trimmed = set()
+
+  def add(self, sample, fastq_files, fifos, report):
+    self.jobs[fifos[0]] = (sample, fastq_files, fifos, report)
+
+  def command(self, fastq_files, fifos):
+    n_cores = self.num_cpu if len(fifos) == 1 else 1
+    cmdArgs = ['cutadapt', '-j', str(n_cores),
+               '-q', '20', '-O', '1', '-e', '0.1', '-m', '20',
+               '-a', TRIM_ADAPTER]
+    if len(fifos) == 2:
+      cmdArgs += ['-A', TRIM_ADAPTER, '-o', fifos[0], '-p', fifos[1]]
+    else:
+      cmdArgs += ['-o', fifos[0]]
+    return(cmdArgs + fastq_files)
+
+  def run(self, cmdArgs, fifo):
+    # Run an aligner reading from the named pipes of a sample while they are being filled
+    sample, fastq_files, fifos, report = self.jobs[fifo]
+    for f in fifos:
+      if os.path.exists(f):
+        os.remove(f)
+      os.mkfifo(f)
+    report_progress('started', stage='trim', sample=sample, outputs=[report])
+    report_obj = open(report,'w')
+    trim_proc  = subprocess.Popen(self.command(fastq_files, fifos), stdout=report_obj)
+    align_proc = subprocess.Popen(cmdArgs)
+    # A failing trimmer would leave the aligner waiting for reads, and a failing
+    # aligner would leave the trimmer waiting for a reader
+    while align_proc.poll() is None:
+      if trim_proc.poll() not in (None, 0):
+        align_proc.terminate()
+      time.sleep(1)
+    if align_proc.returncode != 0 and trim_proc.poll() is None:
+      trim_proc.terminate()
+    trim_proc.wait()
+    report_obj.close()
+    for f in fifos:
+      os.remove(f)
+    if trim_proc.returncode != 0:
+      util.critical('Trimming reads from %s failed. See %s...' % (', '.join(fastq_files), report))
+    if align_proc.returncode != 0:
+      util.critical('%s failed with exit code %d...' % (cmdArgs[0], align_proc.returncode))
+    self.trimmed.add(sample)
+    report_progress('done', stage='trim', sample=sample)
+
+  def finish(self):
+    # Samples already aligned did not need trimming
+    for sample, fastq_files, fifos, report in self.jobs.values():
+      if sample not in self.trimmed:
+        report_progress('done', stage='trim', sample=sample)
+
+
+def trim_galore_command(trim_galore=None, skipfastqc=False, fastqc_args=None, is_single_end=False):
+  # trim_galore command shared by all samples, and the folder it writes to
   cmdArgs = ['trim_galore','--gzip']
 
-  fastq_paths2 = []
-  trimmed_fq = []
-  fastq_dirs = []
-
   if trim_galore is not None:
     trim_galore = trim_galore.split(' ')
     cmdArgs += trim_galore
@@ -126,76 +521,119 @@ def trim_bam(samples_csv, csv, trim_galore=None, skipfastqc=False, fastqc_args=N
     ind = cmdArgs.index('--output_dir') + 1
     od  = cmdArgs[ind]
   else:
-    cmdArgs.append('-o')
-    if exists_skip('./trim_galore'):
-      os.makedirs('./trim_galore',exist_ok = True)
-    od = './trim_galore'
-    cmdArgs.append(od)
+    od = TRIM_DIR
+    cmdArgs += ['-o', od]
 
   if skipfastqc is False:
     cmdArgs += ['-fastqc']
     if fastqc_args is not None:
       cmdArgs += ['-fastqc_args',fastqc_args]
+
+  if not is_single_end:
+    cmdArgs.append('--paired')
+
+  return(cmdArgs, od)
+
+
+def trimmed_file_name(fastq_file, od, is_single_end=False, pair_tags=['r_1','r_2'], stream=False):
+  # Trimmed FASTQ file written by trim_galore in od for an input FASTQ file (a named pipe with -stream)
+  f = os.path.basename(fastq_file)
+  f = f.replace('.gz', '').replace('.fastq', '').replace('.fq','')
+  if is_single_end:
+    trimmed_filename = od + '/' + f +'_trimmed.fq.gz'
+  elif pair_tags[0] in f:
+    trimmed_filename = od + '/' + f + '_val_1.fq.gz'
+  elif pair_tags[1] in f:
+    trimmed_filename = od + '/' + f + '_val_2.fq.gz'
   else:
+    util.critical('Paired read tag not found... Exiting...')
+  if stream:
+    trimmed_filename = trimmed_filename[:-len('.gz')]
+  return(trimmed_filename)
+
+
+def trim_bam(samples_csv, csv, trim_galore=None, skipfastqc=False, fastqc_args=None, is_single_end=False, pair_tags=['r_1','r_2'],
+             trimmer=None):
+  fastq_paths2 = []
+  trimmed_fq = []
+  fastq_dirs = []
+
+  cmdArgs, od = trim_galore_command(trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args,
+                                    is_single_end=is_single_end)
+  if od == TRIM_DIR and exists_skip(od):
+    os.makedirs(od,exist_ok = True)
+
+  if skipfastqc is True:
     util.info('Skipping fastqc step...')
 
   if is_single_end:
     util.info('User specified input data to be single-end... Running single-end mode...')
     fastq_paths = list(csv[:,1])
+    fastq_samples = list(range(len(fastq_paths)))
 
-    for f in fastq_paths:
+    for f, sample in zip(fastq_paths, fastq_samples):
       f0 = os.path.expanduser(f)
       d = os.path.dirname(f0)
-      f = os.path.basename(f)
-      f = f.replace('.gz', '').replace('.fastq', '').replace('.fq','')        
-
-      #if 'fq.gz' in f:
-      #  f=f.split(".")
-      #  f = f[:-2]
-      #  f = '.'.join(f)
-      trimmed_filename = od + '/' + f +'_trimmed.fq.gz'
-      if exists_skip(trimmed_filename):
-        fastq_paths2.append(f0)
+      trimmed_filename = trimmed_file_name(f, od, is_single_end=True, stream=trimmer is not None)
+      if trimmer is not None: # Named pipe
+        fastq_paths2.append((sample, f0, trimmed_filename))
+      elif exists_skip(trimmed_filename):
+        fastq_paths2.append((sample, f0, trimmed_filename))
       trimmed_fq.append(trimmed_filename)
       fastq_dirs.append(d)
 
   else:
     util.info('User specified input data to be paired-end... Running paired-end mode with tags %s and %s...' % (pair_tags[0],pair_tags[1]))
-    cmdArgs.append('--paired')
 
     fastq_paths = []
+    fastq_samples = []
     R = csv.shape[0]
 
     for i in range(R):
       for j in [1,2]:
         fastq_paths.append(csv[i,j])
+        fastq_samples.append(i)
 
-    for f in fastq_paths:
+    for f, sample in zip(fastq_paths, fastq_samples):
       f0 = os.path.expanduser(f)
-      f = os.path.basename(f)
-      f = f.replace('.gz', '').replace('.fastq', '').replace('.fq','')
-      if pair_tags[0] in f:
-        trimmed_filename = od + '/' + f + '_val_1.fq.gz'
+      trimmed_filename = trimmed_file_name(f, od, pair_tags=pair_tags, stream=trimmer is not None)
+      if '_val_1.fq' in trimmed_filename:
         d = os.path.dirname(f0)             # directory where fastq file is stored
-      elif pair_tags[1] in f:
-        trimmed_filename = od + '/' + f + '_val_2.fq.gz'
-      else:
-        util.critical('Paired read tag not found... Exiting...')
 
-      if exists_skip(trimmed_filename):
-        fastq_paths2.append(f0)
+      if trimmer is not None: # Named pipe
+        fastq_paths2.append((sample, f0, trimmed_filename))
+      elif exists_skip(trimmed_filename):
+        fastq_paths2.append((sample, f0, trimmed_filename))
       trimmed_fq.append(trimmed_filename)
       fastq_dirs.append(d)
 
-  # Run Trim_galore followed by fastqc
-  if fastq_paths2 != []:
-
-    if skipfastqc is False:
-      util.call(['fastqc','-v'],stdout=util.LOG_FILE_OBJ)
-
-    cmdArgs += fastq_paths2
-
-    util.call(cmdArgs)
+  # Run Trim_galore followed by fastqc, one sample at a time so that progress can be reported
+  sample_fastq = {}
+  sample_trimmed = {}
+  for sample, f0, trimmed_filename in fastq_paths2:
+    sample_fastq.setdefault(sample, []).append(f0)
+    sample_trimmed.setdefault(sample, []).append(trimmed_filename)
+
+  if trimmer is not None:
+    # Reads are trimmed while they are aligned, fastqc runs on the input files instead
+    for i in range(csv.shape[0]):
+      report = '%s/%s_cutadapt_report.txt' % (od, os.path.basename(sample_trimmed[i][0]))
+      trimmer.add(csv[i,0], sample_fastq[i], sample_trimmed[i], report)
+      if skipfastqc is False:
+        fastqc_reports = [od + '/' + os.path.basename(x).replace('.gz', '').replace('.fastq', '').replace('.fq','') + '_fastqc.html'
+                          for x in sample_fastq[i]]
+        if exists_skip(fastqc_reports[-1]):
+          fastqcArgs = ['fastqc', '-o', od]
+          if fastqc_args is not None:
+            fastqcArgs += fastqc_args.split(' ')
+          util.call(fastqcArgs + sample_fastq[i])
+    return(trimmed_fq, fastq_dirs)
+
+  for i in range(csv.shape[0]):
+    if i in sample_fastq:
+      report_progress('started', stage='trim', sample=csv[i,0], outputs=sample_trimmed[i])
+      util.call(cmdArgs + sample_fastq[i])
+    report_progress('done', stage='trim', sample=csv[i,0])
 
   return(trimmed_fq, fastq_dirs)
 
@@ -210,101 +648,262 @@ def split_pe_files(fq_list,pair_tags=['r_1','r_2']):
   return([fq_r1, fq_r2])
 
 
-def sam_to_bam_parallel(sam_list,bam_list,mapq,num_cpu):
-  def merge(list1, list2):
-    merged_list = [(list1[i], list2[i]) for i in range(0, len(list1))] 
-    return(merged_list)
-  files_list  = merge(sam_list,bam_list)
-  def sam_to_bam(files,mapq):
-    sam,bam = files
-    cmdArgs = ['samtools','view', '-b']
-    if mapq > 0 :
-      cmdArgs += ['-q',str(mapq)]
-    cmdArgs += [sam,'-o',bam]
-    util.call(cmdArgs)
-    os.remove(sam)
-  common_args = [mapq]
-  util.parallel_split_job(sam_to_bam,files_list,common_args, num_cpu)
+def available_memory():
+  # Memory in bytes that can be used without swapping: available memory of the node,
+  # capped by the limit of the cgroup (e.g. cluster job or container) if there is one
+  mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  if os.path.exists('/proc/meminfo'):
+    for line in open('/proc/meminfo','r'):
+      if line.startswith('MemAvailable:'):
+        mem = int(line.split()[1]) * 1024
+  for limit_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+    if os.path.exists(limit_file):
+      limit = open(limit_file,'r').read().strip()
+      if limit.isdigit():
+        mem = min(mem, int(limit))
+  return(mem)
+
+
+def fasta_stats(fasta_file, block_size=1024**2):
+  # Approximate genome length (bases) and number of sequences of a FASTA file
+  n_seqs = 0
+  size = os.path.getsize(fasta_file)
+  file_obj = open(fasta_file,'rb')
+  block = file_obj.read(block_size)
+  while block:
+    n_seqs += block.count(b'>')
+    block = file_obj.read(block_size)
+  file_obj.close()
+  return(size, max(n_seqs, 1))
+
+
+def star_memory(genome_len, sa_sparse, sa_index_bases):
+  # Rough size in bytes of a STAR index: genome, suffix array and pre-indexed suffixes
+  return(int(genome_len + 8.0 * genome_len / sa_sparse + 6 * 4**sa_index_bases))
+
+
+def star_index_args(fasta_file, index_args=None, mem=None):
+  # STAR genomeGenerate options fitting the genome size and the available memory,
+  # for those not set by the user in index_args
+  if index_args is None:
+    index_args = ''
+  if mem is None:
+    mem = available_memory()
+  budget = int(mem * STAR_MEM_FRACTION)
+  genome_len, n_seqs = fasta_stats(fasta_file)
+  args = []
+
+  # Small genomes crash STAR with the default of 14
+  sa_index_bases = int(max(4, min(14, math.log2(genome_len) / 2 - 1)))
+  if '--genomeSAindexNbases' not in index_args:
+    args += ['--genomeSAindexNbases', str(sa_index_bases)]
+  if '--genomeChrBinNbits' not in index_args: # Keeps memory down for assemblies with many scaffolds
+    args += ['--genomeChrBinNbits', str(int(min(18, math.log2(max(genome_len / n_seqs, 100)))))]
+
+  if '--genomeSAsparseD' not in index_args:
+    # Densest suffix array (fastest alignment) that fits in memory
+    sa_sparse = 1
+    while star_memory(genome_len, sa_sparse, sa_index_bases) > budget and sa_sparse < 16:
+      sa_sparse += 1
+    need = star_memory(genome_len, sa_sparse, sa_index_bases)
+    if need > budget:
+      util.warn('The STAR index of %s needs about %.1f GB of memory but only %.1f GB are available...' %
+                (fasta_file, need / 1024.0**3, mem / 1024.0**3))
+    if sa_sparse > 1:
+      util.info('Building a sparse STAR index (--genomeSAsparseD %d) needing about %.1f GB of memory instead of %.1f GB. '
+                'Alignment will be slower, roughly %d times for the suffix array search...' %
+                (sa_sparse, need / 1024.0**3, star_memory(genome_len, 1, sa_index_bases) / 1024.0**3, sa_sparse))
+    else:
+      util.info('Building a full STAR index needing about %.1f GB of memory (%.1f GB available)...' %
+                (need / 1024.0**3, mem / 1024.0**3))
+    args += ['--genomeSAsparseD', str(sa_sparse)]
+
+  if '--limitGenomeGenerateRAM' not in index_args:
+    args += ['--limitGenomeGenerateRAM', str(max(budget, 1024**3))]
+  return(args)
+
+
+def star_align_args(index_dir, al_args=None, mem=None, shared_genome=False):
+  # Memory limit for sorting BAM files with STAR: what remains of the available
+  # memory once the index is loaded, unless set by the user in al_args.
+  # An index already in shared memory (shared_genome) is not available memory any more.
+  if al_args is not None and '--limitBAMsortRAM' in al_args:
+    return([])
+  if mem is None:
+    mem = available_memory()
+  index_size = 0
+  if not shared_genome:
+    index_size = sum([os.path.getsize(os.path.join(index_dir, x))
+                      for x in ['Genome', 'SA', 'SAindex'] if os.path.exists(os.path.join(index_dir, x))])
+  sort_mem = int(mem * STAR_MEM_FRACTION) - index_size
+  if sort_mem < STAR_MIN_SORT_RAM:
+    util.warn('Only %.1f GB of memory are available for a STAR index of %.1f GB, alignment may fail...' %
+              (mem / 1024.0**3, index_size / 1024.0**3))
+    sort_mem = STAR_MIN_SORT_RAM
+  util.info('STAR will sort alignments using up to %.1f GB of memory...' % (sort_mem / 1024.0**3))
+  return(['--limitBAMsortRAM', str(sort_mem)])
+
+
+def index_command(aligner, fasta_file, index_dir, index_args=None, num_cpu=util.MAX_CORES):
+  # Command building the index of an aligner in index_dir, and the index prefix (HISAT2 only)
+  index_head = None
+  if index_args is not None:
+    index_args = index_args.split(' ')
+  # Index for Salmon
+  if aligner == SALMON:
+    cmdArgs = [SALMON,
+               'index','-p', str(num_cpu)]
+    if index_args is None:
+      cmdArgs += ['-k', '15']
+    else:
+      cmdArgs += index_args
+    if '-k' not in cmdArgs:
+      cmdArgs += ['-k', '15']
+    cmdArgs += ['-t', fasta_file,
+               '-i', index_dir]
+  # Index for HISAT2
+  if aligner == ALIGNER_HISAT2:
+    fasta_file_name = os.path.basename(fasta_file)
+    index_head = fasta_file_name.rstrip('.gz')
+    index_head = index_head.split('.')
+    index_head = index_head[:-1]
+    index_head = '.'.join(index_head)
+    index_head = "%s/%s" % (index_dir,index_head)
+    cmdArgs = ['hisat2-build',
+               '-p',str(num_cpu),
+               fasta_file,
+               index_head]
+  # Index for STAR
+  if aligner == ALIGNER_STAR:
+    cmdArgs = [ALIGNER_STAR,
+               '--runMode','genomeGenerate',
+               '--genomeDir',index_dir ,
+               '--genomeFastaFiles', fasta_file ,
+               '--runThreadN',str(num_cpu)]
+    if index_args is not None:
+      cmdArgs += index_args
+    cmdArgs += star_index_args(fasta_file, ' '.join(cmdArgs))
+  return(cmdArgs, index_head)
 
 
-def align(trimmed_fq, fastq_dirs, aligner, fasta_file , al_index =None, al_args=None, 
-          index_args = None, num_cpu=util.MAX_CORES,
-          is_single_end = False, mapq=20, pair_tags=['r_1','r_2']):
-    
-  def check_indices(aligner,al_index,index_args):
-    cmdArgs = []
-    index_head = None
-  # Check whether indices are present. If not, create them.  
-    if al_index is None:
-      al_index   = "%s/%s_index" % (os.path.dirname(fasta_file),aligner)    
-      msg = 'Folder where %s indices are located hasn\'t been specified. Program will default to %s...' % (aligner,al_index)
-      util.warn(msg)
-    if not os.path.exists(al_index):
-      util.info('%s indices not found. Generating indices to be saved at %s...' % (aligner,al_index) )
-      os.mkdir(al_index)
-    # Index for Salmon
-    if aligner == SALMON:
-      check = al_index + '/ref_indexing.log'
-      if not os.path.exists(check):
-        cmdArgs = [SALMON,
-                   'index','-p', str(num_cpu)]
-        if index_args is None:
-          cmdArgs += ['-k', '15']
-        else:
-          index_args = index_args.split(' ')
-          cmdArgs += index_args
-        if '-k' not in cmdArgs:
-          cmdArgs += ['-k', '15']
-        cmdArgs += ['-t', fasta_file,
-                   '-i', al_index]
-    # Index for HISAT2  
-    if aligner == ALIGNER_HISAT2:
-      # dir = os.path.dirname(al_index)
-      if not os.path.exists(al_index):
-        os.mkdir(al_index)
-      flag = 0
-      for file in os.listdir(al_index):
-        if 'ht2' in file:
-          index_head = file
-          flag +=1
-      if flag == 0:
-        fasta_file_name = os.path.basename(fasta_file)
-        index_head = fasta_file_name.rstrip('.gz')
-        index_head = index_head.split('.')
-        index_head = index_head[:-1]
-        index_head = '.'.join(index_head)
-        index_head = "%s/%s" % (al_index,index_head)  
-        cmdArgs = ['hisat2-build',
-                   '-p',str(num_cpu),
-                   fasta_file,
-                   index_head]
-      else:
-        index_head = index_head.split('.')
-        index_head = index_head[:-2]
-        index_head = '.'.join(index_head)
-        index_head = "%s/%s" % (al_index,index_head)
-    # Index for STAR
-    if aligner == ALIGNER_STAR:
-      check = al_index + '/genomeParameters.txt'
-      if not os.path.exists(check):
-        cmdArgs = [ALIGNER_STAR,
-                   '--runMode','genomeGenerate',
-                   '--genomeDir',al_index ,
-                   '--genomeFastaFiles', fasta_file ,
-                   '--runThreadN',str(num_cpu)]
-        if index_args is not None:
-          index_args = index_args.split(' ')
-          cmdArgs += index_args
-    if cmdArgs != []:
-      util.call(cmdArgs)  
-    return([al_index,index_head])
-    
-  al_index, index_head = check_indices(aligner=aligner,al_index=al_index, index_args=index_args) 
-    
+def index_complete(aligner, index_dir):
+  # Whether index_dir holds a complete index. Indexes built by PRAGUI have a marker file
+  # written at the end of the build, others are recognised by the files of each aligner.
+  if not os.path.isdir(index_dir):
+    return(False)
+  if os.path.exists(os.path.join(index_dir, INDEX_MARKER)):
+    return(True)
+  if aligner == SALMON:
+    return(os.path.exists(index_dir + '/ref_indexing.log'))
+  if aligner == ALIGNER_HISAT2:
+    return(len(glob.glob(index_dir + '/*.ht2*')) > 0)
+  if aligner == ALIGNER_STAR:
+    return(os.path.exists(index_dir + '/genomeParameters.txt'))
+  return(False)
+
+
+def index_head_of(aligner, index_dir):
+  # Prefix of the HISAT2 index files in index_dir, e.g. index_dir/genome for genome.1.ht2
+  if aligner != ALIGNER_HISAT2:
+    return(None)
+  index_head = sorted(glob.glob(index_dir + '/*.ht2*'))[0]
+  index_head = os.path.basename(index_head).split('.')
+  index_head = '.'.join(index_head[:-2])
+  return("%s/%s" % (index_dir,index_head))
+
+
+def index_key(aligner, fasta_file, index_args=None):
+  # Key of an index in the store: content of the FASTA file and of any file given in
+  # index_args (e.g. a GTF file for STAR splice junctions), aligner version and index_args
+  args = []
+  files = {'fasta': pragui_cache.file_hash(fasta_file)}
+  if index_args is not None:
+    for x in index_args.split(' '):
+      if os.path.isfile(os.path.expanduser(x)):
+        files[x] = pragui_cache.file_hash(x)
+        x = os.path.basename(x)
+      args.append(x)
+  key = {'aligner' : aligner,
+         'version' : pragui_versions.tool_version(aligner),
+         'args'    : args,
+         'files'   : sorted(files.values())}
+  digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+  return(digest[:16], key)
+
+
+def build_index(aligner, fasta_file, index_dir, index_args=None, num_cpu=util.MAX_CORES, key=None):
+  # Build an index in index_dir unless another run already did. The build is locked so that
+  # concurrent runs wait for a single build, and written to a temporary folder renamed
+  # at the end, so that a killed build never leaves a half-built index in index_dir.
+  index_dir = index_dir.rstrip('/')
+  def wait_msg():
+    util.info('Waiting for another run to build the %s index in %s...' % (aligner, index_dir))
+  with pragui_cache.file_lock(index_dir, on_wait=wait_msg):
+    if index_complete(aligner, index_dir):
+      return(index_head_of(aligner, index_dir))
+    for old_dir in glob.glob(index_dir + '.building.*'):
+      util.warn('Discarding half-built index %s...' % old_dir)
+      shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(index_dir):
+      if len(os.listdir(index_dir)) > 0:
+        util.critical('Folder %s does not contain a complete %s index. Please remove it or choose another folder with "-al_index"...' % (index_dir, aligner))
+      os.rmdir(index_dir)
+
+    util.info('%s indices not found. Generating indices to be saved at %s...' % (aligner,index_dir))
+    temp_dir = '%s.building.%d' % (index_dir, os.getpid())
+    os.makedirs(temp_dir)
+    cmdArgs, index_head = index_command(aligner, fasta_file, temp_dir, index_args, num_cpu)
+    util.call(cmdArgs)
+    marker_obj = open(os.path.join(temp_dir, INDEX_MARKER), 'w')
+    json.dump({'fasta_file': os.path.abspath(fasta_file), 'index_args': index_args, 'key': key}, marker_obj, indent=1)
+    marker_obj.close()
+    os.rename(temp_dir, index_dir)
+  return(index_head_of(aligner, index_dir))
+
+
+def index_store():
+  # Folder where aligner indexes built by PRAGUI are kept, one folder per genome, aligner version
+  # and index options. Resolved when needed, as the default creates PRAGUI_HOME.
+  if 'PRAGUI_INDEX_STORE' in os.environ:
+    return(os.path.expanduser(os.environ['PRAGUI_INDEX_STORE']))
+  return(pragui_cache.pragui_path('indexes'))
+
+
+def index_location(aligner, fasta_file, al_index=None, index_args=None):
+  # Folder of the index used for fasta_file, and its key if it is (or will be) kept in the store
+  key_info = None
+  if al_index is None:
+    # Indexes found next to the genome (default of older versions) are still used
+    legacy_index = "%s/%s_index" % (os.path.dirname(fasta_file),aligner)
+    if index_complete(aligner, legacy_index):
+      al_index = legacy_index
+    else:
+      key, key_info = index_key(aligner, fasta_file, index_args)
+      genome = os.path.basename(fasta_file).split('.')[0]
+      al_index = os.path.join(index_store(), aligner, '%s_%s' % (genome, key))
+  return(al_index, key_info)
+
+
+def check_indices(aligner, fasta_file, al_index=None, index_args=None, num_cpu=util.MAX_CORES):
+# Check whether indices are present. If not, create them.
+  if al_index is None:
+    al_index, key_info = index_location(aligner, fasta_file, index_args=index_args)
+    os.makedirs(os.path.dirname(al_index), exist_ok=True)
+    msg = 'Folder where %s indices are located hasn\'t been specified. Program will default to %s...' % (aligner,al_index)
+    util.warn(msg)
+    if not index_complete(aligner, al_index):
+      build_index(aligner, fasta_file, al_index, index_args, num_cpu, key=key_info)
+  elif not index_complete(aligner, al_index):
+    build_index(aligner, fasta_file, al_index, index_args, num_cpu)
+  index_head = index_head_of(aligner, al_index)
+  return([al_index,index_head])
+
+
+def aligner_command(aligner, al_index, index_head=None, al_args=None, num_cpu=util.MAX_CORES, stream=False,
+                    shared_genome=False):
+  # Aligner command shared by all samples, to be followed by the reads and outputs of each sample.
+  # With shared_genome, STAR uses the index loaded in shared memory by load_shared_genome.
   if aligner == SALMON:
-    util.info('Process fastq files using Salmon...')
-    salmon_v = [SALMON,'-v']
-    util.call(salmon_v, stdout=util.LOG_FILE_OBJ)
     cmdArgs = [SALMON,'quant',
                '-i', al_index,
                # '-l', 'A',
@@ -318,114 +917,24 @@ def align(trimmed_fq, fastq_dirs, aligner, fasta_file , al_index =None, al_args=
       cmdArgs += al_args
       if '-l' not in cmdArgs:
         cmdArgs += ['-l', 'A']
-
-    out_files = []
-    
-    def define_output(fq,k):
-        fo = os.path.basename(fq)
-        fo = fastq_dirs[k]+ '/' + fo
-        quant = fo + '_quant'
-        quant_out = quant + '/quant.sf'
-        return([quant,quant_out])
-     
-    k = 0        
-    if is_single_end:
-      util.info('Running single-end mode...')
-      for f in trimmed_fq:
-        quant , quant_out = define_output(f,k)
-        cmdArgs0 = cmdArgs + ['-r',f,'-o',quant]
-        if exists_skip(quant_out):
-          util.call(cmdArgs0)
-        out_files.append(quant_out)
-        k+=1
-    else:
-      util.info('Running paired-end mode...')
-      read1_list, read2_list = split_pe_files(trimmed_fq,pair_tags=pair_tags)
-      l = len(read1_list)
-      for i in range(l):
-        trimmed_fq_r1 = read1_list[i]
-        trimmed_fq_r2 = read2_list[i]
-        quant , quant_out = define_output(trimmed_fq_r1,k)
-        if exists_skip(quant_out):
-          cmdArgs0 = cmdArgs + ['-1',trimmed_fq_r1, '-2', trimmed_fq_r2,'-o',quant]
-          util.call(cmdArgs0)
-        out_files.append(quant_out)
-        k+=1
   
   if aligner == ALIGNER_HISAT2:
-    util.info('Aligning reads using HISAT2...')
-    util.call([ALIGNER_HISAT2,'--version'], stdout=util.LOG_FILE_OBJ)
     cmdArgs = [ALIGNER_HISAT2,
                '-p',str(num_cpu),
                '-x', index_head]
-    if al_args is None:
-      al_args = []
-    else:
+    if al_args is not None:
       al_args  = al_args.split()
       cmdArgs += al_args
     
-    sam_list = []
-    bam_list = []
-    sam_list0 = []
-    bam_list0 = []
-    k=0
-    if is_single_end:
-      util.info('Running single-end mode...')
-      for f in trimmed_fq:
-        fo = os.path.basename(f)
-        fo = fastq_dirs[k]+ '/' + fo
-        sam = fo + '.sam'
-        sam_list.append(sam)
-        if mapq > 0 :
-          bam = '%s.sorted_fil_%d.out.bam' % (fo,mapq)
-        else:
-          bam = '%s.sorted.out.bam' % fo
-        bam_list.append(bam)
-        if exists_skip(bam):
-          sam_list0.append(sam)
-          bam_list0.append(bam)
-          cmdArgs0 = cmdArgs + ['-U',f,'-S',sam]
-          util.call(cmdArgs0)
-        k +=1
-    else:
-      util.info('Running paired-end mode...')
-      read1_list, read2_list = split_pe_files(trimmed_fq,pair_tags=pair_tags)
-      l = len(read1_list)
-      for i in range(l):
-        trimmed_fq_r1 = read1_list[i]
-        trimmed_fq_r2 = read2_list[i]
-        fo = os.path.basename(trimmed_fq_r1)
-        fo = fastq_dirs[k] + '/' + fo
-        sam = fo + '.sam'
-        sam_list.append(sam)
-        if mapq > 0 :
-          bam = '%s.pe.sorted_fil_%d.out.bam' % (fo,mapq)
-        else:
-          bam = '%s.pe.sorted.out.bam' % fo
-        bam_list.append(bam)
-        if exists_skip(bam):
-          sam_list0.append(sam)
-          bam_list0.append(bam)
-          cmdArgs0 = cmdArgs + ['-1',trimmed_fq_r1, '-2', trimmed_fq_r2,'-S',sam]
-          util.call(cmdArgs0)
-        k +=1
-    if len(bam_list0)>0:
-      util.info('Converting sam to bam...')
-      sam_to_bam_parallel(sam_list0,bam_list0,mapq,num_cpu)
-    out_files = bam_list
-       
-    
   if aligner == ALIGNER_STAR:
-    bam_files = []
-    util.info('Aligning reads using STAR...')
-    util.call([ALIGNER_STAR,'--version'], stdout=util.LOG_FILE_OBJ)
     cmdArgs = [ALIGNER_STAR,
                '--genomeDir',al_index ,
                '--runThreadN',str(num_cpu)]
     if al_args is None:
-      cmdArgs += ['--readFilesCommand', 'zcat', '-c',
+      if not stream: # Streamed reads are not compressed
+        cmdArgs += ['--readFilesCommand', 'zcat', '-c']
     #  cmdArgs +=  ['--readFilesCommand', 'gunzip', '-c',   # option needed for mac users
-                  '--outSAMtype','BAM','SortedByCoordinate',
+      cmdArgs += ['--outSAMtype','BAM','SortedByCoordinate',
                   '--readFilesIn']
     else:
       if 'SortedByCoordinate' in al_args:
@@ -437,87 +946,173 @@ def align(trimmed_fq, fastq_dirs, aligner, fasta_file , al_index =None, al_args=
         cmdArgs += al_args
         cmdArgs += ['--outSAMtype','BAM','SortedByCoordinate',
                    '--readFilesIn']
+    cmdArgs[-1:-1] = star_align_args(al_index, al_args=' '.join(cmdArgs), shared_genome=shared_genome)
+    if shared_genome:
+      cmdArgs[-1:-1] = ['--genomeLoad','LoadAndKeep']
+
+  return(cmdArgs)
+
+
+def aligned_file_name(aligner, fq, fastq_dir, mapq=20, is_single_end=False):
+  # Output of the alignment of a sample named after its (first) trimmed FASTQ file:
+  # quant.sf for Salmon, a BAM file otherwise
+  fo = fastq_dir + '/' + os.path.basename(fq)
+  if aligner == SALMON:
+    return(fo + '_quant/quant.sf')
+  if not is_single_end:
+    fo += '.pe'
+  if mapq > 0 :
+    return('%s.sorted_fil_%d.out.bam' % (fo,mapq))
+  return('%s.sorted.out.bam' % fo)
+
+
+def aligned_outputs(csv, aligner, od, mapq=20, is_single_end=False, pair_tags=['r_1','r_2'], stream=False):
+  # Alignment output of each sample of a parsed samples file, named as by trim_bam and align
+  read_cols = [1] if is_single_end else [1,2]
+  fq_lists = []
+  fastq_dirs = []
+  for i in range(csv.shape[0]):
+    fq_lists.append([trimmed_file_name(csv[i,j], od, is_single_end=is_single_end, pair_tags=pair_tags, stream=stream)
+                     for j in read_cols])
+    fastq_dirs += [os.path.dirname(os.path.expanduser(csv[i,1]))] * len(read_cols)
+  return([aligned_file_name(aligner, fq[0], fastq_dirs[k], mapq=mapq, is_single_end=is_single_end)
+          for k, fq in enumerate(fq_lists)])
+
+
+def aligner_sample_args(aligner, fq_files, fastq_dir, out_file):
+  # Reads and outputs of a sample, added to aligner_command
+  if aligner == SALMON:
+    if len(fq_files) == 1:
+      cmdArgs = ['-r',fq_files[0]]
+    else:
+      cmdArgs = ['-1',fq_files[0], '-2', fq_files[1]]
+    return(cmdArgs + ['-o',os.path.dirname(out_file)])
+
+  if aligner == ALIGNER_HISAT2:
+    fo = fastq_dir + '/' + os.path.basename(fq_files[0])
+    if len(fq_files) == 1:
+      cmdArgs = ['-U',fq_files[0]]
+    else:
+      cmdArgs = ['-1',fq_files[0], '-2', fq_files[1]]
+    return(cmdArgs + ['-S',fo + '.sam','--summary-file',fo + '.hisat2_summary.txt'])
+
+  # STAR output is written next to the final bam file so that several
+  # alignments (e.g. cluster array tasks) can run from the same folder
+  return(list(fq_files) + ['--outFileNamePrefix', out_file + '_'])
+
+
+def align(trimmed_fq, fastq_dirs, aligner, fasta_file , al_index =None, al_args=None, 
+          index_args = None, num_cpu=util.MAX_CORES,
+          is_single_end = False, mapq=20, pair_tags=['r_1','r_2'], clock=None, samples=None, trimmer=None,
+          count_gtf=None, stranded='no', shared_genome=False):
+  # Reads of BAM files are counted with count_gtf while they are filtered (see postprocess_bam)
+
+  def sample_name(k):
+    # Name of the k-th sample for progress reports
+    if samples is None:
+      return(k)
+    return(samples[k])
+
+  def run_aligner(cmdArgs0, fq):
+    # With -stream, reads are trimmed into named pipes while the aligner reads them
+    if trimmer is None:
+      util.call(cmdArgs0)
+    else:
+      trimmer.run(cmdArgs0, fq)
     
-    k=0
-    if is_single_end:
-
-      util.info('Running single-end mode...')
-      for f in trimmed_fq:
-        fo = os.path.basename(f)
-        fo = fastq_dirs[k]+ '/' + fo
-        if mapq > 0 :
-          bam = '%s.sorted_fil_%d.out.bam' % (fo,mapq)
-        else:
-          bam = '%s.sorted.out.bam' % fo
-        bam_files.append(bam)
-        if exists_skip(bam):
-          cmdArgs_se = list(cmdArgs)
-          cmdArgs_se.append(f)
-          util.call([ALIGNER_STAR,'--version'],stdout=util.LOG_FILE_OBJ)
-          util.call(cmdArgs_se)
-          star_log = '%s_Log.final.out' % bam
-          util.logging('Printing %s' % star_log)
-          shutil.copyfileobj(open('./Log.final.out', 'r'), util.LOG_FILE_OBJ)
-          os.rename('./Log.final.out',star_log)
-          if mapq > 0 :
-            util.call(['samtools','--version'],stdout=util.LOG_FILE_OBJ)
-            rm_low_mapq('./Aligned.sortedByCoord.out.bam',bam,mapq) # Remove reads with quality below mapq
-            os.remove('./Aligned.sortedByCoord.out.bam')
-          else:
-            os.rename('./Aligned.sortedByCoord.out.bam',bam)
-        k+=1
+  al_index, index_head = check_indices(aligner=aligner, fasta_file=fasta_file, al_index=al_index,
+                                       index_args=index_args, num_cpu=num_cpu)
+
+  if clock is not None:
+    clock.lap('index')
     
-    else:
-      
-      util.info('Running paired-end mode...')
-      
-      trimmed_fq_r1, trimmed_fq_r2 = split_pe_files(trimmed_fq,pair_tags=pair_tags)
-      util.info(trimmed_fq_r1)
-      
-      for i in range(0,len(trimmed_fq_r1)):
-        fo = os.path.basename(trimmed_fq_r1[i])
-        fo = fastq_dirs[k] + '/' + fo
-        if mapq > 0 :
-          bam = '%s.pe.sorted_fil_%d.out.bam' % (fo,mapq)
-        else:
-          bam = '%s.pe.sorted.out.bam' % fo
-        
-        bam_files.append(bam)
-        
-        if exists_skip(bam):
-          cmdArgs_pe = list(cmdArgs)
-          cmdArgs_pe += [trimmed_fq_r1[i],trimmed_fq_r2[i]]
-          util.call([ALIGNER_STAR,'--version'],stdout=util.LOG_FILE_OBJ)
-          util.call(cmdArgs_pe)
-          star_log = '%s_Log.final.out' % bam
-          util.logging('Printing %s' % star_log)
-          shutil.copyfileobj(open('./Log.final.out', 'r'), util.LOG_FILE_OBJ)
-          os.rename('./Log.final.out',star_log)
-          if mapq > 0 :
-            util.call(['samtools','--version'],stdout=util.LOG_FILE_OBJ)
-            rm_low_mapq('./Aligned.sortedByCoord.out.bam',bam,mapq) # Remove reads with quality below mapq
-            os.remove('./Aligned.sortedByCoord.out.bam')
-          else:
-            os.rename('./Aligned.sortedByCoord.out.bam',bam)
-        k+=1  
-    out_files = bam_files
+  if aligner == SALMON:
+    util.info('Process fastq files using Salmon...')
+  if aligner == ALIGNER_HISAT2:
+    util.info('Aligning reads using HISAT2...')
+  if aligner == ALIGNER_STAR:
+    util.info('Aligning reads using STAR...')
+
+  cmdArgs = aligner_command(aligner, al_index, index_head=index_head, al_args=al_args, num_cpu=num_cpu,
+                            stream=trimmer is not None, shared_genome=shared_genome)
+
+  if is_single_end:
+    util.info('Running single-end mode...')
+    fq_lists = [[f] for f in trimmed_fq]
+  else:
+    util.info('Running paired-end mode...')
+    read1_list, read2_list = split_pe_files(trimmed_fq,pair_tags=pair_tags)
+    fq_lists = [[r1, r2] for r1, r2 in zip(read1_list, read2_list)]
+
+  out_files = []
+  sam_list0 = []
+  bam_list0 = []
+
+  for k, fq in enumerate(fq_lists):
+    out_file = aligned_file_name(aligner, fq[0], fastq_dirs[k], mapq=mapq, is_single_end=is_single_end)
+    out_files.append(out_file)
+
+    if exists_skip(out_file):
+      cmdArgs0 = cmdArgs + aligner_sample_args(aligner, fq, fastq_dirs[k], out_file)
+
+      if aligner == SALMON:
+        report_progress('started', stage='align', sample=sample_name(k), outputs=[os.path.dirname(out_file)])
+        run_aligner(cmdArgs0, fq[0])
+
+      if aligner == ALIGNER_HISAT2:
+        sam = cmdArgs0[cmdArgs0.index('-S') + 1]
+        sam_list0.append(sam)
+        bam_list0.append(out_file)
+        report_progress('started', stage='align', sample=sample_name(k),
+                        outputs=[sam] + postprocess_outputs(out_file, index=False, counted=count_gtf is not None))
+        run_aligner(cmdArgs0, fq[0])
+
+      if aligner == ALIGNER_STAR:
+        star_prefix = out_file + '_'
+        star_bam = star_prefix + 'Aligned.sortedByCoord.out.bam'
+        report_progress('started', stage='align', sample=sample_name(k),
+                        outputs=[star_bam, star_prefix + '_STARtmp'] +
+                                postprocess_outputs(out_file, counted=count_gtf is not None))
+        run_aligner(cmdArgs0, fq[0])
+        star_log = star_prefix + 'Log.final.out'
+        util.logging('Printing %s' % star_log)
+        shutil.copyfileobj(open(star_log, 'r'), util.LOG_FILE_OBJ)
+        # Remove reads with quality below mapq, index and count in one pass
+        postprocess_bam(star_bam, out_file, mapq=mapq, genome_gtf=count_gtf, stranded=stranded, num_cpu=num_cpu)
+        os.remove(star_bam)
+
+    report_progress('done', stage='align', sample=sample_name(k))
+    if aligner == SALMON:
+      report_progress('done', stage='count', sample=sample_name(k)) # Salmon quantifies while mapping
+
+  if len(bam_list0)>0:
+    util.info('Converting sam to bam...')
+    postprocess_bam_parallel(sam_list0,bam_list0,mapq,count_gtf,stranded,num_cpu)
+
+  if trimmer is not None:
+    trimmer.finish()
 
   return(out_files)
 
 
-def sort_bam_parallel(bam_list,num_cpu):
-  def sort_bam(bam):
+def sort_bam_parallel(bam_list,num_cpu,samples=None):
+  if samples is None:
+    samples = list(range(len(bam_list)))
+  def sort_bam(job):
+    bam, sample = job
     bam_out = os.path.dirname(bam) + '/' + os.path.basename(bam) + '_sorted.bam'
     if exists_skip(bam_out):
+      report_progress('started', stage='count', sample=sample, outputs=[bam_out])
       cmdArgs = ['samtools','sort','-n',bam]
       util.call(cmdArgs,stdout=bam_out)
     return(bam_out)
   common_args = []
-  sorted_bam_list = util.parallel_split_job(sort_bam,bam_list,common_args, num_cpu)
+  jobs = list(zip(bam_list, samples))
+  sorted_bam_list = util.parallel_split_job(sort_bam,jobs,common_args, num_cpu)
   return(sorted_bam_list)
 
 
-def read_count_htseq(bam_files,genome_gtf,stranded='no'):
+def read_count_htseq(bam_files,genome_gtf,stranded='no',samples=None):
   rc_file_list = []
   stranded = '--stranded=' + stranded
 #  if stranded:
@@ -528,32 +1123,157 @@ def read_count_htseq(bam_files,genome_gtf,stranded='no'):
     rc_file = '%s_count_table.txt' % f
     rc_file_list.append(rc_file)
     if exists_skip(rc_file):
-      htseq_version = HTSeq.__version__
-      util.info('HTSeq version %s' % htseq_version)
+      if samples is not None:
+        report_progress('started', stage='count', sample=samples[len(rc_file_list)-1], outputs=[rc_file])
       fileObj = open(rc_file,'wb')
       cmdArgs = ['htseq-count','--format=bam',stranded]
       cmdArgs += [f,genome_gtf]
       util.call(cmdArgs,stdout=fileObj)
       fileObj.close()
+    if samples is not None:
+      report_progress('done', stage='count', sample=samples[len(rc_file_list)-1])
   return(rc_file_list)
 
 
-def read_count_htseq_parallel(bam_files,genome_gtf,num_cpu, stranded='no'):
+def read_count_htseq_parallel(bam_files,genome_gtf,num_cpu, stranded='no', samples=None):
+  if samples is None:
+    samples = list(range(len(bam_files)))
+  def count_sample(job,genome_gtf,stranded):
+    bam, sample = job
+    return(read_count_htseq([bam],genome_gtf,stranded,samples=[sample]))
   common_args = [genome_gtf,stranded]
-  bam_files = [ [x] for x in bam_files ]
-  counts = util.parallel_split_job(read_count_htseq,bam_files,common_args, num_cpu)
+  jobs = list(zip(bam_files, samples))
+  counts = util.parallel_split_job(count_sample,jobs,common_args, num_cpu)
   return(counts)
 
 
-def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism, log, aligner, contrast='condition', levels=None):
+def index_sorted_bam(bam, num_cpu=1, sample=None):
+  # BAM file sorted by position and indexed, as needed to read some of its regions
+  header = subprocess.run(['samtools','view','-H',bam], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+  if 'SO:coordinate' not in header.split('\n')[0]: # e.g. HISAT2 alignments
+    sorted_bam = bam + '_pos_sorted.bam'
+    if exists_skip(sorted_bam):
+      report_progress('started', stage='count', sample=sample, outputs=[sorted_bam])
+      util.call(['samtools','sort','-@',str(num_cpu),'-o',sorted_bam,bam])
+    bam = sorted_bam
+  if exists_skip(bam + '.bai'):
+    util.call(['samtools','index',bam])
+  return(bam)
+
+
+def bam_shards(bam, n_shards):
+  # Split the contigs of an indexed BAM file into at most n_shards groups holding similar
+  # numbers of reads. Reads placed on no contig ('*') make a group of their own. A file
+  # without reads makes one group of all contigs, so that it still gets a count table.
+  out = subprocess.run(['samtools','idxstats',bam], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+  contigs = []
+  n_unplaced = 0
+  for line in out.splitlines():
+    contig, length, mapped, unmapped = line.split('\t')
+    if contig == '*':
+      n_unplaced = int(unmapped)
+    elif int(mapped) + int(unmapped) > 0:
+      contigs.append((int(mapped) + int(unmapped), contig))
+  shards = [[] for i in range(min(n_shards, max(len(contigs), 1)))]
+  sizes  = [0] * len(shards)
+  for n, contig in sorted(contigs, reverse=True): # Largest contigs first, each to the smallest shard
+    i = sizes.index(min(sizes))
+    shards[i].append(contig)
+    sizes[i] += n
+  shards = [x for x in shards if len(x) > 0]
+  if n_unplaced > 0:
+    shards.append(['*'])
+  if len(shards) == 0:
+    shards = [[]]
+  return(shards)
+
+
+def merge_count_tables(count_tables, rc_file):
+  # Sum htseq-count tables produced from the same annotation, gene counts and summary lines
+  # (__no_feature, __ambiguous...) alike, keeping the order of the lines
+  names  = None
+  counts = None
+  for table in count_tables:
+    rows = [line.rstrip('\n').split('\t') for line in open(table,'r')]
+    if names is None:
+      names  = [x[0] for x in rows]
+      counts = [0] * len(rows)
+    if [x[0] for x in rows] != names:
+      util.critical('Count tables %s and %s do not list the same genes...' % (count_tables[0], table))
+    for i, x in enumerate(rows):
+      counts[i] += int(x[1])
+  file_obj = open(rc_file,'w')
+  for name, count in zip(names, counts):
+    file_obj.write('%s\t%d\n' % (name, count))
+  file_obj.close()
+
+
+def count_shard(shard, bam, genome_gtf, stranded, shard_dir):
+  # Count the reads of some contigs of a BAM file with htseq-count. Pairs whose mates are on
+  # different contigs are left out and saved in SAM format, to be counted together later.
+  k, regions = shard
+  count_table = '%s/shard_%d_count_table.txt' % (shard_dir, k)
+  cross_sam   = '%s/shard_%d_cross.sam' % (shard_dir, k)
+  out_obj = open(count_table,'w')
+  view  = subprocess.Popen(['samtools','view','-h',bam] + regions, stdout=subprocess.PIPE)
+  split = subprocess.Popen(['awk','-v','cross=' + cross_sam, SHARD_FILTER + ' END {printf "" > cross}'],
+                           stdin=view.stdout, stdout=subprocess.PIPE)
+  count = subprocess.Popen(['htseq-count','--format=sam','--order=pos',stranded,'-',genome_gtf],
+                           stdin=split.stdout, stdout=out_obj)
+  view.stdout.close()
+  split.stdout.close()
+  err = [count.wait(), split.wait(), view.wait()]
+  out_obj.close()
+  if err != [0, 0, 0]:
+    util.critical('Counting reads of %s in %s failed...' % (bam, ', '.join(regions) if len(regions) > 0 else 'all contigs'))
+  return(count_table, cross_sam)
+
+
+def read_count_htseq_sharded(bam_files,genome_gtf,num_cpu, stranded='no', samples=None):
+  # Count the reads of each BAM file split by contigs on num_cpu cores (option -shard_count),
+  # for runs with fewer samples than cores. Gives the same table as htseq-count on the file sorted
+  # by name (read_count_htseq_parallel), as both mates of a pair are always counted in the same
+  # shard, pairs across contigs, secondary alignments and unmapped mates included (checked with
+  # HTSeq 2.1). Tables are named after the file sorted by position: <bam>_count_table.txt for STAR
+  # alignments, <bam>_pos_sorted.bam_count_table.txt otherwise, not <bam>_sorted.bam_count_table.txt.
+  if samples is None:
+    samples = list(range(len(bam_files)))
+  stranded = '--stranded=' + stranded
+  rc_file_list = []
+  for f, sample in zip(bam_files, samples):
+    f = index_sorted_bam(f, num_cpu=num_cpu, sample=sample)
+    rc_file = '%s_count_table.txt' % f
+    rc_file_list.append(rc_file)
+    if exists_skip(rc_file):
+      report_progress('started', stage='count', sample=sample, outputs=[rc_file])
+      shard_dir = tempfile.mkdtemp(prefix=os.path.basename(f) + '_shards_', dir=os.path.dirname(os.path.abspath(f)))
+      shards = bam_shards(f, num_cpu)
+      util.info('Counting reads of %s in %d shards...' % (f, len(shards)))
+      results = util.parallel_split_job(count_shard, list(enumerate(shards)), [f, genome_gtf, stranded, shard_dir], num_cpu)
+      count_tables = [x[0] for x in results]
+
+      # Pairs spanning two contigs, in the order of the shards
+      cross_sam = shard_dir + '/cross.sam'
+      cross_obj = open(cross_sam,'wb')
+      util.call(['samtools','view','-H',f], stdout=cross_obj)
+      n_cross = 0
+      for count_table, shard_sam in results:
+        n_cross += os.path.getsize(shard_sam)
+        shutil.copyfileobj(open(shard_sam,'rb'), cross_obj)
+      cross_obj.close()
+      if n_cross > 0:
+        count_table = shard_dir + '/cross_count_table.txt'
+        util.call(['htseq-count','--format=sam','--order=pos',stranded,cross_sam,genome_gtf], stdout=count_table)
+        count_tables.append(count_table)
+
+      merge_count_tables(count_tables, rc_file)
+      shutil.rmtree(shard_dir)
+    report_progress('done', stage='count', sample=sample)
+  return(rc_file_list)
 
-  if organism not in ['human', 'mouse', 'worm', 'fly', 'yeast', 'zebrafish']:
-    organism = "None"
-    util.info('No recognised organism provided...')
-  else:
-    util.info('User provided recognised organism. Using %s genes names in differential analysis output...' % organism)
 
-  # Create csv file for DESeq function DESeqDataSetFromHTSeqCount
+def deseq_file_head(rc_file_list, samples_csv, aligner):
+  # Start of the names of the files written by the DESeq analysis
   if aligner == SALMON:
     deseq_dir = rc_file_list[0].split('/')
     deseq_dir = deseq_dir[:-2]
@@ -562,6 +1282,202 @@ def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism,
     deseq_dir = os.path.dirname(rc_file_list[0]) + '/'
   deseq_head = os.path.basename(samples_csv)
   deseq_head = deseq_dir + deseq_head
+  return(deseq_head)
+
+
+def deseq_outputs(rc_file_list, samples_csv, aligner):
+  # Files written by the DESeq analysis of all samples, outdated when samples change
+  deseq_head = deseq_file_head(rc_file_list, samples_csv, aligner)
+  return([append_to_file_name(deseq_head, x) for x in
+          ['_DESeq_table.txt', '_sclust.pdf', '_tpm.txt', '_DESeq_summary.txt',
+           '_DESeq_results_4_peat.txt', '_DESeq_norm_read_counts.txt']])
+
+
+def stale_deseq_outputs(rc_file_list, samples_csv, aligner):
+  # Files of earlier DESeq analyses removed when it has to run again: deseq_outputs, and the results
+  # of every contrast, the saved fits and the gene tables of Salmon runs, whatever their names
+  deseq_head = deseq_file_head(rc_file_list, samples_csv, aligner)
+  outputs = deseq_outputs(rc_file_list, samples_csv, aligner)
+  for pattern in ['_DESeq_results_*_vs_*.txt', '_DESeq_fit_*.rds', '_salmon_*.txt']:
+    outputs += sorted(glob.glob(glob.escape(deseq_head) + pattern))
+  return(outputs)
+
+
+def deseq_fit_key(csv_deseq_name, rc_file_list, contrast):
+  # Key of a DESeq2 fit: samples table, content of the count files and design
+  key = {'table'  : open(csv_deseq_name,'r').read(),
+         'counts' : [pragui_cache.file_hash(x) for x in rc_file_list],
+         'design' : contrast}
+  return(hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16])
+
+
+def parse_contrasts(contrasts):
+  # Level pairs from a list of contrasts such as "WT:KO,WT:HET"
+  pairs = []
+  for x in contrasts.split(','):
+    x = x.split(':')
+    if len(x) != 2 or '' in x:
+      util.critical('Expecting contrasts as LEVEL1:LEVEL2 pairs separated by commas, e.g. "WT:KO,WT:HET"...')
+    pairs.append(x)
+  return(pairs)
+
+
+def write_deseq_table(csv_deseq_name, csv, header, rc_file_list):
+  # Table of samples read by DESeqDataSetFromHTSeqCount: sample name, read count file and
+  # conditions of each sample, after the header
+  import numpy as np
+  csv_deseq_wh = [list(header)]
+  for row, rc_file in zip(csv, rc_file_list):
+    csv_deseq_wh.append([row[0], rc_file] + list(row[3:]))
+  csv_deseq_wh = np.array(csv_deseq_wh, dtype=object) # dtype=object provides an array of python object references.
+
+  np.savetxt(fname=csv_deseq_name,X=csv_deseq_wh,delimiter='\t',fmt='%s')
+
+
+def annotation_cache(genome_gtf):
+  # Folder of the annotation tables built from a GTF file, keyed by its content and shared with RNAseq_analysis.R
+  return(os.path.dirname(pragui_cache.pragui_path('annotations', pragui_cache.file_hash(genome_gtf)[:16], 'txdb.sqlite')))
+
+
+def tx2gene_map(genome_gtf):
+  # Transcript and gene ids of the transcripts of a GTF file, as two arrays. Saved as tx2gene_gtf.txt in
+  # the annotation cache of the GTF, so that it is only parsed once (not tx2gene.txt, which older
+  # versions of RNAseq_analysis.R wrote from the TxDb with NA for transcripts without a gene).
+  import numpy as np
+  tx2gene_file = os.path.join(annotation_cache(genome_gtf), 'tx2gene_gtf.txt')
+  if os.path.exists(tx2gene_file):
+    pairs = [x.rstrip('\n').split('\t') for x in open(tx2gene_file,'r')][1:]
+  else:
+    util.info('Reading transcripts and genes of %s...' % genome_gtf)
+    tx_genes = collections.OrderedDict()
+    for line in open(genome_gtf,'r'):
+      entry = gtf_gene(line)
+      if entry is None or entry[1] == '':
+        continue
+      match = GTF_TRANSCRIPT_ID.search(entry[0][8])
+      if match:
+        tx_genes.setdefault(match.group(1), entry[1])
+    pairs = list(tx_genes.items())
+    temp = '%s.%d' % (tx2gene_file, os.getpid())
+    file_obj = open(temp,'w')
+    file_obj.write('TXNAME\tGENEID\n')
+    file_obj.writelines(['%s\t%s\n' % x for x in pairs])
+    file_obj.close()
+    os.replace(temp, tx2gene_file)
+  if len(pairs) == 0:
+    util.critical('No transcript with a gene_id was found in %s...' % genome_gtf)
+  tx_ids, gene_ids = zip(*pairs)
+  return(np.array(tx_ids), np.array(gene_ids))
+
+
+def read_quant_sf(quant_file, columns=['EffectiveLength', 'TPM', 'NumReads']):
+  # Transcript names and some numeric columns of a Salmon quant.sf file
+  import numpy as np
+  header = open(quant_file,'r').readline().rstrip('\n').split('\t')
+  names = np.loadtxt(quant_file, dtype=str, delimiter='\t', skiprows=1, usecols=0, ndmin=1)
+  table = np.loadtxt(quant_file, delimiter='\t', skiprows=1, usecols=[header.index(x) for x in columns], ndmin=2)
+  return(names, table)
+
+
+def transcript_genes(names, tx_ids, gene_ids):
+  # Gene id of each transcript quantified by Salmon, '' if not in tx2gene. If no id matches, ids are
+  # compared without version, then names cut at the first bar (ignoreTxVersion, ignoreAfterBar of tximport).
+  import numpy as np
+  attempts = [(names, tx_ids),
+              (np.char.partition(names, '.')[:,0], np.char.partition(tx_ids, '.')[:,0]),
+              (np.char.partition(names, '|')[:,0], tx_ids)]
+  for names, tx_ids in attempts:
+    order = np.argsort(tx_ids)
+    pos = np.minimum(np.searchsorted(tx_ids[order], names), len(order) - 1)
+    found = tx_ids[order][pos] == names
+    if found.any():
+      return(np.where(found, gene_ids[order][pos], ''))
+  return(np.full(len(names), ''))
+
+
+def salmon_matrix_files(deseq_head):
+  # Start of the names of the gene-level tables of Salmon runs, and the tables
+  head = append_to_file_name(deseq_head, '_salmon_')
+  return(head, [head + x + '.txt' for x in SALMON_MATRICES])
+
+
+def write_salmon_matrices(quant_files, samples, genome_gtf, deseq_head):
+  # Gene-level counts, abundances (TPM) and lengths of Salmon runs summarised from their quant.sf
+  # files as tximport does, in tables read by RNAseq_analysis.R: reads and TPM summed over the
+  # transcripts of each gene, and effective lengths averaged weighted by TPM (or the mean length
+  # of the transcripts over samples when a gene has no TPM in a sample).
+  import numpy as np
+  tx_ids, gene_ids = tx2gene_map(genome_gtf)
+  names = None
+  values = []
+  for quant_file in quant_files:
+    tx_names, table = read_quant_sf(quant_file)
+    if names is None:
+      names = tx_names
+    elif not np.array_equal(names, tx_names):
+      util.critical('Salmon files %s and %s do not list the same transcripts...' % (quant_files[0], quant_file))
+    values.append(table)
+  values = np.stack(values, axis=2) # Transcripts x (length, TPM, reads) x samples
+
+  genes = transcript_genes(names, tx_ids, gene_ids)
+  known = genes != ''
+  if not known.any():
+    util.critical('None of the transcripts quantified by Salmon are in %s...' % genome_gtf)
+  if not known.all():
+    util.warn('%d of %d transcripts quantified by Salmon are not in %s and are left out...' %
+              ((~known).sum(), len(names), genome_gtf))
+  gene_names, gene_index = np.unique(genes[known], return_inverse=True)
+  order = np.argsort(gene_index, kind='stable')
+  starts = np.flatnonzero(np.r_[True, np.diff(gene_index[order]) != 0]) # First transcript of each gene
+  length, abundance, counts = [values[known][order][:,k,:] for k in range(3)]
+
+  gene_abundance = np.add.reduceat(abundance, starts, axis=0)
+  gene_counts = np.add.reduceat(counts, starts, axis=0)
+  mean_length = np.add.reduceat(length.mean(axis=1), starts) / np.diff(np.r_[starts, len(order)])
+  with np.errstate(divide='ignore', invalid='ignore'):
+    gene_length = np.add.reduceat(abundance * length, starts, axis=0) / gene_abundance
+  gene_length = np.where(gene_abundance > 0, gene_length, mean_length[:,None])
+
+  head, matrix_files = salmon_matrix_files(deseq_head)
+  row_format = '%s' + '\t%.10g' * len(quant_files) + '\n'
+  for matrix_file, matrix in zip(matrix_files, [gene_counts, gene_abundance, gene_length]):
+    file_obj = open(matrix_file,'w')
+    file_obj.write('\t'.join(['gene_id'] + list(samples)) + '\n')
+    file_obj.writelines([row_format % tuple([x] + y) for x, y in zip(gene_names.tolist(), matrix.tolist())])
+    file_obj.close()
+  util.info('Salmon quantifications of %d transcripts summarised to %d genes in %s*...' % (known.sum(), len(gene_names), head))
+  return(head)
+
+
+def deseq_command(csv_deseq_name, flags, genome_gtf, organism, contrast, levels=None, contrasts=None, fit_file=None,
+                  num_cpu=1, salmon_matrices=None):
+  # Command running RNAseq_analysis.R, flags being the steps to run joined by "_"
+  rnaseq_analysis_script = os.path.join(pragui_directory, 'RNAseq_analysis.R')
+  if levels is None:
+    cmdArgs = ['Rscript', '--vanilla', rnaseq_analysis_script, csv_deseq_name, flags, genome_gtf, organism, contrast]
+  else:
+    cmdArgs = ['Rscript', '--vanilla', rnaseq_analysis_script, csv_deseq_name, flags, genome_gtf, organism, contrast] + levels
+  cmdArgs.append('--fit_file=%s' % fit_file)
+  cmdArgs.append('--cpu=%d' % num_cpu)
+  cmdArgs.append('--annotation_cache=%s' % annotation_cache(genome_gtf))
+  if salmon_matrices is not None:
+    cmdArgs.append('--salmon_matrices=%s' % salmon_matrices)
+  if contrasts is not None:
+    cmdArgs.append('--contrasts=%s' % ','.join([':'.join(x) for x in contrasts]))
+  return(cmdArgs)
+
+
+def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism, log, aligner, contrast='condition', levels=None,
+                   contrasts=None, num_cpu=1):
+
+  if organism not in ['human', 'mouse', 'worm', 'fly', 'yeast', 'zebrafish']:
+    organism = "None"
+    util.info('No recognised organism provided...')
+  else:
+    util.info('User provided recognised organism. Using %s genes names in differential analysis output...' % organism)
+
+  # Create csv file for DESeq function DESeqDataSetFromHTSeqCount
+  deseq_head = deseq_file_head(rc_file_list, samples_csv, aligner)
 
   csv_deseq_name = append_to_file_name(deseq_head,'_DESeq_table.txt')
 
@@ -571,23 +1487,7 @@ def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism,
 
   if exists_skip(csv_deseq_name):
 
-    M = csv.shape[0]
-    N = csv.shape[1] - 1
-
-    csv_deseq = np.zeros((M,N))
-    csv_deseq = np.array(csv_deseq,dtype=object) # dtype=object provides an array of python object references.
-                                                 # It can have all the behaviours of python strings.
-
-    csv_deseq[:,0] = csv[:,0]
-    csv_deseq[:,1] = np.array(rc_file_list)
-    csv_deseq[:,2:] = csv[:,3:]
-
-    csv_deseq_wh = np.zeros((M+1,N))
-    csv_deseq_wh = np.array(csv_deseq_wh,dtype=object)
-    csv_deseq_wh[0,:] = header
-    csv_deseq_wh[1:,:] = csv_deseq
-
-    np.savetxt(fname=csv_deseq_name,X=csv_deseq_wh,delimiter='\t',fmt='%s')
+    write_deseq_table(csv_deseq_name, csv, header, rc_file_list)
 
   # Set default condition to third column in header
   if contrast is None:
@@ -598,6 +1498,9 @@ def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism,
   TPMs = append_to_file_name(deseq_head,'_tpm.txt')
   DESeq_summary = append_to_file_name(deseq_head,'_DESeq_summary.txt')
   DESeq_results = append_to_file_name(deseq_head,'_DESeq_results_4_peat.txt')
+  contrast_results = []
+  if contrasts is not None:
+    contrast_results = [append_to_file_name(deseq_head,'_DESeq_results_%s_vs_%s.txt' % tuple(x)) for x in contrasts]
 
   i=[]
 
@@ -605,20 +1508,24 @@ def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism,
     i.append("ea")                             # These do not need to be repeated if they have
   if exists_skip(TPMs):                        # already been run. Therefore, the script checks
     i.append("tpm")                            # whether the output files have been generated
-  if exists_skip(DESeq_results):               # and stores a specific flag each time that's the case.
+  if exists_skip(DESeq_results) or not all([os.path.exists(x) for x in contrast_results]): # and stores a specific flag each time that's the case.
     i.append("deseq")                          # The following R script checks which flags have been
                                                # stored and thus knows which steps to skip (if any).
   if aligner == SALMON:                        
     i.append(SALMON)
     
   if len(i) > 0:
+    outputs = [exploratory_analysis_plots, TPMs, DESeq_results, DESeq_summary] + contrast_results
+    report_progress('started', stage='de', outputs=[x for x in outputs if not os.path.exists(x)])
+    fit_file = append_to_file_name(deseq_head, '_DESeq_fit_%s.rds' % deseq_fit_key(csv_deseq_name, rc_file_list, contrast))
     i = "_".join(i)
 
-    rnaseq_analysis_script = os.path.join(pragui_directory, 'RNAseq_analysis.R')
-    if levels is None:
-      cmdArgs = ['Rscript', '--vanilla', rnaseq_analysis_script, csv_deseq_name, i, genome_gtf, organism, contrast]
-    else:
-      cmdArgs = ['Rscript', '--vanilla', rnaseq_analysis_script, csv_deseq_name, i, genome_gtf, organism, contrast] + levels
+    salmon_matrices = None
+    if aligner == SALMON:
+      salmon_matrices = write_salmon_matrices(rc_file_list, csv[:,0], genome_gtf, deseq_head)
+
+    cmdArgs = deseq_command(csv_deseq_name, i, genome_gtf, organism, contrast, levels=levels, contrasts=contrasts,
+                            fit_file=fit_file, num_cpu=num_cpu, salmon_matrices=salmon_matrices)
 
     if "deseq" in i:
       DESeq_out_obj = open(DESeq_summary,"wb")
@@ -634,8 +1541,208 @@ def DESeq_analysis(rc_file_list,samples_csv, csv, header, genome_gtf, organism,
       os.remove(sessionInfo_file)
 
 
+def cuff_replicates(csv, cxb_list):
+  # Labels of the conditions and comma separated replicates of each condition, as given to
+  # Cuffnorm and Cuffdiff. cxb_list follows the rows of the samples file, so replicates are
+  # grouped in one pass. Conditions keep the order in which they first appear.
+  rep_dict = collections.OrderedDict()
+  for conds_check, cxb_file in zip(csv[:, 3], cxb_list):
+    rep_dict.setdefault(conds_check, []).append(cxb_file)
+
+  conds_str = ','.join(rep_dict.keys())
+  reps_list = [','.join(x) for x in rep_dict.values()]
+  return(conds_str, reps_list)
+
+
+def gtf_gene(line):
+  # Fields and gene id of a GTF line, None for comments
+  fields = line.split('\t')
+  if line.startswith('#') or len(fields) < 9:
+    return(None)
+  match = GTF_GENE_ID.search(fields[8])
+  return(fields, match.group(1) if match else '')
+
+
+def gtf_loci(gtf_file):
+  # Loci of a GTF file as [number of lines, gene ids]. Genes whose spans overlap on either
+  # strand make one locus, as Cuffdiff bundles their transcripts together.
+  genes = collections.OrderedDict()
+  for line in open(gtf_file,'r'):
+    entry = gtf_gene(line)
+    if entry is None:
+      continue
+    fields, gene_id = entry
+    start, end = int(fields[3]), int(fields[4])
+    if gene_id in genes:
+      gene = genes[gene_id]
+      gene[1] = min(gene[1], start)
+      gene[2] = max(gene[2], end)
+      gene[3] += 1
+    else:
+      genes[gene_id] = [fields[0], start, end, 1]
+
+  chrom_genes = collections.OrderedDict()
+  for gene_id, (chrom, start, end, n) in genes.items():
+    chrom_genes.setdefault(chrom, []).append((start, end, n, gene_id))
+  loci = []
+  for gene_list in chrom_genes.values():
+    locus_end = None
+    for start, end, n, gene_id in sorted(gene_list):
+      if locus_end is None or start > locus_end:
+        loci.append([0, []])
+        locus_end = end
+      loci[-1][0] += n
+      loci[-1][1].append(gene_id)
+      locus_end = max(locus_end, end)
+  return(loci)
+
+
+def split_gtf(gtf_file, n_shards, shard_dir):
+  # Write the loci of a GTF file into at most n_shards GTF files with similar numbers of lines,
+  # largest loci first, each to the smallest shard. Lines keep the order of the file.
+  loci = gtf_loci(gtf_file)
+  sizes = [0] * min(n_shards, max(len(loci), 1))
+  gene_shards = {}
+  for n, gene_ids in sorted(loci, key=lambda x: x[0], reverse=True):
+    i = sizes.index(min(sizes))
+    sizes[i] += n
+    for gene_id in gene_ids:
+      gene_shards[gene_id] = i
+
+  shard_gtfs = ['%s/shard_%d.gtf' % (shard_dir, k) for k in range(len(sizes))]
+  out_objs = [open(x,'w') for x in shard_gtfs]
+  for line in open(gtf_file,'r'):
+    entry = gtf_gene(line)
+    if entry is not None:
+      out_objs[gene_shards[entry[1]]].write(line)
+  for out_obj in out_objs:
+    out_obj.close()
+  return([x for x, n in zip(shard_gtfs, sizes) if n > 0])
+
+
+def cuffdiff_workers(n_shards, worker_mem, num_cpu, mem=None):
+  # Number of Cuffdiff shards run at a time: one per core, as many as fit in the available
+  # memory with worker_mem GB each, and at least one
+  if mem is None:
+    mem = available_memory()
+  n_fit = int(mem * CUFFDIFF_MEM_FRACTION / (worker_mem * 1024.0**3))
+  if n_fit < 1:
+    util.warn('Only %.1f GB of memory are available for Cuffdiff, which may need %.1f GB...' %
+              (mem / 1024.0**3, worker_mem))
+  return(max(1, min(n_shards, num_cpu, n_fit)))
+
+
+def cuffdiff_shard_command(options, out_dir, conds_str, shard_gtf, bam_reps, total_norm=False):
+  # Cuffdiff on the loci of one shard GTF. Shards read the BAM files, as the abundances saved
+  # by Cuffquant can only be used with the whole GTF they were computed from.
+  if total_norm:
+    options = options + CUFFDIFF_SHARD_OPTIONS
+  return(['cuffdiff'] + options + ['-o', out_dir, '-L', conds_str, shard_gtf] + bam_reps)
+
+
+def warn_cuffdiff_shards(total_norm):
+  # Results of sharded Cuffdiff runs differ from those of one run on all loci
+  if total_norm:
+    norm = 'by their total numbers of fragments (classic-fpkm, total hits)'
+  else:
+    norm = 'within each group, from its loci only (add "-cuffdiff_total_norm" to scale them alike in all groups)'
+  util.warn('Cuffdiff runs on groups of loci: dispersions are estimated within each group and libraries are normalised %s. '
+            'Expression values and tests will differ from a single Cuffdiff run...' % norm)
+
+
+def bh_adjust(p_values):
+  # Benjamini-Hochberg adjusted p-values, in the order given
+  m = len(p_values)
+  q_values = [1.0] * m
+  q_min = 1.0
+  for rank, i in enumerate(sorted(range(m), key=lambda x: p_values[x], reverse=True)):
+    q_min = min(q_min, p_values[i] * m / (m - rank))
+    q_values[i] = q_min
+  return(q_values)
+
+
+def merge_cuffdiff_tables(tables, out_file, fdr=CUFFDIFF_FDR):
+  # Concatenate the tables of the same name written by each Cuffdiff shard under one header.
+  # In differential tests (.diff files), q values are computed again over the tests of all shards,
+  # for each pair of conditions and over tests with status OK as Cuffdiff does.
+  out_obj = open(out_file,'w')
+  if not out_file.endswith('.diff'):
+    for k, table in enumerate(tables):
+      file_obj = open(table,'r')
+      header = file_obj.readline()
+      if k == 0:
+        out_obj.write(header)
+      shutil.copyfileobj(file_obj, out_obj)
+      file_obj.close()
+    out_obj.close()
+    return
+
+  rows = []
+  for k, table in enumerate(tables):
+    file_obj = open(table,'r')
+    header = file_obj.readline()
+    if k == 0:
+      out_obj.write(header)
+    rows += [x.rstrip('\n').split('\t') for x in file_obj]
+    file_obj.close()
+  cols = header.rstrip('\n').split('\t')
+  i_pair = [cols.index('sample_1'), cols.index('sample_2')]
+  i_status, i_p, i_q, i_sig = [cols.index(x) for x in ['status', 'p_value', 'q_value', 'significant']]
+  tests = collections.OrderedDict()
+  for k, row in enumerate(rows):
+    if row[i_status] == 'OK':
+      tests.setdefault(tuple([row[x] for x in i_pair]), []).append(k)
+  for test_rows in tests.values():
+    q_values = bh_adjust([float(rows[k][i_p]) for k in test_rows])
+    for k, q in zip(test_rows, q_values):
+      rows[k][i_q] = '%g' % q
+      rows[k][i_sig] = 'yes' if q <= fdr else 'no'
+  for row in rows:
+    out_obj.write('\t'.join(row) + '\n')
+  out_obj.close()
+
+
+def merge_cuffdiff_shards(shard_dirs, dir_cdiff):
+  # Outputs of Cuffdiff shards merged into dir_cdiff as if written by one Cuffdiff run, to be read by
+  # cummeRbund. Feature tables (tracking and .diff files) are concatenated, the other files
+  # (read_groups.info, run.info...) describe the libraries and are taken from one shard. Each shard
+  # fits its own dispersion model, kept as var_model_shard_K.info.
+  names = []
+  for shard_dir in shard_dirs:
+    names += [x for x in sorted(os.listdir(shard_dir)) if x not in names]
+  for name in names:
+    tables = [os.path.join(x, name) for x in shard_dirs if os.path.exists(os.path.join(x, name))]
+    if name == 'var_model.info':
+      for k, shard_dir in enumerate(shard_dirs):
+        if os.path.exists(os.path.join(shard_dir, name)):
+          shutil.copy(os.path.join(shard_dir, name), os.path.join(dir_cdiff, 'var_model_shard_%d.info' % k))
+    elif name.endswith(('_tracking', '.diff')):
+      merge_cuffdiff_tables(tables, os.path.join(dir_cdiff, name))
+    else:
+      shutil.copy(tables[0], os.path.join(dir_cdiff, name))
+
+
+def cuffdiff_sharded(options, conds_str, merged_gtf, bam_files, csv, dir_cdiff, n_shards, worker_mem, num_cpu,
+                     total_norm=False):
+  # Run Cuffdiff on at most n_shards groups of loci of the merged GTF in parallel, in a single thread
+  # each so that no shard needs more memory than one Cuffdiff would, and merge their outputs
+  shard_dir = tempfile.mkdtemp(prefix='shards_', dir=dir_cdiff)
+  shard_gtfs = split_gtf(merged_gtf, n_shards, shard_dir)
+  n_workers = cuffdiff_workers(len(shard_gtfs), worker_mem, num_cpu)
+  util.info('Running Cuffdiff on %d groups of loci of %s, %d at a time...' % (len(shard_gtfs), merged_gtf, n_workers))
+  warn_cuffdiff_shards(total_norm)
+  bam_reps = cuff_replicates(csv, bam_files)[1]
+  out_dirs = ['%s/shard_%d/' % (shard_dir, k) for k in range(len(shard_gtfs))]
+  commands = [cuffdiff_shard_command(options, x, conds_str, y, bam_reps, total_norm=total_norm)
+              for x, y in zip(out_dirs, shard_gtfs)]
+  util.parallel_split_job(call_filtered, commands, [], n_workers)
+  merge_cuffdiff_shards(out_dirs, dir_cdiff)
+  shutil.rmtree(shard_dir)
+
+
 def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None, cuff_gtf=False, num_cpu=util.MAX_CORES,
-                       genome_gtf=None,cuffnorm=False, status = None, stranded=None):
+                       genome_gtf=None,cuffnorm=False, stranded=None, cuffdiff_shards=0, cuffdiff_mem=CUFFDIFF_WORKER_MEM,
+                       cuffdiff_total_norm=False):
 
   out_folder = './'
   library_type = None
@@ -677,7 +1784,6 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
     fi = f + '.bai'
     if exists_skip(fi):
       util.info('Indexing file %s...' % f)
-      util.call(['samtools','--version'],stdout=util.LOG_FILE_OBJ)
       cmdArgs = ['samtools','index',f]
       util.call(cmdArgs)
 
@@ -694,8 +1800,6 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
 
     if exists_skip(f_transcripts):
 
-      report_cuff_version('cufflinks') # Report version of cufflinks
-      
       cmdArgs = ['cufflinks','-p',str(num_cpu)]
       if cuff_opt is not None:
         cmdArgs += cuff_opt
@@ -725,8 +1829,7 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
           util.critical('Option "-cuff_gtf" should not be specified if "-g" option from Cufflinks has already been set in "-cuff_opt". Exiting...')
       cmdArgs.append(f)
 
-      util.call(cmdArgs,stderr='cufflinks_stderr.log',check = False)
-      rm_lines('cufflinks_stderr.log',util.LOG_FILE_PATH)
+      call_filtered(cmdArgs, check=False)
 
       # Rename output files
       for i in range(4):
@@ -742,7 +1845,6 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
   ofc2 = out_folder + cuff_head + '_cuffmerge.gtf'
 
   if exists_skip(ofc2):
-    util.call(['cuffmerge','--version'],stdout=util.LOG_FILE_OBJ)
     err = 0
     cmdArgs = ['cuffmerge', '-s',fasta_file ,
                '-p',str(num_cpu),
@@ -756,8 +1858,7 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
       cmdArgs.append('-g')
       cmdArgs.append(genome_gtf)
     cmdArgs.append(assemblies)
-    util.call(cmdArgs,stderr='cuffmerge_stderr.log')
-    rm_lines('cuffmerge_stderr.log',util.LOG_FILE_PATH)
+    call_filtered(cmdArgs)
     os.rename(out_folder + 'merged.gtf', ofc2)
 
   # Run Cuffquant
@@ -772,22 +1873,20 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
 
   basic_options += ['-o', out_folder] # Output folder added to the end so to facilitate using this object in downstream code (cuffdiff and cuffnorm steps)
 
-  for f in bam_files:
+  # Cuffdiff shards read the BAM files, so that abundances are then only needed by Cuffnorm
+  quantify = cuffdiff_shards <= 1 or cuffnorm
+
+  for k, f in enumerate(bam_files):
     f2 = f.split('/')[-1]
     ofc3 = out_folder + f2 + '_abundances.cxb'
     cxb_list.append(ofc3)
 
-    if exists_skip(ofc3):
-      report_cuff_version('cuffquant')
+    if quantify and exists_skip(ofc3):
+      report_progress('started', stage='count', sample=csv[k,0], outputs=[ofc3, out_folder + 'abundances.cxb'])
       cmdArgs = ['cuffquant'] + basic_options + [ofc2,f]
-      util.call(cmdArgs,stderr='cuffquant_stderr.log')
-      rm_lines('cuffquant_stderr.log',util.LOG_FILE_PATH)
+      call_filtered(cmdArgs)
       os.rename(out_folder + 'abundances.cxb', ofc3)
-      
-  if status is not None:
-    status_obj = open(status,'a')
-    status_obj.write('Read count done...\n')
-    status_obj.close()  
+    report_progress('done', stage='count', sample=csv[k,0])
    
   # Set list of replicates and conditions for both Cuffnorm and Cuffdiff
   '''
@@ -819,38 +1918,12 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
   # Only enforces ordering with conditions, not with the individual replicates
   # e.g. with conditions A and B, the replicates could be ordered A1,A2 B1,B2 or A2,A1 B2,B1
 
-  rep_dict = {}
-  conds_list = list(set(csv[:, 3]))
-  sample_files_list = list(set(csv[:, 1]))
-  for conds in conds_list:
-    rep_dict[conds] = []
-
-  for rows in range(0, csv.shape[0]):
-    conds_check = csv[rows, 3]
-    files_check = csv[rows, 1]
-    for sample_files in sample_files_list:
-      file_name_pre1 = './{0}'.format(sample_files.split('/')[-1])
-      if files_check == sample_files:
-        file_name = file_name_pre1.split('.fq.gz')[0]
-        search_pattern = re.compile('^{}.*?$'.format(file_name))
-        search_results = list(filter(search_pattern.match, cxb_list))[0]
-        cxb_index = cxb_list.index('{0}'.format(search_results))
-        rep_dict[conds_check].append(cxb_list[cxb_index])
-
-  reps = []
-  reps_list = []
-  for conditions in conds_list:
-    reps.append(rep_dict[conditions])
-  conds_str = ','.join(conds_list)
-  for conditions_2 in conds_list:
-    reps_list.append(','.join(rep_dict[conditions_2]))
+  conds_str, reps_list = cuff_replicates(csv, cxb_list)
 
   # Run Cuffnorm
 
   if cuffnorm:
 
-    report_cuff_version('cuffnorm')
-
     dir_cnorm = out_folder + '/cuffnorm/'
     dir_cnorm = new_dir(dir_cnorm)
 
@@ -860,26 +1933,26 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
     cmdArgs.append(conds_str) # Changed for Gurpreet's edit
     cmdArgs.append(ofc2)
     cmdArgs += reps_list # Changed for Gurpreet's edit
-    util.call(cmdArgs,stderr='cuffnorm_stderr.log', check = False)
-    rm_lines('cuffnorm_stderr.log', util.LOG_FILE_PATH)
+    call_filtered(cmdArgs, check=False)
 
   # Run Cuffdiff
 
-  report_cuff_version('cuffdiff')
-
   dir_cdiff = out_folder + '/cuffdiff/'
   dir_cdiff = new_dir(dir_cdiff)
 
   basic_options[4] = '1' # Cuffdiff should not be run in more than 1 thread to avoid crashing due to insufficient memory
 
-  cmdArgs = ['cuffdiff'] + basic_options[:-1]
-  cmdArgs.append(dir_cdiff)
-  cmdArgs.append('-L')
-  cmdArgs.append(conds_str) # Changed for Gurpreet's edit
-  cmdArgs.append(ofc2)
-  cmdArgs += reps_list # Changed for Gurpreet's edit
-  util.call(cmdArgs,stderr='cuffdiff_stderr.log', check = False)
-  rm_lines('cuffdiff_stderr.log',util.LOG_FILE_PATH)
+  if cuffdiff_shards > 1:
+    cuffdiff_sharded(basic_options[:-2], conds_str, ofc2, bam_files, csv, dir_cdiff, cuffdiff_shards, cuffdiff_mem, num_cpu,
+                     total_norm=cuffdiff_total_norm)
+  else:
+    cmdArgs = ['cuffdiff'] + basic_options[:-1]
+    cmdArgs.append(dir_cdiff)
+    cmdArgs.append('-L')
+    cmdArgs.append(conds_str) # Changed for Gurpreet's edit
+    cmdArgs.append(ofc2)
+    cmdArgs += reps_list # Changed for Gurpreet's edit
+    call_filtered(cmdArgs, check=False)
 
   # Run CummeRbund
 
@@ -889,16 +1962,792 @@ def Cufflinks_analysis(bam_files, samples_csv, csv, fasta_file , cuff_opt=None,
   util.info('Plot saved in %s as exploratory_analysis_plots.pdf...' % dir_cdiff)
 
 
-def run_multiqc(multiqc=True):
-  if multiqc:
-    util.info('Running multiqc on working directory...')
-    util.call(['multiqc','.'])
+def multiqc_files(csv, od, trimmed_fq, fastq_dirs, out_files, aligner, is_single_end=False, pair_tags=['r_1','r_2'],
+                  rc_file_list=None):
+  # QC reports, aligner logs and read counts of the samples of this run, for multiqc
+  read_cols = [1] if is_single_end else [1,2]
+  qc_files = []
+  for i in range(csv.shape[0]):
+    for j in read_cols:
+      # trim_galore/cutadapt reports and fastqc results are named after the input FASTQ file
+      stem = os.path.basename(csv[i,j]).replace('.gz', '').replace('.fastq', '').replace('.fq','')
+      for f in sorted(glob.glob(glob.escape(od + '/' + stem) + '*')):
+        if f.endswith(('_trimming_report.txt', '_cutadapt_report.txt', '_fastqc.zip')):
+          qc_files.append(f)
+
+  if is_single_end:
+    fq_lists = [[f] for f in trimmed_fq]
+  else:
+    fq_lists = [[r1, r2] for r1, r2 in zip(*split_pe_files(trimmed_fq, pair_tags=pair_tags))]
+  for k, out_file in enumerate(out_files):
+    if aligner == SALMON:
+      qc_files.append(os.path.dirname(out_file))
+    elif aligner == ALIGNER_STAR:
+      qc_files.append(out_file + '_Log.final.out')
+    elif aligner == ALIGNER_HISAT2:
+      sample_args = aligner_sample_args(aligner, fq_lists[k], fastq_dirs[k], out_file)
+      qc_files.append(sample_args[sample_args.index('--summary-file') + 1])
+    if aligner != SALMON:
+      qc_files.append(out_file + '_flagstat.txt')
+
+  if rc_file_list is not None:
+    qc_files += rc_file_list
+
+  return([x for x in qc_files if os.path.exists(x)])
+
+
+def multiqc_command(list_file):
+  return(['multiqc', '--file-list', list_file])
+
+
+def start_multiqc(samples_csv, qc_files, multiqc=True):
+  # Start multiqc in the background on the files of this run only, rather than on the whole
+  # working directory, so that the report is written while the rest of the analysis runs
+  if not multiqc:
+    return(None)
+  if len(qc_files) == 0:
+    util.warn('No QC files found for multiqc...')
+    return(None)
+  list_file = append_to_file_name(os.path.basename(samples_csv), '_multiqc_files.txt')
+  file_obj = open(list_file,'w')
+  for f in qc_files:
+    file_obj.write(f + '\n')
+  file_obj.close()
+  util.info('Running multiqc on %d QC files in the background (listed in %s)...' % (len(qc_files), list_file))
+  cmdArgs = multiqc_command(list_file)
+  util.logging(' '.join(cmdArgs))
+  if util.LOG_FILE_OBJ is not None:
+    util.LOG_FILE_OBJ.flush()
+  return(subprocess.Popen(cmdArgs, stdout=util.LOG_FILE_OBJ, stderr=subprocess.STDOUT if util.LOG_FILE_OBJ else None))
+
+
+def wait_multiqc(multiqc_proc):
+  if multiqc_proc is None:
+    return
+  util.info('Waiting for multiqc to finish...')
+  if multiqc_proc.wait() != 0:
+    util.critical('multiqc failed with exit code %d...' % multiqc_proc.returncode)
+
+def read_fastq_records(file_obj):
+  # Yield FASTQ records as tuples of their four lines
+  while True:
+    record = tuple([file_obj.readline() for i in range(4)])
+    if not record[0]:
+      break
+    yield record
+
+
+def subsample_fastq(in_paths, out_paths, n_reads, reservoir=False):
+  # Write n_reads records from each file in in_paths to the matching file in out_paths.
+  # Paired files are read together so that mates are kept in the same order.
+  # The first n_reads records are taken unless reservoir is set, in which case
+  # a uniform random sample of the whole file is drawn instead.
+  # Returns the number of records written and the fraction of the input they represent.
+  raw_objs  = [open(os.path.expanduser(f),'rb') for f in in_paths]
+  file_objs = []
+  for f, raw_obj in zip(in_paths, raw_objs):
+    if f.endswith('.gz'):
+      file_objs.append(gzip.GzipFile(fileobj=raw_obj))
+    else:
+      file_objs.append(raw_obj)
+  records = zip(*[read_fastq_records(x) for x in file_objs])
+
+  if reservoir:
+    rng = random.Random(n_reads) # Fixed seed so that previews are reproducible
+    sample = []
+    n = 0
+    for record in records:
+      n += 1
+      if n <= n_reads:
+        sample.append(record)
+      else:
+        k = rng.randrange(n)
+        if k < n_reads:
+          sample[k] = record
+    fraction = float(len(sample)) / n if n > 0 else 1.0
+  else:
+    sample = []
+    for record in records:
+      sample.append(record)
+      if len(sample) == n_reads:
+        break
+    if len(sample) < n_reads:
+      fraction = 1.0
+    else:
+      # Bytes of the file read so far are a proxy for the fraction of reads consumed, without
+      # reading the rest of it. For gzipped files these are compressed bytes (the size in the gzip
+      # trailer is wrong for multi-member or 4 GB files), read slightly ahead of the last record.
+      position = raw_objs[0].tell()
+      fraction = min(1.0, float(position) / max(os.path.getsize(os.path.expanduser(in_paths[0])), 1))
+
+  for file_obj in file_objs + raw_objs:
+    file_obj.close()
+
+  for j, f in enumerate(out_paths):
+    if f.endswith('.gz'):
+      out_obj = gzip.open(f, 'wb', compresslevel=1)
+    else:
+      out_obj = open(f, 'wb')
+    for record in sample:
+      out_obj.writelines(record[j])
+    out_obj.close()
+
+  return(len(sample), fraction)
+
+
+def drop_output_option(opts, flags=('-o','--output_dir')):
+  # Remove an output folder option (and its value) from a string of software arguments
+  if opts is None:
+    return(None)
+  opts = opts.split(' ')
+  for flag in flags:
+    if flag in opts:
+      ind = opts.index(flag)
+      del opts[ind:ind+2]
+  return(' '.join(opts))
+
+
+def mapping_rate(sample_dir):
+  # Read the mapping rate reported by STAR, HISAT2 or Salmon for the sample in sample_dir
+  for dir_path, dir_names, file_names in os.walk(sample_dir):
+    for f in file_names:
+      path = os.path.join(dir_path, f)
+      if f.endswith('_Log.final.out'):
+        rates = {}
+        for line in open(path):
+          if '|' in line:
+            key, value = line.split('|')
+            rates[key.strip()] = value.strip()
+        return('%s unique, %s multi' % (rates.get('Uniquely mapped reads %','NA'),
+                                          rates.get('% of reads mapped to multiple loci','NA')))
+      if f.endswith('.hisat2_summary.txt'):
+        match = re.search(r'([\d.]+%) overall alignment rate', open(path).read())
+        if match:
+          return(match.group(1))
+      if f == 'meta_info.json':
+        match = re.search(r'"percent_mapped":\s*([\d.]+)', open(path).read())
+        if match:
+          return('%.2f%%' % float(match.group(1)))
+  return('NA')
+
+
+def dir_size(dir_path):
+  size = 0
+  for dir_path, dir_names, file_names in os.walk(dir_path):
+    for f in file_names:
+      path = os.path.join(dir_path, f)
+      if not os.path.islink(path):
+        size += os.path.getsize(path)
+  return(size)
+
+
+def run_preview(n_reads, pipeline_args, reservoir=False):
+  # Run the whole pipeline on a subsample of every FASTQ file in a throwaway folder
+  # and project the run time and disk use of the full data set from it.
+  import numpy as np
+  samples_csv   = pipeline_args['samples_csv']
+  is_single_end = pipeline_args['is_single_end']
+
+  header, csv = parse_csv(samples_csv)
+  check_csv_samples(csv)
+  check_csv_reads(csv)
+
+  preview_dir = os.path.abspath(tempfile.mkdtemp(prefix='pragui_preview_', dir='.'))
+  if reservoir:
+    util.info('Preview mode: sampling %d random reads per FASTQ file into %s...' % (n_reads, preview_dir))
+  else:
+    util.info('Preview mode: taking the first %d reads per FASTQ file into %s...' % (n_reads, preview_dir))
+
+  if is_single_end:
+    read_cols = [1]
+  else:
+    read_cols = [1,2]
+
+  preview_reads = 0
+  total_reads   = 0.0
+  input_bytes   = 0
+  sample_dirs   = []
+  csv_preview   = np.array(csv, dtype=object)
+
+  for i in range(csv.shape[0]):
+    sample_dir = os.path.join(preview_dir, 'sample_%d' % i) # Sample names are not guaranteed to be valid folder names
+    os.makedirs(sample_dir)
+    sample_dirs.append(sample_dir)
+    in_paths  = [csv[i,j] for j in read_cols]
+    out_paths = [os.path.join(sample_dir, os.path.basename(f)) for f in in_paths]
+    n, fraction = subsample_fastq(in_paths, out_paths, n_reads, reservoir=reservoir)
+    preview_reads += n
+    total_reads   += n / max(fraction, 1e-9)
+    for j, f in zip(read_cols, out_paths):
+      csv_preview[i,j] = f
+      input_bytes += os.path.getsize(f)
+
+  preview_csv = os.path.join(preview_dir, os.path.basename(samples_csv))
+  header_line = open(samples_csv,'r').readline()
+  csv_obj = open(preview_csv,'w')
+  csv_obj.write(header_line)
+  for row in csv_preview:
+    csv_obj.write('\t'.join(row) + '\n')
+  csv_obj.close()
+
+  preview_args = dict(pipeline_args)
+  preview_args.update(samples_csv=preview_csv, preview=None, multiqc=False, status=None, history=False,
+                      trim_galore=drop_output_option(pipeline_args['trim_galore']),
+                      cuff_opt=drop_output_option(pipeline_args['cuff_opt'], flags=('-o',)))
+  for key in ['fasta_file', 'genome_gtf', 'al_index']:
+    if preview_args[key] is not None:
+      preview_args[key] = os.path.abspath(os.path.expanduser(preview_args[key]))
+
+  cwd = os.getcwd()
+  os.chdir(preview_dir)
+  try:
+    clock = rnaseq_diff_caller(**preview_args)
+  finally:
+    os.chdir(cwd)
+
+  scale = total_reads / max(preview_reads, 1)
+  output_bytes = dir_size(preview_dir) - input_bytes
+
+  util.info('Preview summary (%d of ~%d reads, %.3f%% of the input):' % (preview_reads, total_reads, 100.0 / scale))
+  for i in range(csv.shape[0]):
+    util.info('  %s mapping rate: %s' % (csv[i,0], mapping_rate(sample_dirs[i])))
+
+  projected_time = 0.0
+  for stage, seconds, cpu, peak_mem in clock.stages:
+    if stage == 'index':
+      util.info('  %-10s %s (not repeated in the full run)' % (stage, pragui_history.format_duration(seconds)))
+      continue
+    if stage in pragui_history.PER_READ_STAGES:
+      projected = seconds * scale
+    else:
+      projected = seconds
+    projected_time += projected
+    util.info('  %-10s preview %s, projected %s' % (stage, pragui_history.format_duration(seconds),
+                                                     pragui_history.format_duration(projected)))
+
+  util.info('Projected full run: %s and %.1f GB of disk space' % (pragui_history.format_duration(projected_time),
+                                                                   output_bytes * scale / 1e9))
+
+  shutil.rmtree(preview_dir)
+
+  return(clock)
+
+
+def shared_genome_command(al_index, mode):
+  # STAR loading (LoadAndExit) or removing (Remove) an index in shared memory. STAR writes
+  # its logs to the index folder rather than to the folder of the run.
+  return([ALIGNER_STAR, '--genomeLoad', mode, '--genomeDir', al_index,
+          '--outFileNamePrefix', os.path.join(al_index, 'shared_genome_')])
+
+
+def run_batch(samples_csvs, pipeline_args):
+  # Run the pipeline on several samples files (projects) against the same genome and options,
+  # paying the fixed costs of a run once: the aligner index is checked (or built) once, STAR
+  # reads the genome from shared memory for every sample of every project instead of loading it
+  # for each sample, and the annotations cached by the R analysis of the first project are used
+  # by the others. Each project writes the same outputs as a run of its own, and a failing
+  # project does not stop the next ones.
+  if pipeline_args['stage'] != 'all' or pipeline_args['preview'] is not None:
+    util.critical('Several samples files can only be run together with "-stage all" and without "-preview"...')
+  names = collections.Counter([os.path.basename(x) for x in samples_csvs])
+  duplicates = [x for x, n in names.items() if n > 1]
+  if len(duplicates) > 0: # Manifests and DESeq outputs are named after the samples file
+    util.critical('Samples files of a batch must have different names: %s...' % ', '.join(duplicates))
+
+  batch_args = dict(pipeline_args)
+  aligner = pipeline_args['aligner']
+  load_genome = False
+  if not pipeline_args['plan']:
+    batch_args['al_index'] = check_indices(aligner=aligner, fasta_file=pipeline_args['fasta_file'],
+                                           al_index=pipeline_args['al_index'], index_args=pipeline_args['index_args'],
+                                           num_cpu=pipeline_args['num_cpu'])[0]
+    load_genome = aligner == ALIGNER_STAR and not pipeline_args['shared_genome'] # Not already loaded by the PRAGUI service
+    batch_args['shared_genome'] = aligner == ALIGNER_STAR
+  if load_genome:
+    util.info('Loading STAR index %s into shared memory for %d projects...' % (batch_args['al_index'], len(samples_csvs)))
+    util.call(shared_genome_command(batch_args['al_index'], 'LoadAndExit'))
+
+  failed = []
+  try:
+    for k, samples_csv in enumerate(samples_csvs):
+      util.info('Project %d of %d: %s...' % (k + 1, len(samples_csvs), samples_csv))
+      batch_args['samples_csv'] = samples_csv
+      try:
+        rnaseq_diff_caller(**batch_args)
+      except (Exception, SystemExit) as err: # SystemExit from util.critical
+        util.warn('Analysis of %s failed: %s' % (samples_csv, err))
+        failed.append(samples_csv)
+  finally:
+    if load_genome:
+      util.info('Removing STAR index %s from shared memory...' % batch_args['al_index'])
+      util.call(shared_genome_command(batch_args['al_index'], 'Remove'))
+
+  if len(failed) > 0:
+    util.critical('Analysis failed for %d of %d projects: %s' % (len(failed), len(samples_csvs), ', '.join(failed)))
+  util.info('Batch of %d projects complete' % len(samples_csvs))
+
+
+def manifest_file(samples_csv):
+  # Record of the samples processed by the last run of a samples file, kept in the run folder
+  return(append_to_file_name(os.path.basename(samples_csv), '_manifest.json'))
+
+
+def sample_fingerprints(csv, is_single_end=False):
+  # Row of each sample in the samples file, and size and modification time of its FASTQ files
+  read_cols = [1] if is_single_end else [1,2]
+  fastq_files = [os.path.abspath(os.path.expanduser(row[j])) for row in csv for j in read_cols]
+  stats = map_files(os.stat, fastq_files)
+  samples = {}
+  for row in csv:
+    fastq = []
+    for j in read_cols:
+      f = os.path.abspath(os.path.expanduser(row[j]))
+      stat = stats[f]
+      fastq.append([f, stat.st_size, int(stat.st_mtime)])
+    samples[str(row[0])] = {'row': [str(x) for x in row], 'fastq': fastq}
+  return(samples)
+
+
+def manifest_settings(pipeline_args):
+  # Options of a run that change the differential expression analysis when changed
+  return(dict([(x, pipeline_args[x]) for x in ['analysis_type', 'aligner', 'fasta_file', 'genome_gtf', 'organism',
+                                                'contrast', 'levels', 'stranded', 'mapq']]))
+
+
+def count_tables(bam):
+  # Read count tables that may have been written for a BAM file: while post-processing it,
+  # after sorting it by name, or after sorting it by position (-shard_count)
+  return(['%s%s_count_table.txt' % (bam, x) for x in ['', '_sorted.bam', '_pos_sorted.bam']])
+
+
+def outdated_count_tables(manifest, settings):
+  # Count tables of the samples of the last run, outdated when an option changing read counts
+  # has changed since. They are named after the BAM files and would be reused otherwise.
+  if manifest is None or all([settings[x] == manifest['settings'].get(x) for x in COUNT_SETTINGS]):
+    return([])
+  return([y for x in manifest['samples'].values() for bam in x['outputs'] if bam.endswith('.bam')
+          for y in count_tables(bam)])
+
+
+def load_manifest(samples_csv):
+  manifest_name = manifest_file(samples_csv)
+  if not os.path.exists(manifest_name):
+    return(None)
+  return(json.load(open(manifest_name,'r')))
+
+
+def compare_manifest(manifest, samples, settings):
+  # Samples added, removed and changed (different FASTQ files) since the run that wrote
+  # manifest, and whether the differential expression analysis needs to be run again
+  if manifest is None:
+    return([], [], [], False)
+  old = manifest['samples']
+  added   = [x for x in samples if x not in old]
+  removed = [x for x in old if x not in samples]
+  changed = [x for x in samples if x in old and old[x]['fastq'] != samples[x]['fastq']]
+  rows_changed = [x for x in samples if x in old and old[x]['row'] != samples[x]['row']]
+  rerun_de = len(added + removed + changed + rows_changed) > 0 or settings != manifest['settings']
+  return(added, removed, changed, rerun_de)
+
+
+def write_manifest(samples_csv, samples, settings, sample_outputs):
+  for name in samples:
+    samples[name]['outputs'] = sample_outputs.get(name, [])
+  manifest_obj = open(manifest_file(samples_csv),'w')
+  json.dump({'settings': settings, 'samples': samples}, manifest_obj, indent=1)
+  manifest_obj.close()
+
+
+def remove_outputs(outputs):
+  for path in outputs:
+    if os.path.isdir(path):
+      util.info('Removing outdated %s...' % path)
+      shutil.rmtree(path)
+    elif os.path.exists(path):
+      util.info('Removing outdated %s...' % path)
+      os.remove(path)
+
+
+def command_line(cmdArgs, stdout=None):
+  # Command as it would be typed in a shell, for reports
+  line = ' '.join([shlex.quote(str(x)) for x in cmdArgs])
+  if stdout is not None:
+    line += ' > %s' % shlex.quote(stdout)
+  return(line)
+
+
+def path_size(path):
+  # Size in bytes of a file or folder, 0 if it does not exist
+  if os.path.isdir(path):
+    return(dir_size(path))
+  if os.path.exists(path):
+    return(os.path.getsize(path))
+  return(0)
+
+
+def format_size(n_bytes):
+  for unit in ['B', 'KB', 'MB', 'GB']:
+    if n_bytes < 1024:
+      return('%.1f %s' % (n_bytes, unit))
+    n_bytes /= 1024.0
+  return('%.1f TB' % n_bytes)
+
+
+def plan_step(stage, sample, commands, inputs, outputs, cached):
+  # One step of the plan of a run: commands to run (none if cached), files read and written
+  return({'stage'   : stage,
+          'sample'  : sample,
+          'commands': [] if cached else commands,
+          'inputs'  : inputs,
+          'outputs' : outputs,
+          'cached'  : cached})
+
+
+def plan_sizes(steps, index_bytes=None):
+  # Bytes read and written by the steps to run, in the order of the pipeline. Outputs of steps
+  # to run are estimated from the cached steps of the same stage (size of the outputs over size
+  # of the inputs), or from PLAN_OUTPUT_RATIOS when no step of the stage has been run yet.
+  sizes = {}
+  for stage in PLAN_STAGES:
+    stage_steps = [x for x in steps if x['stage'] == stage]
+    done = [x for x in stage_steps if x['cached'] and all([os.path.exists(y) for y in x['inputs']])]
+    done_in = sum([path_size(y) for x in done for y in x['inputs']])
+    ratio = PLAN_OUTPUT_RATIOS[stage]
+    if done_in > 0:
+      ratio = float(sum([path_size(y) for x in done for y in x['outputs']])) / done_in
+
+    for step in stage_steps:
+      if step['cached']:
+        step['read'] = step['written'] = 0
+        continue
+      step['read'] = sum([sizes[x] if x in sizes else path_size(x) for x in step['inputs']])
+      step['written'] = int(step['read'] * ratio)
+      if stage == 'index' and index_bytes is not None:
+        step['written'] = index_bytes
+      for x in step['outputs']:
+        sizes[x] = step['written'] / len(step['outputs'])
+  return(steps)
+
+
+def report_plan(samples_csv, steps, missing_tools):
+  util.info('Plan for %s, nothing has been run:' % samples_csv)
+  total_read = total_written = 0
+  for stage in PLAN_STAGES:
+    stage_steps = [x for x in steps if x['stage'] == stage]
+    if len(stage_steps) == 0:
+      continue
+    to_run  = [x for x in stage_steps if not x['cached']]
+    read    = sum([x['read'] for x in to_run])
+    written = sum([x['written'] for x in to_run])
+    total_read    += read
+    total_written += written
+    util.info('%-9s %d to run, %d cached, reads %s, writes ~%s' % (stage, len(to_run), len(stage_steps) - len(to_run),
+                                                                   format_size(read), format_size(written)))
+    for step in stage_steps:
+      name = step['sample'] if step['sample'] is not None else '-'
+      if step['cached']:
+        util.info('  %s: cached (%s)' % (name, ', '.join(step['outputs'])))
+      for command in step['commands']:
+        util.info('  %s: %s' % (name, command))
+  util.info('Total: reads %s, writes ~%s' % (format_size(total_read), format_size(total_written)))
+  if len(missing_tools) > 0:
+    util.warn('Tools not found: %s' % ', '.join(missing_tools))
+
+
+def plan_cufflinks(steps, bam_files, samples_csv, csv, fasta_file, cuff_opt, cuff_gtf, genome_gtf, cuffnorm, num_cpu, cached,
+                   cuffdiff_shards=0, cuffdiff_mem=CUFFDIFF_WORKER_MEM, cuffdiff_total_norm=False):
+  # Steps of Cufflinks_analysis as run from rnaseq_diff_caller
+  out_folder = './'
+  library_type = []
+  no_output_folder = True
+  is_gtf_specified = False
+  if cuff_opt is not None:
+    cuff_opt = cuff_opt.split(' ')
+    if '-o' in cuff_opt:
+      out_folder = cuff_opt[cuff_opt.index('-o') + 1] +'/'
+      no_output_folder = False
+    if '--library-type' in cuff_opt:
+      library_type = ['--library-type',cuff_opt[cuff_opt.index('--library-type') + 1]]
+    for x in ['-g', '-GTF-guide']:
+      if x in cuff_opt:
+        is_gtf_specified = True
+        cuff_gtf_file = ['-g',cuff_opt[cuff_opt.index(x) + 1]]
+
+  assemblies = out_folder + 'assembly_GTF_list.txt'
+  transcripts = []
+  for k, f in enumerate(bam_files):
+    if no_output_folder:
+      f_transcripts = f + '_transcripts.gtf'
+    else:
+      f_transcripts = out_folder + f.split('/')[-1] + '_transcripts.gtf'
+    transcripts.append(f_transcripts)
+    commands = []
+    if not cached(f + '.bai'):
+      commands.append(command_line(['samtools','index',f]))
+    cmdArgs = ['cufflinks','-p',str(num_cpu)] + (cuff_opt or [])
+    if cuff_gtf is True and not is_gtf_specified:
+      cmdArgs += ['-g', genome_gtf]
+    commands.append(command_line(cmdArgs + [f]))
+    steps.append(plan_step('cufflinks', csv[k,0], commands, [f], [f_transcripts], cached(f_transcripts)))
+
+  ofc2 = out_folder + samples_csv.split('/')[-1] + '_cuffmerge.gtf'
+  cmdArgs = ['cuffmerge', '-s',fasta_file, '-p',str(num_cpu), '-o',out_folder]
+  if is_gtf_specified:
+    cmdArgs += cuff_gtf_file
+  elif cuff_gtf is True:
+    cmdArgs += ['-g', genome_gtf]
+  steps.append(plan_step('cufflinks', None, [command_line(cmdArgs + [assemblies])], transcripts, [ofc2], cached(ofc2)))
+
+  basic_options = ['-u', '-b', fasta_file, '-p', str(num_cpu)] + library_type + ['-o', out_folder]
+  cxb_list = []
+  for k, f in enumerate(bam_files):
+    ofc3 = out_folder + f.split('/')[-1] + '_abundances.cxb'
+    cxb_list.append(ofc3)
+    if cuffdiff_shards <= 1 or cuffnorm: # Cuffdiff shards read the BAM files
+      steps.append(plan_step('cufflinks', csv[k,0], [command_line(['cuffquant'] + basic_options + [ofc2, f])],
+                             [ofc2, f], [ofc3], cached(ofc3)))
+
+  conds_str, reps_list = cuff_replicates(csv, cxb_list)
+  if cuffnorm:
+    dir_cnorm = out_folder + '/cuffnorm/'
+    cmdArgs = ['cuffnorm'] + basic_options[3:-1] + [dir_cnorm, '-L', conds_str, ofc2] + reps_list
+    steps.append(plan_step('cufflinks', None, [command_line(cmdArgs)], cxb_list, [dir_cnorm], False))
+  dir_cdiff = out_folder + '/cuffdiff/'
+  basic_options[4] = '1'
+  if cuffdiff_shards > 1:
+    n_workers = cuffdiff_workers(cuffdiff_shards, cuffdiff_mem, num_cpu)
+    cmdArgs = cuffdiff_shard_command(basic_options[:-2], dir_cdiff + 'shards/shard_K/', conds_str,
+                                     dir_cdiff + 'shards/shard_K.gtf', cuff_replicates(csv, bam_files)[1],
+                                     total_norm=cuffdiff_total_norm)
+    cuffdiff = command_line(cmdArgs) + ' (one per group of loci of %s, %d at a time)' % (ofc2, n_workers)
+    inputs = [ofc2] + bam_files
+  else:
+    cuffdiff = command_line(['cuffdiff'] + basic_options[:-1] + [dir_cdiff, '-L', conds_str, ofc2] + reps_list)
+    inputs = cxb_list
+  cummerbund_script = os.path.join(pragui_directory, 'exploratory_analysis_cummeRbund.R')
+  steps.append(plan_step('cufflinks', None, [cuffdiff, command_line(['Rscript', '--vanilla', cummerbund_script, dir_cdiff])],
+                         inputs, [dir_cdiff], False)) # Cuffdiff always runs, in a new folder if needed
+
+
+def run_plan(pipeline_args, report=True):
+  # Resolve the inputs, outputs and commands of every step of a run without running anything
+  # (option -plan): which steps would run and which are cached, and the bytes they would read
+  # and write. Outputs of samples whose input files changed since the last run count as not cached.
+  samples_csv   = pipeline_args['samples_csv']
+  fasta_file    = pipeline_args['fasta_file']
+  genome_gtf    = pipeline_args['genome_gtf']
+  aligner       = pipeline_args['aligner']
+  is_single_end = pipeline_args['is_single_end']
+  pair_tags     = pipeline_args['pair_tags']
+  num_cpu       = pipeline_args['num_cpu']
+  mapq          = pipeline_args['mapq']
+  stream        = pipeline_args['stream']
+  skipfastqc    = pipeline_args['skipfastqc']
+  fastqc_args   = pipeline_args['fastqc_args']
+  index_args    = pipeline_args['index_args']
+  analysis_type = pipeline_args['analysis_type']
+  contrasts     = pipeline_args['contrasts']
+
+  if isinstance(pair_tags, str):
+    pair_tags = pair_tags.split(',')
+  if isinstance(contrasts, str):
+    contrasts = parse_contrasts(contrasts)
+
+  header, csv = parse_csv(samples_csv)
+  check_csv_samples(csv)
+  check_csv_reads(csv)
+
+  manifest = load_manifest(samples_csv)
+  added, removed, changed, rerun_de = compare_manifest(manifest, sample_fingerprints(csv, is_single_end=is_single_end),
+                                                       manifest_settings(pipeline_args))
+  stale = set(outdated_count_tables(manifest, manifest_settings(pipeline_args)))
+  for sample in changed:
+    stale.update(manifest['samples'][sample]['outputs'])
+
+  def cached(path):
+    return(os.path.exists(path) and path not in stale)
+
+  steps = []
+
+  # Index
+  al_index = pipeline_args['al_index']
+  if al_index is None:
+    al_index, key_info = index_location(aligner, fasta_file, index_args=index_args)
+  index_bytes = None
+  if index_complete(aligner, al_index):
+    index_head = index_head_of(aligner, al_index)
+    steps.append(plan_step('index', None, [], [fasta_file], [al_index], True))
+  else:
+    cmdArgs, index_head = index_command(aligner, fasta_file, al_index, index_args, num_cpu)
+    if aligner == ALIGNER_STAR:
+      genome_len, n_seqs = fasta_stats(fasta_file)
+      index_bytes = star_memory(genome_len, int(cmdArgs[cmdArgs.index('--genomeSAsparseD') + 1]),
+                                int(cmdArgs[cmdArgs.index('--genomeSAindexNbases') + 1]))
+    steps.append(plan_step('index', None, [command_line(cmdArgs)], [fasta_file], [al_index], False))
+
+  # Trimming
+  trim_cmd, od = trim_galore_command(trim_galore=pipeline_args['trim_galore'], skipfastqc=skipfastqc,
+                                     fastqc_args=fastqc_args, is_single_end=is_single_end)
+  read_cols = [1] if is_single_end else [1,2]
+  trimmed_fq = []
+  fastq_dirs = []
+  sample_fastq = []
+  trim_steps = []
+  trimmer = FifoTrimmer(num_cpu=max(1, num_cpu // 4))
+  for i in range(csv.shape[0]):
+    fastq = [os.path.expanduser(csv[i,j]) for j in read_cols]
+    trimmed = [trimmed_file_name(csv[i,j], od, is_single_end=is_single_end, pair_tags=pair_tags, stream=stream)
+               for j in read_cols]
+    trimmed_fq += trimmed
+    fastq_dirs += [os.path.dirname(fastq[0])] * len(fastq)
+    sample_fastq.append(fastq)
+    if stream:
+      commands = [command_line(trimmer.command(fastq, trimmed)) + ' (into named pipes read by %s)' % aligner]
+      if skipfastqc is False:
+        fastqcArgs = ['fastqc', '-o', od] + (fastqc_args.split(' ') if fastqc_args is not None else [])
+        commands.append(command_line(fastqcArgs + fastq))
+      trim_steps.append(plan_step('trim', csv[i,0], commands, fastq, [], False))
+    else:
+      to_trim = [f for f, t in zip(fastq, trimmed) if not cached(t)]
+      trim_steps.append(plan_step('trim', csv[i,0], [command_line(trim_cmd + to_trim)], fastq, trimmed, len(to_trim) == 0))
+  steps += trim_steps
+
+  # Alignment
+  align_cmd = aligner_command(aligner, al_index, index_head=index_head, al_args=pipeline_args['al_args'],
+                              num_cpu=num_cpu, stream=stream)
+  if is_single_end:
+    fq_lists = [[f] for f in trimmed_fq]
+  else:
+    fq_lists = [[r1, r2] for r1, r2 in zip(*split_pe_files(trimmed_fq, pair_tags=pair_tags))]
+  stranded = pipeline_args['stranded']
+  count_gtf = genome_gtf if analysis_type == 'DESeq' and not pipeline_args['shard_count'] else None
+  out_files = []
+  for k, fq in enumerate(fq_lists):
+    out_file = aligned_file_name(aligner, fq[0], fastq_dirs[k], mapq=mapq, is_single_end=is_single_end)
+    out_files.append(out_file)
+    sample_args = aligner_sample_args(aligner, fq, fastq_dirs[k], out_file)
+    commands = [command_line(align_cmd + sample_args)]
+    if aligner != SALMON:
+      if aligner == ALIGNER_HISAT2:
+        aligned = sample_args[sample_args.index('-S') + 1]
+      else:
+        aligned = out_file + '_Aligned.sortedByCoord.out.bam'
+      commands.append(postprocess_command_line(aligned, out_file, mapq=mapq, genome_gtf=count_gtf, stranded=stranded,
+                                               index=aligner == ALIGNER_STAR, num_cpu=num_cpu))
+    inputs = sample_fastq[k] if stream else fq
+    if stream and cached(out_file): # Reads are only trimmed to be aligned
+      trim_steps[k]['cached'] = True
+      trim_steps[k]['commands'] = []
+    steps.append(plan_step('align', csv[k,0], commands, inputs, [out_file], cached(out_file)))
+
+  # Read counts and differential expression
+  rc_file_list = out_files
+  if aligner != SALMON and analysis_type == 'DESeq':
+    stranded = '--stranded=' + stranded
+    rc_file_list = []
+    for k, bam in enumerate(out_files):
+      commands = []
+      rc_file = '%s_count_table.txt' % bam
+      if cached(rc_file) or (count_gtf is not None and not cached(bam)): # Counted while post-processing the alignments
+        rc_file_list.append(rc_file)
+        if cached(rc_file):
+          steps.append(plan_step('count', csv[k,0], [], [bam], [rc_file], True))
+        continue
+      if pipeline_args['shard_count']:
+        counted = bam
+        if aligner != ALIGNER_STAR: # Only STAR alignments are sorted by position
+          counted = bam + '_pos_sorted.bam'
+          if not cached(counted):
+            commands.append(command_line(['samtools','sort','-@',str(num_cpu),'-o',counted,bam]))
+        if not cached(counted + '.bai'):
+          commands.append(command_line(['samtools','index',counted]))
+        rc_file = '%s_count_table.txt' % counted
+        commands.append(command_line(['samtools','view','-h',counted,'CONTIGS']) + ' | awk ... | ' +
+                        command_line(['htseq-count','--format=sam','--order=pos',stranded,'-',genome_gtf]) +
+                        ' (one per group of contigs on %d cores)' % num_cpu)
+      else:
+        counted = os.path.dirname(bam) + '/' + os.path.basename(bam) + '_sorted.bam'
+        if not cached(counted):
+          commands.append(command_line(['samtools','sort','-n',bam], stdout=counted))
+        rc_file = '%s_count_table.txt' % counted
+        commands.append(command_line(['htseq-count','--format=bam',stranded,counted,genome_gtf], stdout=rc_file))
+      rc_file_list.append(rc_file)
+      outputs = [rc_file] if counted == bam else [counted, rc_file]
+      steps.append(plan_step('count', csv[k,0], commands, [bam], outputs, cached(rc_file)))
+
+  if analysis_type == 'DESeq':
+    deseq_head = deseq_file_head(rc_file_list, samples_csv, aligner)
+    outputs = deseq_outputs(rc_file_list, samples_csv, aligner)
+    if contrasts is not None:
+      outputs += [append_to_file_name(deseq_head,'_DESeq_results_%s_vs_%s.txt' % tuple(x)) for x in contrasts]
+    if rerun_de:
+      stale.update(stale_deseq_outputs(rc_file_list, samples_csv, aligner) + outputs)
+    csv_deseq_name, plots, tpms, summary, results = outputs[:5]
+    flags = []
+    if not cached(plots):
+      flags.append('ea')
+    if not cached(tpms):
+      flags.append('tpm')
+    if not all([cached(x) for x in [results] + outputs[6:]]):
+      flags.append('deseq')
+    if aligner == SALMON:
+      flags.append(SALMON)
+    contrast = pipeline_args['contrast']
+    if contrast is None:
+      contrast = header[2]
+    organism = pipeline_args['organism']
+    if organism not in ['human', 'mouse', 'worm', 'fly', 'yeast', 'zebrafish']:
+      organism = "None"
+    # The fit is named after the content of the samples table and count files
+    if all([cached(x) for x in [csv_deseq_name] + rc_file_list]):
+      fit_file = append_to_file_name(deseq_head, '_DESeq_fit_%s.rds' % deseq_fit_key(csv_deseq_name, rc_file_list, contrast))
+    else:
+      fit_file = append_to_file_name(deseq_head, '_DESeq_fit_KEY.rds')
+    salmon_matrices = None
+    if aligner == SALMON: # Gene-level tables written by the pipeline itself before running R
+      salmon_matrices, matrix_files = salmon_matrix_files(deseq_head)
+      outputs = matrix_files + outputs
+    cmdArgs = deseq_command(csv_deseq_name, '_'.join(flags), genome_gtf, organism, contrast, levels=pipeline_args['levels'],
+                            contrasts=contrasts, fit_file=fit_file, num_cpu=num_cpu, salmon_matrices=salmon_matrices)
+    steps.append(plan_step('de', None, [command_line(cmdArgs, stdout=summary if 'deseq' in flags else None)],
+                           rc_file_list, [x for x in outputs if not cached(x)], len(flags) == 0))
+  else:
+    plan_cufflinks(steps, out_files, samples_csv, csv, fasta_file, pipeline_args['cuff_opt'], pipeline_args['cuff_gtf'],
+                   genome_gtf, pipeline_args['cuffnorm'], num_cpu, cached,
+                   cuffdiff_shards=pipeline_args['cuffdiff_shards'], cuffdiff_mem=pipeline_args['cuffdiff_mem'],
+                   cuffdiff_total_norm=pipeline_args['cuffdiff_total_norm'])
+
+  if pipeline_args['multiqc']:
+    list_file = append_to_file_name(os.path.basename(samples_csv), '_multiqc_files.txt')
+    steps.append(plan_step('multiqc', None, [command_line(multiqc_command(list_file))], [], [], False))
+
+  tools = required_tools(aligner, analysis_type, skipfastqc, pipeline_args['cuffnorm'], pipeline_args['multiqc'],
+                         stream=stream)
+  missing_tools = [x for x in tools if shutil.which(x) is None]
+  if report:
+    if analysis_type == 'Cufflinks' and pipeline_args['cuffdiff_shards'] > 1:
+      warn_cuffdiff_shards(pipeline_args['cuffdiff_total_norm'])
+    report_plan(samples_csv, plan_sizes(steps, index_bytes=index_bytes), missing_tools)
+  return(steps)
+
+
+def stages_to_run(pipeline_args, samples):
+  # Stages of the plan with steps to run for the given samples or for the whole run. The
+  # other stages take no time as their outputs are cached, and are left out of the run history.
+  steps = run_plan(pipeline_args, report=False)
+  return(set([x['stage'] for x in steps if not x['cached'] and x['sample'] in [None] + samples]))
+
 
 def rnaseq_diff_caller(samples_csv, fasta_file , genome_gtf, analysis_type=['DESeq','Cufflinks'][0], trim_galore=None, 
                        skipfastqc=False, fastqc_args=None, aligner=DEFAULT_ALIGNER,organism=None, is_single_end=False, pair_tags=['r_1','r_2'],
                        index_args = None, al_index =None,al_args=None,num_cpu=util.MAX_CORES,mapq=20,stranded='no',contrast='condition',levels=None,
-                       cuff_opt=None, cuff_gtf=False,cuffnorm=False, multiqc=True,python_command=None,q=False,log=False, gui=False, status=None):
+                       contrasts=None, cuff_opt=None, cuff_gtf=False,cuffnorm=False, multiqc=True,python_command=None,q=False,log=False, gui=False, status=None,
+                       preview=None, preview_random=False, stage='all', sample_task=None, stream=False,
+                       shard_count=False, plan=False, shared_genome=False, cuffdiff_shards=0, cuffdiff_mem=CUFFDIFF_WORKER_MEM,
+                       cuffdiff_total_norm=False, history=True):
   
+  pipeline_args = dict(locals()) # Needed to rerun the pipeline on a subsample in preview mode
+
   util.QUIET   = q
   util.LOGGING = log
 
@@ -913,10 +2762,8 @@ def rnaseq_diff_caller(samples_csv, fasta_file , genome_gtf, analysis_type=['DES
 
   util.info(python_command)
 
-  if status is not None:
-    status_obj = open(status,'a')
-    status_obj.write('Starting PRAGUI... \n')
-    status_obj.close()
+  global PROGRESS_FILE
+  PROGRESS_FILE = status
 
   if isinstance(pair_tags, str):
     pair_tags = pair_tags.split(',')
@@ -934,112 +2781,250 @@ def rnaseq_diff_caller(samples_csv, fasta_file , genome_gtf, analysis_type=['DES
   else:
     util.critical('Expecting ANALYSIS_TYPE to be either DESeq2 or Cufflinks...')
 
-
-  # Parse samples csv file
-
-  header, csv = parse_csv(samples_csv)
-
-  check_csv_samples(csv)
-  check_csv_reads(csv)
-
-  # Trim_galore
+  if isinstance(contrasts, str):
+    if levels is not None:
+      util.critical('Options "-contrast_levels" and "-contrasts" cannot be used together...')
+    contrasts = parse_contrasts(contrasts)
+
+
+  if plan:
+    return(run_plan(pipeline_args))
+
+  if preview is not None:
+    return(run_preview(n_reads=preview, pipeline_args=pipeline_args, reservoir=preview_random))
+
+  clock = StageClock()
+  try:
+    # Parse samples csv file
+
+    header, csv = parse_csv(samples_csv)
+
+    check_csv_samples(csv)
+    check_csv_reads(csv)
+
+    # Stages run as separate cluster jobs (see pragui_cluster.py)
+    if stage == 'samples':
+      if sample_task is None:
+        sample_task = os.environ.get('SGE_TASK_ID')
+      if sample_task is None:
+        util.critical('Expecting the number of the sample to process with option "-sample_task"...')
+      csv = csv[[int(sample_task) - 1]]
+      util.info('Processing sample %s only...' % csv[0,0])
+    elif stage not in ('all', 'index', 'de'):
+      util.critical('Expecting STAGE to be either all, index, samples or de...')
+
+    if stage in ('all', 'index'): # Per-sample cluster jobs start with the index job
+      report_progress('start', samples=list(csv[:,0]), sample_stages=SAMPLE_STAGES, run_stages=RUN_STAGES)
+
+    log_tool_versions(required_tools(aligner, analysis_type, skipfastqc, cuffnorm, multiqc, stage, stream))
+
+    # Runs are added to the history unless they are previews or all their steps are cached
+    if history and stage != 'index':
+      to_run = stages_to_run(pipeline_args, [str(x) for x in csv[:,0]])
+      history = len(to_run - set(['multiqc'])) > 0 # multiqc is never cached
+      history_skip = [x for x in PLAN_STAGES if x not in to_run]
+
+    # Compare with the samples of the last run of this samples file
+    if stage != 'samples':
+      settings = manifest_settings(pipeline_args)
+      samples_info = sample_fingerprints(csv, is_single_end=is_single_end)
+      manifest = load_manifest(samples_csv)
+      added, removed, changed, rerun_de = compare_manifest(manifest, samples_info, settings)
+      if len(added) > 0:
+        util.info('Samples added since the last run: %s...' % ', '.join(added))
+      if len(removed) > 0:
+        util.info('Samples removed since the last run: %s...' % ', '.join(removed))
+      if rerun_de:
+        util.info('Differential expression analysis will be run again...')
+      if stage in ('all', 'index'): # Later cluster jobs must keep what the sample jobs produced
+        for sample in changed:
+          util.info('Input files of sample %s have changed since the last run...' % sample)
+          remove_outputs(manifest['samples'][sample]['outputs'])
+        outdated = outdated_count_tables(manifest, settings)
+        if len(outdated) > 0:
+          util.info('Options of the read count (%s) have changed since the last run...' % ', '.join(COUNT_SETTINGS))
+          remove_outputs(outdated)
+
+    if stage == 'index':
+      check_indices(aligner=aligner, fasta_file=fasta_file, al_index=al_index, index_args=index_args, num_cpu=num_cpu)
+      return(clock)
+
+    clock.lap('setup')
+
+    if stage == 'de': # Held until the sample jobs end, whether they succeeded or not
+      od = trim_galore_command(trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args,
+                               is_single_end=is_single_end)[1]
+      out_files = aligned_outputs(csv, aligner, od, mapq=mapq, is_single_end=is_single_end, pair_tags=pair_tags, stream=stream)
+      missing = [csv[k,0] for k, x in enumerate(out_files) if not os.path.exists(x)]
+      if len(missing) > 0:
+        util.critical('Alignments of samples %s are missing, their sample jobs may have failed. Run them again with '
+                      '"-stage samples -sample_task N" before the differential expression analysis...' % ', '.join(missing))
+
+    # Trim_galore
  
-  trimmed_fq, fastq_dirs = trim_bam(samples_csv=samples_csv, csv=csv, trim_galore=trim_galore, 
-                                    skipfastqc=skipfastqc, fastqc_args=fastqc_args, 
-                                    is_single_end=is_single_end, pair_tags=pair_tags)
-  
-  if status is not None:
-    status_obj = open(status,'a')
-    status_obj.write('TrimGalore processing done... \n')
-    status_obj.close()
+    trimmer = None
+    if stream:
+      if trim_galore is not None:
+        util.critical('Options for trim_galore cannot be used with "-stream", where reads are trimmed by cutadapt with the defaults of trim_galore...')
+      util.info('Streaming trimmed reads to %s through named pipes...' % aligner)
+      trimmer = FifoTrimmer(num_cpu=max(1, num_cpu // 4))
+
+    trimmed_fq, fastq_dirs = trim_bam(samples_csv=samples_csv, csv=csv, trim_galore=trim_galore, 
+                                      skipfastqc=skipfastqc, fastqc_args=fastqc_args, 
+                                      is_single_end=is_single_end, pair_tags=pair_tags, trimmer=trimmer)
   
-  # Run Aligner
+    clock.lap('trim')
+
+    # Run Aligner
   
-  out_files = align(trimmed_fq=trimmed_fq, fastq_dirs=fastq_dirs, aligner=aligner, al_index =al_index , 
-                    al_args=al_args, index_args = index_args, num_cpu=num_cpu, fasta_file =fasta_file , 
-                    is_single_end=is_single_end, mapq=mapq, pair_tags=pair_tags)
+    out_files = align(trimmed_fq=trimmed_fq, fastq_dirs=fastq_dirs, aligner=aligner, al_index =al_index , 
+                      al_args=al_args, index_args = index_args, num_cpu=num_cpu, fasta_file =fasta_file , 
+                      is_single_end=is_single_end, mapq=mapq, pair_tags=pair_tags, clock=clock,
+                      samples=list(csv[:,0]), trimmer=trimmer,
+                      count_gtf=genome_gtf if analysis_type == 'DESeq' and not shard_count else None, stranded=stranded,
+                      shared_genome=shared_genome)
   
+    clock.lap('align')
 
-  if status is not None:
-    status_obj = open(status,'a')
-    status_obj.write('Alignment done...\n')
-    status_obj.close()
-    
-  # Differential gene expression
+    # Differential gene expression
 
-  if aligner == SALMON:
-    quant_files = out_files
-    if status is not None:
-      status_obj = open(status,'a')
-      status_obj.write('Read count done...\n')
-      status_obj.close()
-    DESeq_analysis(rc_file_list=quant_files, header=header, csv=csv, samples_csv=samples_csv,
-                   genome_gtf=genome_gtf,organism=organism,contrast=contrast,levels=levels,log=log,aligner=aligner)
-  else:
-    bam_files = out_files
-    if analysis_type == 'DESeq':
-      # Generate Count matrix with HTSeq
-      sorted_bam_list = sort_bam_parallel(bam_list = bam_files, num_cpu=num_cpu)
-      counts = read_count_htseq_parallel(bam_files=sorted_bam_list,genome_gtf=genome_gtf,stranded=stranded,num_cpu=num_cpu)
-      rc_file_list = [x[0] for x in counts]
-      if status is not None:
-        status_obj = open(status,'a')
-        status_obj.write('Read count done...\n')
-        status_obj.close()
-      # DESeq and exploratory analysis
-      DESeq_analysis(rc_file_list=rc_file_list, header=header, csv=csv, samples_csv=samples_csv,
-                     genome_gtf=genome_gtf,organism=organism,contrast=contrast,levels=levels,log=log,aligner=aligner)
+    # Outputs of each sample, removed if its input files change
+    reads_per_sample = 1 if is_single_end else 2
+    sample_outputs = {}
+    for k, sample in enumerate(csv[:,0]):
+      sample_outputs[str(sample)] = trimmed_fq[k*reads_per_sample:(k+1)*reads_per_sample] + [out_files[k]]
 
-    if analysis_type == 'Cufflinks':
-    
-      Cufflinks_analysis(bam_files=bam_files, samples_csv=samples_csv, csv=csv, cuff_opt=cuff_opt, cuff_gtf=cuff_gtf, num_cpu=num_cpu,
-                         fasta_file =fasta_file , genome_gtf=genome_gtf,cuffnorm=cuffnorm,status=status)
-  
-  if status is not None:
-    status_obj = open(status,'a')
-    status_obj.write('Differential Expression Analysis done...\n')
-    status_obj.close()
-  
-  run_multiqc(multiqc=multiqc)
-  util.info('Analysis complete')
+    # multiqc starts as soon as the last QC file of the samples is written
+    trim_dir = trim_galore_command(trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args,
+                                   is_single_end=is_single_end)[1]
+    multiqc_proc = None
+
+    if aligner == SALMON:
+      quant_files = out_files
+      for k, sample in enumerate(csv[:,0]):
+        sample_outputs[str(sample)][-1] = os.path.dirname(quant_files[k])
+      if stage != 'samples':
+        multiqc_proc = start_multiqc(samples_csv, multiqc_files(csv, trim_dir, trimmed_fq, fastq_dirs, out_files, aligner,
+                                                                is_single_end=is_single_end, pair_tags=pair_tags),
+                                     multiqc=multiqc)
+        if rerun_de:
+          remove_outputs(stale_deseq_outputs(quant_files, samples_csv, aligner))
+        DESeq_analysis(rc_file_list=quant_files, header=header, csv=csv, samples_csv=samples_csv,
+                       genome_gtf=genome_gtf,organism=organism,contrast=contrast,levels=levels,log=log,aligner=aligner,
+                       contrasts=contrasts,num_cpu=num_cpu)
+    else:
+      bam_files = out_files
+      for k, sample in enumerate(csv[:,0]):
+        sample_outputs[str(sample)] += [bam_files[k] + '.bai', bam_files[k] + '_flagstat.txt']
+      if analysis_type == 'DESeq':
+        # Generate Count matrix with HTSeq, for the BAM files not counted while post-processed
+        rc_file_list = postprocessed_counts(bam_files, list(csv[:,0]))
+        uncounted = [k for k, x in enumerate(rc_file_list) if x is None]
+        uncounted_bams = [bam_files[k] for k in uncounted]
+        uncounted_samples = [csv[k,0] for k in uncounted]
+        rc_files = []
+        if len(uncounted) > 0 and shard_count:
+          rc_files = read_count_htseq_sharded(bam_files=uncounted_bams,genome_gtf=genome_gtf,stranded=stranded,num_cpu=num_cpu,
+                                              samples=uncounted_samples)
+        elif len(uncounted) > 0:
+          sorted_bam_list = sort_bam_parallel(bam_list = uncounted_bams, num_cpu=num_cpu, samples=uncounted_samples)
+          counts = read_count_htseq_parallel(bam_files=sorted_bam_list,genome_gtf=genome_gtf,stranded=stranded,num_cpu=num_cpu,
+                                             samples=uncounted_samples)
+          rc_files = [x[0] for x in counts]
+          for sample, sorted_bam in zip(uncounted_samples, sorted_bam_list):
+            sample_outputs[str(sample)].append(sorted_bam)
+        for k, rc_file in zip(uncounted, rc_files):
+          rc_file_list[k] = rc_file
+        for k, sample in enumerate(csv[:,0]):
+          counted_bam = rc_file_list[k][:-len('_count_table.txt')] # Sorted by position with -shard_count
+          sample_outputs[str(sample)] += [rc_file_list[k], counted_bam + '.bai']
+          if counted_bam.endswith('_pos_sorted.bam'):
+            sample_outputs[str(sample)].append(counted_bam)
+        clock.lap('count')
+        # DESeq and exploratory analysis
+        if stage != 'samples':
+          multiqc_proc = start_multiqc(samples_csv, multiqc_files(csv, trim_dir, trimmed_fq, fastq_dirs, out_files, aligner,
+                                                                  is_single_end=is_single_end, pair_tags=pair_tags,
+                                                                  rc_file_list=rc_file_list),
+                                       multiqc=multiqc)
+          if rerun_de:
+            remove_outputs(stale_deseq_outputs(rc_file_list, samples_csv, aligner))
+          DESeq_analysis(rc_file_list=rc_file_list, header=header, csv=csv, samples_csv=samples_csv,
+                         genome_gtf=genome_gtf,organism=organism,contrast=contrast,levels=levels,log=log,aligner=aligner,
+                       contrasts=contrasts,num_cpu=num_cpu)
+
+      if analysis_type == 'Cufflinks' and stage != 'samples':
+        multiqc_proc = start_multiqc(samples_csv, multiqc_files(csv, trim_dir, trimmed_fq, fastq_dirs, out_files, aligner,
+                                                                is_single_end=is_single_end, pair_tags=pair_tags),
+                                     multiqc=multiqc)
+        Cufflinks_analysis(bam_files=bam_files, samples_csv=samples_csv, csv=csv, cuff_opt=cuff_opt, cuff_gtf=cuff_gtf, num_cpu=num_cpu,
+                           fasta_file =fasta_file , genome_gtf=genome_gtf,cuffnorm=cuffnorm,
+                           cuffdiff_shards=cuffdiff_shards, cuffdiff_mem=cuffdiff_mem, cuffdiff_total_norm=cuffdiff_total_norm)
+        clock.lap('cufflinks')
+
+    if stage == 'samples':
+      if history:
+        pragui_history.record_run(clock=clock, csv=csv, aligner=aligner, fasta_file=fasta_file,
+                                  analysis_type=analysis_type, num_cpu=num_cpu, skip=history_skip)
+      return(clock)
+
+    if analysis_type == 'DESeq': # Cufflinks runs were timed as a whole
+      clock.lap('de')
+    report_progress('done', stage='de')
+    write_manifest(samples_csv, samples_info, settings, sample_outputs)
   
-  if status is not None:
-    status_obj = open(status,'a')
-    status_obj.write('All done!\n')
-    status_obj.close()
+    wait_multiqc(multiqc_proc)
+    clock.lap('multiqc')
+    report_progress('done', stage='multiqc')
+    util.info('Analysis complete')
 
+    if history:
+      pragui_history.record_run(clock=clock, csv=csv, aligner=aligner, fasta_file=fasta_file,
+                                analysis_type=analysis_type, num_cpu=num_cpu, skip=history_skip)
 
-def check_csv_samples(csv):
-  samples_list = []
+    report_progress('finished')
 
-  for entries in csv:
-    samples_list.append(entries[0])
+    return(clock)
+  finally:
+    clock.stop()
 
-  duplicates = set()
 
-  for sample in samples_list:
-    if samples_list.count(sample) > 1:
-      duplicates.add(sample)
+def check_csv_samples(csv):
+  counts = collections.Counter([str(entries[0]) for entries in csv])
+  duplicates = [sample for sample, n in counts.items() if n > 1]
 
   if len(duplicates) > 0:
     util.critical('Duplicate sample names; there are more than 1 entires for {0}'.format(', '.join(duplicates)))
 
 
+def map_files(func, paths, num_threads=FILE_CHECK_THREADS):
+  # Call func once for each distinct path in threads and return a dict path -> result.
+  # File system calls wait on the disk (or network file system) rather than on Python,
+  # so checking the thousands of FASTQ files of a large samples file is much faster in parallel.
+  paths = list(dict.fromkeys(paths))
+  if len(paths) < 2 or num_threads < 2:
+    return(dict([(x, func(x)) for x in paths]))
+  pool = ThreadPoolExecutor(max_workers=min(num_threads, len(paths)))
+  try:
+    results = list(pool.map(func, paths))
+  finally:
+    pool.shutdown()
+  return(dict(zip(paths, results)))
+
+
 def check_csv_reads(csv):
   errors = {}
+  fastq_files = [fastq_file for entries in csv for fastq_file in entries[1:3] if fastq_file != '']
+  file_checks = map_files(util.check_regular_file, fastq_files)
 
   for entries in csv:
     sample_name = entries[0]
-    read1 = entries[1]
-    read2 = entries[2]
-
-    read_list = [read1, read2]
+    read_list = [entries[1], entries[2]]
 
-    for fastq_file in read_list:
-      fastq_read_number = read_list.index(fastq_file) + 1
+    for fastq_read_number, fastq_file in enumerate(read_list, 1):
 
       if not fastq_file == '':
-        file_check_status, file_check_mesasge = util.check_regular_file(fastq_file)
+        file_check_status, file_check_mesasge = file_checks[fastq_file]
 
         if file_check_status == False:
           if not sample_name in errors:
@@ -1059,7 +3044,9 @@ def check_csv_reads(csv):
     util.critical(out_message)
 
 
-if __name__ == '__main__':
+def main(argv=None, shared_indexes=()):
+  # Run PRAGUI from command line arguments (sys.argv by default). shared_indexes are STAR
+  # indexes already loaded in shared memory, e.g. by the PRAGUI service (see pragui_daemon.py).
 
   from argparse import ArgumentParser
 
@@ -1069,8 +3056,8 @@ if __name__ == '__main__':
   arg_parse = ArgumentParser(prog=PROG_NAME, description=DESCRIPTION,
                              epilog=epilog, prefix_chars='-', add_help=True)
 
-  arg_parse.add_argument('samples_csv', metavar='SAMPLES_CSV',
-                         help='File path of a tab-separated file containing the samples names, the file path for read1, the file path for read2, the experimental condition (e.g. Mutant or Wild-type) and any other information to be used as contrasts for differential expression calling. For single-ended experiments, please fill read2 slot with NA.')
+  arg_parse.add_argument('samples_csv', metavar='SAMPLES_CSV', nargs='+',
+                         help='File path of a tab-separated file containing the samples names, the file path for read1, the file path for read2, the experimental condition (e.g. Mutant or Wild-type) and any other information to be used as contrasts for differential expression calling. For single-ended experiments, please fill read2 slot with NA. Several samples files (projects sharing the genome and options) can be given to run them one after the other, checking the aligner index once and, with STAR, keeping the genome in shared memory for all of them.')
 
   arg_parse.add_argument('fasta_file ', metavar='fasta_file ',
                          help='File path of genome sequence FASTA file (for use by genome aligner)')
@@ -1128,6 +3115,9 @@ if __name__ == '__main__':
   arg_parse.add_argument('-contrast_levels', nargs=2, default=None,
                          help='Set comparisons for DESeq2. By default, DESeq2 compare last level over the first level from the CONTRAST column.')
 
+  arg_parse.add_argument('-contrasts', metavar='LEVEL1:LEVEL2,...', default=None,
+                         help='Comparisons of levels from the CONTRAST column, e.g. "WT:KO,WT:HET". DESeq2 is fitted once and a results table is written for each comparison. The fit is saved and reused when other comparisons are requested later.')
+
   arg_parse.add_argument('-cuff_opt', default=None,
                          help='options to be provided to cufflinks. They should be provided under quotes. If not provided, cufflinks will run with developer\'s default options.')
 
@@ -1137,9 +3127,39 @@ if __name__ == '__main__':
   arg_parse.add_argument('-cuffnorm', default=False, action='store_true',
                          help='Specify whether Cuffnorm should be executed besides Cuffdiff.')
 
+  arg_parse.add_argument('-cuffdiff_shards', metavar='NUM_SHARDS', default=0, type=int,
+                         help='Run Cuffdiff on up to NUM_SHARDS groups of loci of the merged GTF in parallel, instead of on all loci in one thread, and merge their outputs, recomputing q values over all loci. Dispersions are estimated within each group, so results differ from a single Cuffdiff run. Each group reads every BAM file in full, so the BAM files are read up to NUM_SHARDS times. Cuffquant is then only run for "-cuffnorm".')
+
+  arg_parse.add_argument('-cuffdiff_total_norm', default=False, action='store_true',
+                         help='With "-cuffdiff_shards", normalise libraries by their total numbers of fragments (classic-fpkm, total hits) so that all groups of loci scale them alike, instead of normalising them within each group.')
+
+  arg_parse.add_argument('-cuffdiff_mem', metavar='GB', default=CUFFDIFF_WORKER_MEM, type=float,
+                         help='Memory needed by each Cuffdiff run with "-cuffdiff_shards", limiting how many run at a time to fit in the available memory. Default: %.0f GB' % CUFFDIFF_WORKER_MEM)
+
   arg_parse.add_argument('-disable_multiqc', default=False, action='store_true',
                          help='Specify whether to disable multiqc run. Defaults to False.')
 
+  arg_parse.add_argument('-preview', metavar='NUM_READS', default=None, type=int,
+                         help='Run the whole pipeline on the first NUM_READS reads of every FASTQ file in a throwaway folder and report mapping rates plus the projected run time and disk use of the full analysis.')
+
+  arg_parse.add_argument('-preview_random', default=False, action='store_true',
+                         help='In preview mode, draw a random sample of NUM_READS reads from every FASTQ file instead of taking the first reads. Slower, as whole files are read, whereas the first reads only need the start of each file.')
+
+  arg_parse.add_argument('-stage', default='all', choices=['all','index','samples','de'],
+                         help='Part of the pipeline to run: all (default), index (only check/build the aligner index), samples (trimming, alignment and read counting of the sample given by -sample_task) or de (the whole pipeline, reusing per-sample outputs). Set by per-sample cluster submissions.')
+
+  arg_parse.add_argument('-sample_task', metavar='SAMPLE_NUMBER', default=None, type=int,
+                         help='Row number (starting at 1) of the sample processed with "-stage samples". Defaults to the SGE_TASK_ID of a cluster array job.')
+
+  arg_parse.add_argument('-stream', default=False, action='store_true',
+                         help='Trim reads with cutadapt into named pipes read directly by the aligner, instead of writing trimmed FASTQ files. Saves disk space and I/O. Fastqc is run on the input files. Paired-end reads are trimmed on one core, so that cutadapt writes mates to both pipes as the aligner reads them.')
+
+  arg_parse.add_argument('-shard_count', default=False, action='store_true',
+                         help='Count the reads of each BAM file on all cores by splitting it by chromosomes, instead of one core per BAM file. Faster with fewer samples than cores. BAM files are sorted by position and indexed if needed. Reads are then counted after the alignment of all samples, rather than while each BAM file is filtered.')
+
+  arg_parse.add_argument('-plan', default=False, action='store_true',
+                         help='Only print the plan of the run: the commands of every step, which steps would run and which are already done (cached), and the bytes each stage would read and write. No tool is run.')
+
   arg_parse.add_argument('-q',default=False, action='store_true',
                          help='Sets quiet mode to supress on-screen reporting.')
 
@@ -1152,7 +3172,9 @@ if __name__ == '__main__':
   arg_parse.add_argument('-status', default=None,
                          help='Status file. Should only be specified by GUI. Do not change this parameter manually.')
 
-  args = vars(arg_parse.parse_args())
+  args = vars(arg_parse.parse_args(argv))
+
+  util.init_app('rnapip') # Redefine variables from cross_fil_util.py
 
   samples_csv   = args['samples_csv']
   fasta_file   = args['fasta_file ']
@@ -1173,10 +3195,21 @@ if __name__ == '__main__':
   stranded      = args['stranded']
   contrast      = args['contrast']
   levels        = args['contrast_levels']
+  contrasts     = args['contrasts']
   cuff_opt      = args['cuff_opt']
   cuff_gtf      = args['cuff_gtf']
   cuffnorm      = args['cuffnorm']
+  cuffdiff_shards = args['cuffdiff_shards']
+  cuffdiff_mem  = args['cuffdiff_mem']
+  cuffdiff_total_norm = args['cuffdiff_total_norm']
   multiqc       = not args['disable_multiqc']
+  preview       = args['preview']
+  preview_random = args['preview_random']
+  stage         = args['stage']
+  sample_task   = args['sample_task']
+  stream        = args['stream']
+  shard_count   = args['shard_count']
+  plan          = args['plan']
 
   # Reporting handled by cross_fil_util.py (submodule)
   q      = args['q']
@@ -1185,16 +3218,36 @@ if __name__ == '__main__':
   status = args['status']
 
   # Save python command
-  python_command = ' '.join(sys.argv) + '\n'
+  if argv is None:
+    argv = sys.argv[1:]
+  python_command = ' '.join([sys.argv[0]] + argv) + '\n'
+
+  shared_genome = aligner == ALIGNER_STAR and al_index is not None and \
+                  os.path.realpath(al_index) in [os.path.realpath(x) for x in shared_indexes]
+
+  if gui and status is not None and os.getpid() != os.getpgrp():
+    os.setpgrp() # Own process group, so that cancelling from the GUI stops every tool started here
   
-  rnaseq_diff_caller(samples_csv=samples_csv, fasta_file =fasta_file , genome_gtf=genome_gtf, levels=levels,
+  caller_args = dict(samples_csv=samples_csv[0], fasta_file =fasta_file , genome_gtf=genome_gtf, levels=levels, contrasts=contrasts,
                      analysis_type=analysis_type, trim_galore=trim_galore, skipfastqc=skipfastqc, fastqc_args=fastqc_args,
                      aligner=aligner, organism=organism,is_single_end=is_single_end, pair_tags=pair_tags,al_index= al_index,
                      index_args = index_args, al_args=al_args,num_cpu=num_cpu,mapq=mapq,stranded=stranded,contrast=contrast,
                      cuff_opt=cuff_opt, cuff_gtf=cuff_gtf,cuffnorm=cuffnorm, multiqc=multiqc,python_command=python_command,q=q,
-                     log=log,gui=gui,status=status)
-
-
+                     log=log,gui=gui,status=status,preview=preview,preview_random=preview_random,
+                     stage=stage,sample_task=sample_task,stream=stream,
+                     shard_count=shard_count, plan=plan, shared_genome=shared_genome,
+                     cuffdiff_shards=cuffdiff_shards, cuffdiff_mem=cuffdiff_mem, cuffdiff_total_norm=cuffdiff_total_norm)
+
+  try:
+    if len(samples_csv) > 1:
+      run_batch(samples_csv, caller_args)
+    else:
+      rnaseq_diff_caller(**caller_args)
+  except BaseException as err: # Includes exits from util.critical
+    report_progress('failed', message=str(err))
+    raise
 
 
+if __name__ == '__main__':
 
+  main()